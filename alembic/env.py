@@ -1,6 +1,7 @@
 from logging.config import fileConfig
 from sqlalchemy import engine_from_config, pool
 from alembic import context
+import os
 import sys
 from os.path import abspath, dirname
 
@@ -8,18 +9,23 @@ from os.path import abspath, dirname
 # 确保 Alembic 能找到您的模型文件
 sys.path.insert(0, dirname(dirname(abspath(__file__))))  # 假设模型文件在项目根目录
 
-# ---------- 关键修改 2：导入您的模型基类 ----------
-from fx_bot import Base  # 替换为您的实际模型文件路径
-
 # Alembic 配置对象
 config = context.config
 
-# 配置日志（保留原有代码）
-if config.config_file_name is not None:
+# 与机器人一致：设置了 FX_DB_PATH 时覆盖 alembic.ini 中的数据库地址
+if os.environ.get('FX_DB_PATH'):
+    config.set_main_option('sqlalchemy.url', f"sqlite:///{os.environ['FX_DB_PATH']}")
+
+# 配置日志（保留原有代码）；由机器人进程内调用时沿用机器人自己的日志配置
+if config.config_file_name is not None and config.attributes.get('configure_logger', True):
     fileConfig(config.config_file_name)
 
-# ---------- 关键修改 3：设置元数据 ----------
-target_metadata = Base.metadata  # 原为 None
+# ---------- 关键修改 2/3：导入模型基类并设置元数据 ----------
+# 机器人进程内调用时直接传入元数据，避免以 fx_bot 之名再次导入主模块
+target_metadata = config.attributes.get('target_metadata')
+if target_metadata is None:
+    from fx_bot import Base  # 替换为您的实际模型文件路径
+    target_metadata = Base.metadata  # 原为 None
 
 def run_migrations_offline() -> None:
     """离线模式迁移（用于生成SQL脚本）"""
@@ -35,18 +41,30 @@ def run_migrations_offline() -> None:
 
 def run_migrations_online() -> None:
     """在线模式迁移（直接操作数据库）"""
+    connection = config.attributes.get('connection')
+    if connection is not None:
+        # 机器人进程内调用：复用传入的连接
+        do_run_migrations(connection)
+        return
+
     connectable = engine_from_config(
         config.get_section(config.config_ini_section, {}),
         prefix="sqlalchemy.",
         poolclass=pool.NullPool,
     )
     with connectable.connect() as connection:
-        context.configure(
-            connection=connection,
-            target_metadata=target_metadata  # 确保这里使用正确的元数据
-        )
-        with context.begin_transaction():
-            context.run_migrations()
+        do_run_migrations(connection)
+
+def do_run_migrations(connection) -> None:
+    # 初始迁移为空：基础表按模型元数据建立（已存在的表不受影响），后续迁移在其上增量修改
+    target_metadata.create_all(connection)
+    context.configure(
+        connection=connection,
+        target_metadata=target_metadata,  # 确保这里使用正确的元数据
+        render_as_batch=True,  # SQLite 需要批处理模式修改表结构
+    )
+    with context.begin_transaction():
+        context.run_migrations()
 
 # 根据模式选择迁移方式
 if context.is_offline_mode():
@@ -0,0 +1,66 @@
+"""query indexes
+
+Revision ID: 5c2e9a41d7b3
+Revises: 733f2627b10d
+Create Date: 2026-10-17 04:10:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5c2e9a41d7b3'
+down_revision: Union[str, None] = '733f2627b10d'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+
+    # 早期数据库缺少结算字段（原 run_migrations 中的 ALTER TABLE）
+    columns = {c['name'] for c in sa.inspect(bind).get_columns('transactions')}
+    with op.batch_alter_table('transactions') as batch_op:
+        if 'settled_in' not in columns:
+            batch_op.add_column(sa.Column('settled_in', sa.Float(), server_default='0'))
+        if 'settled_out' not in columns:
+            batch_op.add_column(sa.Column('settled_out', sa.Float(), server_default='0'))
+
+    # 余额 upsert 依赖 (customer_name, currency) 唯一；建索引前先合并历史重复行
+    op.execute(
+        "UPDATE balances SET amount = ("
+        " SELECT ROUND(SUM(b2.amount), 2) FROM balances b2"
+        " WHERE b2.customer_name IS balances.customer_name AND b2.currency IS balances.currency)"
+        " WHERE id IN (SELECT MIN(id) FROM balances GROUP BY customer_name, currency HAVING COUNT(*) > 1)"
+    )
+    op.execute(
+        "DELETE FROM balances WHERE id NOT IN (SELECT MIN(id) FROM balances GROUP BY customer_name, currency)"
+    )
+    op.create_index('uq_balances_customer_currency', 'balances', ['customer_name', 'currency'],
+                    unique=True, if_not_exists=True)
+
+    # /received、/paid 查找客户未结订单：customer_name + status，按 timestamp 取最近
+    op.create_index('ix_transactions_customer_status_ts', 'transactions',
+                    ['customer_name', 'status', 'timestamp'], if_not_exists=True)
+    # /creport 客户交易：customer_name + timestamp BETWEEN
+    op.create_index('ix_transactions_customer_ts', 'transactions',
+                    ['customer_name', 'timestamp'], if_not_exists=True)
+    # /pnl、/report 区间查询：timestamp BETWEEN
+    op.create_index('ix_transactions_timestamp', 'transactions', ['timestamp'], if_not_exists=True)
+    # /creport 调整记录：customer_name + timestamp BETWEEN
+    op.create_index('ix_adjustments_customer_ts', 'adjustments',
+                    ['customer_name', 'timestamp'], if_not_exists=True)
+    # /pnl 支出区间查询与 /expenses 倒序列表
+    op.create_index('ix_expenses_timestamp', 'expenses', ['timestamp'], if_not_exists=True)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_expenses_timestamp', table_name='expenses', if_exists=True)
+    op.drop_index('ix_adjustments_customer_ts', table_name='adjustments', if_exists=True)
+    op.drop_index('ix_transactions_timestamp', table_name='transactions', if_exists=True)
+    op.drop_index('ix_transactions_customer_ts', table_name='transactions', if_exists=True)
+    op.drop_index('ix_transactions_customer_status_ts', table_name='transactions', if_exists=True)
+    op.drop_index('uq_balances_customer_currency', table_name='balances', if_exists=True)
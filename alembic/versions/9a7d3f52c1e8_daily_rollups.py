@@ -0,0 +1,71 @@
+"""daily rollups
+
+Revision ID: 9a7d3f52c1e8
+Revises: 5c2e9a41d7b3
+Create Date: 2026-10-17 06:20:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9a7d3f52c1e8'
+down_revision: Union[str, None] = '5c2e9a41d7b3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+
+    # 启动时 create_all 可能已建好空表，此时只需回填
+    if not sa.inspect(bind).has_table('daily_rollups'):
+        op.create_table(
+            'daily_rollups',
+            sa.Column('day', sa.Date(), primary_key=True),
+            sa.Column('currency', sa.String(4), primary_key=True),
+            sa.Column('total_income', sa.Float(), nullable=False),
+            sa.Column('settled_income', sa.Float(), nullable=False),
+            sa.Column('total_expense', sa.Float(), nullable=False),
+            sa.Column('settled_expense', sa.Float(), nullable=False),
+            sa.Column('expense', sa.Float(), nullable=False),
+            sa.Column('income_count', sa.Integer(), nullable=False),
+            sa.Column('payout_count', sa.Integer(), nullable=False),
+            sa.Column('expense_count', sa.Integer(), nullable=False),
+        )
+
+    # 从历史交易与支出回填（与 fx_bot.rollup_source_query 口径一致）
+    op.execute("DELETE FROM daily_rollups")
+    op.execute(
+        "INSERT INTO daily_rollups (day, currency, total_income, settled_income, total_expense,"
+        " settled_expense, expense, income_count, payout_count, expense_count)"
+        " SELECT day, currency, SUM(total_income), SUM(settled_income), SUM(total_expense),"
+        " SUM(settled_expense), SUM(expense), SUM(income_count), SUM(payout_count), SUM(expense_count)"
+        " FROM ("
+        "  SELECT date(timestamp) AS day,"
+        "   CASE WHEN transaction_type = 'buy' THEN quote_currency ELSE base_currency END AS currency,"
+        "   CASE WHEN transaction_type = 'buy'"
+        "    THEN CASE WHEN operator = '/' THEN amount / rate ELSE amount * rate END"
+        "    ELSE amount END AS total_income,"
+        "   COALESCE(settled_in, 0) AS settled_income, 0.0 AS total_expense, 0.0 AS settled_expense,"
+        "   0.0 AS expense, 1 AS income_count, 0 AS payout_count, 0 AS expense_count"
+        "  FROM transactions"
+        "  UNION ALL"
+        "  SELECT date(timestamp),"
+        "   CASE WHEN transaction_type = 'buy' THEN base_currency ELSE quote_currency END,"
+        "   0.0, 0.0,"
+        "   CASE WHEN transaction_type = 'buy' THEN amount"
+        "    ELSE CASE WHEN operator = '/' THEN amount / rate ELSE amount * rate END END,"
+        "   COALESCE(settled_out, 0), 0.0, 0, 1, 0"
+        "  FROM transactions"
+        "  UNION ALL"
+        "  SELECT date(timestamp), currency, 0.0, 0.0, 0.0, 0.0, amount, 0, 0, 1 FROM expenses"
+        " ) GROUP BY day, currency"
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('daily_rollups')
@@ -0,0 +1,26 @@
+"""expenses currency index
+
+Revision ID: e41b7c9d2a63
+Revises: 9a7d3f52c1e8
+Create Date: 2026-10-17 08:40:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e41b7c9d2a63'
+down_revision: Union[str, None] = '9a7d3f52c1e8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # /expenses 按货币筛选后按 (timestamp, id) 倒序分页
+    op.create_index('ix_expenses_currency_ts', 'expenses', ['currency', 'timestamp'], if_not_exists=True)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_expenses_currency_ts', table_name='expenses', if_exists=True)
@@ -0,0 +1 @@
+"""fx_bot 性能基准脚本"""
@@ -0,0 +1,84 @@
+"""结算状态引擎基准：逐行计算 vs 向量化计算
+
+用法: python -m bench.bench_status [--rows 200000] [--repeat 3] [--seed 7]
+"""
+import argparse
+import random
+import time
+from collections import namedtuple
+
+from fx_bot import settlement_status, settlements
+
+Row = namedtuple('Row', ['amount', 'rate', 'operator', 'transaction_type', 'settled_in', 'settled_out'])
+
+
+def legacy_status(tx):
+    """原报表中的逐行实现（对照用）"""
+    if tx.operator == '/':
+        total_quote = tx.amount / tx.rate
+    else:
+        total_quote = tx.amount * tx.rate
+    settled_base = tx.settled_out if tx.transaction_type == 'buy' else tx.settled_in
+    settled_quote = tx.settled_in if tx.transaction_type == 'buy' else tx.settled_out
+    base_progress = settled_base / tx.amount if tx.amount != 0 else 0
+    quote_progress = settled_quote / total_quote if total_quote != 0 else 0
+    done = int(settled_base) >= int(tx.amount) and int(settled_quote) >= int(total_quote)
+    return total_quote, min(base_progress, quote_progress), done
+
+
+def make_rows(n: int, seed: int) -> list:
+    rnd = random.Random(seed)
+    rows = []
+    for _ in range(n):
+        amount = round(rnd.uniform(100, 100000), 2)
+        rate = round(rnd.uniform(0.1, 40), 4)
+        operator = rnd.choice('*/')
+        total_quote = amount / rate if operator == '/' else amount * rate
+        # 约三分之一已结清、三分之一部分结算、其余未结算
+        fill = rnd.choice((0.0, rnd.random(), 1.0))
+        rows.append(Row(amount, rate, operator, rnd.choice(('buy', 'sell')),
+                        round(total_quote * fill, 2), round(amount * fill, 2)))
+    return rows
+
+
+def best_of(fn, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args(argv)
+
+    rows = make_rows(args.rows, args.seed)
+    amount, rate, operator, transaction_type, settled_in, settled_out = zip(*rows)
+    columns = (amount, rate, [op == '/' for op in operator], [t == 'buy' for t in transaction_type],
+               settled_in, settled_out)
+
+    legacy = [legacy_status(tx) for tx in rows]
+    st = settlements(rows)
+    mismatches = sum(
+        1 for old, total_quote, min_progress, done in zip(legacy, st.total_quote, st.min_progress, st.done)
+        if old[2] != done or abs(old[0] - total_quote) > 1e-9 or abs(old[1] - min_progress) > 1e-12
+    )
+
+    t_legacy = best_of(lambda: [legacy_status(tx) for tx in rows], args.repeat)
+    t_vector = best_of(lambda: settlement_status(*columns), args.repeat)
+    t_rows = best_of(lambda: settlements(rows), args.repeat)
+
+    print(f"行数: {args.rows}  不一致: {mismatches}")
+    print(f"逐行计算:          {t_legacy * 1000:8.1f} ms")
+    print(f"向量化（列数组）:  {t_vector * 1000:8.1f} ms  ({t_legacy / t_vector:.1f}x)")
+    print(f"向量化（含行转换）:{t_rows * 1000:8.1f} ms  ({t_legacy / t_rows:.1f}x)")
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,195 @@
+"""合成数据集：按种子确定性地生成指定规模的 fx_bot 数据库
+
+用法: python -m bench.dataset --db /tmp/fx_bench.db --transactions 1000000 --customers 5000 --seed 7
+
+数据库结构由 fx_bot 自身（create_all + Alembic 迁移）建立，数据用 sqlite3 executemany 在一个事务内
+批量写入：常见货币对（USDT/MYR/USD/SGD/CNY）与各自的 / 或 * 报价习惯，约四成订单已结清、
+两成多部分结算，另有手动调整与公司支出。客户与公司余额由同样的记账规则累加得出，
+与交易、结算、调整、支出完全一致；日汇总最后由 fx_bot.rebuild_rollups() 生成。
+
+相同的 --seed 与 --until 生成完全相同的数据。fx_bot 在导入时按 FX_DB_PATH 绑定数据库，
+因此 open_database() 必须在本进程首次导入 fx_bot 之前调用。
+"""
+import argparse
+import importlib
+import os
+import random
+import sqlite3
+import sys
+import time
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+
+# (基础货币, 报价货币, 运算符, 中间价, 权重)：报价货币金额 = 金额 / 汇率 或 金额 * 汇率
+PAIRS = [
+    ('MYR', 'USDT', '/', 4.42, 30),
+    ('USDT', 'MYR', '*', 4.42, 25),
+    ('USD', 'MYR', '*', 4.45, 12),
+    ('MYR', 'USD', '/', 4.45, 8),
+    ('USDT', 'USD', '*', 1.0, 8),
+    ('SGD', 'MYR', '*', 3.45, 7),
+    ('CNY', 'MYR', '*', 0.62, 5),
+    ('USDT', 'CNY', '*', 7.2, 5),
+]
+SETTLED_SHARE = 0.40   # 两侧都已结清
+PARTIAL_SHARE = 0.25   # 部分结算
+ADJUSTMENT_RATIO = 50  # 每多少笔交易一条手动调整
+EXPENSE_RATIO = 200    # 每多少笔交易一条公司支出
+EXPENSE_PURPOSES = ('办公室租金', '员工工资', '银行手续费', '网络费用', '交通费', '茶水费')
+BATCH = 50000
+
+TRANSACTION_SQL = (
+    "INSERT INTO transactions (order_id, customer_name, transaction_type, base_currency, quote_currency,"
+    " amount, rate, operator, status, payment_in, payment_out, timestamp, settled_in, settled_out)"
+    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0, 0, ?, ?, ?)"
+)
+
+
+def open_database(path: str):
+    """把 fx_bot 绑定到 path 并在结构落后时升级到最新版本，返回 fx_bot 模块"""
+    if 'fx_bot' in sys.modules:
+        module = sys.modules['fx_bot']
+        if os.path.abspath(module.DB_PATH) != os.path.abspath(path):
+            raise RuntimeError(f"fx_bot 已绑定到 {module.DB_PATH}，无法切换到 {path}")
+        return module
+    os.environ['FX_DB_PATH'] = path
+    module = importlib.import_module('fx_bot')
+    module.ensure_schema()
+    return module
+
+
+def customer_names(count: int) -> list:
+    return [f"c{i:05d}" for i in range(1, count + 1)]
+
+
+def sorted_timestamps(rnd: random.Random, count: int, start: datetime, span: int) -> list:
+    """span 秒内的 count 个随机时间（升序，精确到秒），使订单号随时间递增"""
+    offsets = sorted(rnd.random() for _ in range(count))
+    return [(start + timedelta(seconds=int(offset * span))).isoformat(' ') for offset in offsets]
+
+
+def transaction_rows(rnd: random.Random, count: int, names: list, start: datetime, span: int, balances):
+    """逐行生成交易，同时把下单与结算对余额的影响累加到 balances"""
+    pairs = [pair[:4] for pair in PAIRS]
+    weights = [pair[4] for pair in PAIRS]
+    choices = rnd.choices(pairs, weights, k=count)
+    timestamps = sorted_timestamps(rnd, count, start, span)
+    for i, ((base, quote, operator, mid), timestamp) in enumerate(zip(choices, timestamps), 1):
+        customer = names[int(rnd.random() ** 2 * len(names))]  # 少数客户贡献大部分交易
+        rate = round(mid * (0.98 + rnd.random() * 0.04), 4)
+        amount = round(100 + rnd.random() ** 3 * 99900, 2)
+        quote_amount = amount / rate if operator == '/' else amount * rate
+        is_buy = rnd.random() < 0.5
+
+        # 下单：买入时客户获得基础货币、支付报价货币；卖出相反
+        if is_buy:
+            income_currency, income_total, payout_currency, payout_total = quote, quote_amount, base, amount
+            balances[(customer, base)] += amount
+            balances[(customer, quote)] -= quote_amount
+        else:
+            income_currency, income_total, payout_currency, payout_total = base, amount, quote, quote_amount
+            balances[(customer, base)] -= amount
+            balances[(customer, quote)] += quote_amount
+
+        draw = rnd.random()
+        if draw < SETTLED_SHARE:
+            status, settled_in, settled_out = 'settled', round(income_total, 2), round(payout_total, 2)
+        elif draw < SETTLED_SHARE + PARTIAL_SHARE:
+            settled_in = round(income_total * rnd.choice((0.0, rnd.random(), 1.0)), 2)
+            settled_out = round(payout_total * rnd.random(), 2) if settled_in < income_total else 0.0
+            status = 'partial' if settled_in or settled_out else 'pending'
+        else:
+            status, settled_in, settled_out = 'pending', 0.0, 0.0
+
+        # 结算：/received 客户与公司余额同增，/paid 同减
+        if settled_in:
+            balances[(customer, income_currency)] += settled_in
+            balances[('COMPANY', income_currency)] += settled_in
+        if settled_out:
+            balances[(customer, payout_currency)] -= settled_out
+            balances[('COMPANY', payout_currency)] -= settled_out
+
+        yield (f"YS{i:09d}", customer, 'buy' if is_buy else 'sell', base, quote, amount, rate, operator,
+               status, timestamp, settled_in, settled_out)
+
+
+def adjustment_rows(rnd: random.Random, count: int, names: list, start: datetime, span: int, balances) -> list:
+    currencies = sorted({currency for pair in PAIRS for currency in pair[:2]})
+    rows = []
+    for timestamp in sorted_timestamps(rnd, count, start, span):
+        customer = rnd.choice(names)
+        currency = rnd.choice(currencies)
+        amount = round(rnd.uniform(-500, 500), 2)
+        balances[(customer, currency)] += amount
+        rows.append((customer, currency, amount, '对账差额调整', timestamp))
+    return rows
+
+
+def expense_rows(rnd: random.Random, count: int, start: datetime, span: int, balances) -> list:
+    rows = []
+    for timestamp in sorted_timestamps(rnd, count, start, span):
+        currency = rnd.choice(('MYR', 'MYR', 'USD', 'USDT'))
+        amount = round(rnd.uniform(10, 5000), 2)
+        balances[('COMPANY', currency)] -= amount
+        rows.append((amount, currency, rnd.choice(EXPENSE_PURPOSES), timestamp))
+    return rows
+
+
+def generate(path: str, transactions: int, customers: int, days: int = 365, seed: int = 7,
+             until: date = None) -> dict:
+    """在 path 生成数据库，交易分布在 until（默认今天）之前的 days 天内，返回统计信息"""
+    if os.path.exists(path):
+        raise FileExistsError(f"{path} 已存在")
+    started = time.perf_counter()
+    fx_bot = open_database(path)
+    rnd = random.Random(seed)
+    names = customer_names(customers)
+    end = datetime.combine(until or date.today(), datetime.min.time()) + timedelta(days=1)
+    span = days * 86400
+    start = end - timedelta(seconds=span)
+    balances = defaultdict(float)
+
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute("PRAGMA cache_size=-262144")
+        conn.executemany("INSERT INTO customers (name) VALUES (?)", [(name,) for name in ['COMPANY', *names]])
+        rows = transaction_rows(rnd, transactions, names, start, span, balances)
+        while batch := [row for _, row in zip(range(BATCH), rows)]:
+            conn.executemany(TRANSACTION_SQL, batch)
+        conn.executemany(
+            "INSERT INTO adjustments (customer_name, currency, amount, note, timestamp) VALUES (?, ?, ?, ?, ?)",
+            adjustment_rows(rnd, transactions // ADJUSTMENT_RATIO, names, start, span, balances)
+        )
+        conn.executemany(
+            "INSERT INTO expenses (amount, currency, purpose, timestamp) VALUES (?, ?, ?, ?)",
+            expense_rows(rnd, transactions // EXPENSE_RATIO, start, span, balances)
+        )
+        conn.executemany(
+            "INSERT INTO balances (customer_name, currency, amount) VALUES (?, ?, ?)",
+            [(customer, currency, round(amount, 2)) for (customer, currency), amount in sorted(balances.items())]
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    fx_bot.rebuild_rollups()
+    return {'db': path, 'transactions': transactions, 'customers': customers,
+            'adjustments': transactions // ADJUSTMENT_RATIO, 'expenses': transactions // EXPENSE_RATIO,
+            'balances': len(balances), 'seconds': round(time.perf_counter() - started, 2)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', required=True, help="输出数据库路径（不能已存在）")
+    parser.add_argument('--transactions', type=int, default=100000)
+    parser.add_argument('--customers', type=int, default=2000)
+    parser.add_argument('--days', type=int, default=365, help="交易时间分布在最近多少天内")
+    parser.add_argument('--until', type=date.fromisoformat, help="最后一天（YYYY-MM-DD，默认今天）")
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args(argv)
+    print(generate(args.db, args.transactions, args.customers, args.days, args.seed, args.until))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
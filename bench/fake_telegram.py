@@ -0,0 +1,173 @@
+"""本地假 Telegram Bot API 服务，用于在不连外网的情况下测试 webhook 模式
+
+机器人以 webhook 模式启动并指向本服务后，本服务接收 setWebhook 登记，
+再把构造的更新 POST 到机器人的 webhook 端点，记录 sendMessage / sendDocument
+回复并统计从推送到收到回复的延迟。
+
+用法:
+    FX_TELEGRAM_BASE_URL=http://127.0.0.1:8081 FX_WEBHOOK_LISTEN=127.0.0.1 \\
+        python fx_bot.py run --mode webhook &
+    python -m bench.fake_telegram --port 8081 --updates 50 "/balance" "alice buy 1000MYR/4.42 USDT"
+"""
+import argparse
+import itertools
+import json
+import re
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BOT_USER = {'id': 100000001, 'is_bot': True, 'first_name': 'fx_bot', 'username': 'fx_test_bot'}
+
+
+class FakeTelegram:
+    """假 Bot API：记录 webhook 登记与机器人发出的消息，并向 webhook 推送更新"""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 8081):
+        self.webhook_url = None
+        self.secret_token = None
+        self.sent = []  # (发送时间, chat_id, 方法, 文本或文件名)
+        self._ids = itertools.count(1)
+        self._cond = threading.Condition()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                method = self.path.rsplit('/', 1)[-1]
+                result = fake.handle(method, body, self.headers.get('Content-Type', ''))
+                payload = json.dumps({'ok': True, 'result': result}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST
+
+        return Handler
+
+    def handle(self, method: str, body: bytes, content_type: str):
+        if content_type.startswith('multipart/'):
+            params = dict(re.findall(rb'name="(\w+)"\r\n\r\n([^\r]*)', body))
+            params = {k.decode(): v.decode(errors='replace') for k, v in params.items()}
+            filename = re.search(rb'filename="([^"]*)"', body)
+            params.setdefault('document', filename.group(1).decode(errors='replace') if filename else '')
+        elif body:
+            params = json.loads(body) if content_type.startswith('application/json') else \
+                dict(urllib.parse.parse_qsl(body.decode()))
+        else:
+            params = {}
+
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'setWebhook':
+            with self._cond:
+                self.webhook_url = params.get('url')
+                self.secret_token = params.get('secret_token')
+                self._cond.notify_all()
+            return True
+        if method in ('sendMessage', 'sendDocument'):
+            chat_id = int(params.get('chat_id', 0))
+            content = params.get('text') if method == 'sendMessage' else params.get('document')
+            with self._cond:
+                self.sent.append((time.perf_counter(), chat_id, method, content))
+                self._cond.notify_all()
+            return {
+                'message_id': next(self._ids), 'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'}, 'from': BOT_USER,
+                **({'text': content} if method == 'sendMessage' else {})
+            }
+        return True
+
+    def wait_for_webhook(self, timeout: float = 30) -> str:
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.webhook_url, timeout):
+                raise TimeoutError("机器人未登记 webhook")
+            return self.webhook_url
+
+    def push(self, text: str, chat_id: int = 1, user_id: int = 1) -> int:
+        """向机器人 webhook 推送一条文本消息更新，返回 update_id"""
+        update_id = next(self._ids)
+        message = {
+            'message_id': update_id, 'date': int(time.time()), 'text': text,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'op{user_id}'},
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        request = urllib.request.Request(
+            self.webhook_url, data=json.dumps({'update_id': update_id, 'message': message}).encode(),
+            headers={'Content-Type': 'application/json',
+                     **({'X-Telegram-Bot-Api-Secret-Token': self.secret_token} if self.secret_token else {})}
+        )
+        # 机器人先登记 webhook 再开始监听，刚登记后的第一次推送可能被拒绝连接
+        for attempt in range(50):
+            try:
+                urllib.request.urlopen(request, timeout=30).read()
+                return update_id
+            except urllib.error.URLError as e:
+                if not isinstance(e.reason, ConnectionRefusedError) or attempt == 49:
+                    raise
+                time.sleep(0.1)
+
+    def wait_for_replies(self, chat_id: int, count: int, timeout: float = 30) -> list:
+        with self._cond:
+            self._cond.wait_for(lambda: len([s for s in self.sent if s[1] == chat_id]) >= count, timeout)
+            return [s for s in self.sent if s[1] == chat_id]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--updates', type=int, default=20, help="推送的更新条数（轮流使用给出的文本）")
+    parser.add_argument('texts', nargs='*', default=['/balance'])
+    args = parser.parse_args(argv)
+
+    fake = FakeTelegram(args.host, args.port).start()
+    print(f"假 Bot API 已启动: http://{args.host}:{args.port}，等待机器人登记 webhook…")
+    print(f"webhook: {fake.wait_for_webhook()}")
+
+    latencies = []
+    for i in range(args.updates):
+        chat_id = 10000 + i
+        start = time.perf_counter()
+        fake.push(args.texts[i % len(args.texts)], chat_id=chat_id)
+        replies = fake.wait_for_replies(chat_id, 1)
+        if replies:
+            latencies.append(replies[0][0] - start)
+    fake.stop()
+
+    result = {'updates': args.updates, 'replied': len(latencies)}
+    if latencies:
+        latencies.sort()
+        result.update({
+            'p50_ms': round(statistics.median(latencies) * 1000, 2),
+            'p95_ms': round(latencies[max(0, int(len(latencies) * 0.95) - 1)] * 1000, 2),
+            'max_ms': round(latencies[-1] * 1000, 2),
+        })
+    print(json.dumps(result, ensure_ascii=False))
+    return 0 if len(latencies) == args.updates else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,245 @@
+"""处理器负载基准：用伪造的 Update/Context 按指定速率与命令配比驱动真实处理器
+
+用法:
+    python -m bench.load --transactions 100000 --customers 2000 --rate 200 --duration 20 \\
+        --mix trade=50,received=15,paid=10,cancel=5,pnl=5,report=5,creport=10
+    python -m bench.load --db /tmp/fx_bench.db --rate 100 --output result.json
+
+未指定 --db 时在临时目录生成合成数据库（见 bench.dataset）。处理器取自 fx_bot.build_application()
+的注册结果，因此与线上一样经过命令调度器。请求按固定间隔开环发出，延迟从计划发出时刻算起，
+排队等待也计入其中。结果为一行 JSON：各命令的次数、失败/拒绝数、p50/p95/p99 延迟（毫秒）与吞吐量。
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import sqlite3
+import tempfile
+from collections import defaultdict
+from io import BytesIO
+
+from bench import dataset
+
+DEFAULT_MIX = 'trade=50,received=15,paid=10,cancel=5,pnl=5,report=5,creport=10'
+CURRENCIES = ('USDT', 'MYR', 'USD')
+
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+
+
+class FakeChat:
+    type = 'private'
+
+    def __init__(self, chat_id: int):
+        self.id = chat_id
+
+
+class FakeMessage:
+    """记录处理器回复的消息对象，提供处理器用到的 reply_text / reply_document"""
+
+    def __init__(self, text: str, chat_id: int):
+        self.text = text
+        self.chat_id = chat_id
+        self.replies = []
+        self.bytes_sent = 0
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+        self.bytes_sent += len(text.encode('utf-8'))
+
+    async def reply_document(self, document=None, filename=None, caption=None, **kwargs):
+        data = document.getvalue() if isinstance(document, BytesIO) else document
+        self.replies.append(caption or filename or '')
+        self.bytes_sent += len(data or b'')
+
+
+class FakeUpdate:
+    def __init__(self, text: str, chat_id: int = 1, user_id: int = 1):
+        self.message = FakeMessage(text, chat_id)
+        self.effective_message = self.message
+        self.effective_user = FakeUser(user_id)
+        self.effective_chat = FakeChat(chat_id)
+
+
+class FakeContext:
+    def __init__(self, args: list):
+        self.args = args
+
+
+def registered_handlers(fx_bot) -> dict:
+    """命令名 -> 回调（含调度包装）；普通文本（交易录入）的回调键为 'trade'"""
+    application = fx_bot.build_application()
+    callbacks = {}
+    for handler in application.handlers[0]:
+        commands = getattr(handler, 'commands', None)
+        if commands:
+            for command in commands:
+                callbacks[command] = handler.callback
+        else:
+            callbacks['trade'] = handler.callback
+    return callbacks
+
+
+def parse_mix(text: str) -> dict:
+    mix = {}
+    for part in text.split(','):
+        command, _, weight = part.partition('=')
+        mix[command.strip()] = float(weight or 1)
+    return mix
+
+
+class Workload:
+    """按配比随机生成 (命令, 消息文本, 参数)，客户与待撤销订单取自数据库"""
+
+    def __init__(self, db_path: str, mix: dict, seed: int):
+        self.rnd = random.Random(seed)
+        self.commands = list(mix)
+        self.weights = [mix[c] for c in self.commands]
+        conn = sqlite3.connect(db_path)
+        try:
+            self.customers = [name for (name,) in conn.execute(
+                "SELECT name FROM customers WHERE name != 'COMPANY' ORDER BY name")]
+            self.open_orders = [order_id for (order_id,) in conn.execute(
+                "SELECT order_id FROM transactions WHERE status = 'pending' ORDER BY order_id DESC LIMIT 20000")]
+        finally:
+            conn.close()
+        if not self.customers:
+            raise SystemExit("数据库中没有客户，请先生成数据集")
+        self.rnd.shuffle(self.open_orders)
+
+    def next(self):
+        command = self.rnd.choices(self.commands, self.weights)[0]
+        customer = self.rnd.choice(self.customers)
+        amount = f"{self.rnd.randint(100, 20000)}{self.rnd.choice(CURRENCIES)}"
+        if command == 'trade':
+            side = self.rnd.choice(('买', '卖'))
+            text = f"{customer} {side} {self.rnd.randint(100, 50000)}MYR /{self.rnd.uniform(4.3, 4.5):.4f} USDT"
+            return command, text, []
+        if command in ('received', 'paid'):
+            args = [customer, amount]
+        elif command == 'cancel':
+            args = [self.open_orders.pop() if self.open_orders else 'YS000000000']
+        elif command == 'creport':
+            args = [customer]
+        else:
+            args = []
+        return command, ' '.join([f"/{command}", *args]), args
+
+
+def percentile(sorted_values: list, p: float) -> float:
+    """最近秩百分位"""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(p * len(sorted_values)) - 1)]
+
+
+async def drive(callbacks: dict, workload: Workload, rate: float, duration: float) -> tuple:
+    """以 rate 次/秒开环发出请求，持续 duration 秒；返回 (各命令样本, 实际耗时)"""
+    loop = asyncio.get_running_loop()
+    samples = defaultdict(list)   # 命令 -> [(延迟, 结果, 发送字节)]
+    tasks = []
+
+    async def run_one(command, text, args, planned):
+        update = FakeUpdate(text)
+        outcome = 'ok'
+        try:
+            await callbacks[command](update, FakeContext(args))
+            replies = update.message.replies
+            if any(str(r).startswith('⏳') for r in replies):
+                outcome = 'shed'
+            elif any(str(r).startswith('❌') for r in replies):
+                outcome = 'error'
+        except Exception:
+            outcome = 'error'
+        samples[command].append((loop.time() - planned, outcome, update.message.bytes_sent))
+
+    start = loop.time()
+    total = int(rate * duration)
+    for i in range(total):
+        planned = start + i / rate
+        delay = planned - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        command, text, args = workload.next()
+        tasks.append(asyncio.create_task(run_one(command, text, args, planned)))
+    await asyncio.gather(*tasks)
+    return samples, loop.time() - start
+
+
+def summarize(samples: dict, elapsed: float) -> dict:
+    def stats(entries):
+        latencies = sorted(latency for latency, _, _ in entries)
+        return {
+            'count': len(entries),
+            'errors': sum(outcome == 'error' for _, outcome, _ in entries),
+            'shed': sum(outcome == 'shed' for _, outcome, _ in entries),
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+            'max_ms': round(latencies[-1] * 1000, 2) if latencies else 0.0,
+            'throughput': round(len(entries) / elapsed, 2) if elapsed else 0.0,
+            'bytes_sent': sum(sent for _, _, sent in entries),
+        }
+
+    result = {command: stats(entries) for command, entries in sorted(samples.items())}
+    result['all'] = stats([entry for entries in samples.values() for entry in entries])
+    return result
+
+
+async def run(fx_bot, db_path: str, mix: dict, rate: float, duration: float, seed: int) -> tuple:
+    fx_bot.balance_cache.rebuild()
+    fx_bot.open_orders.rebuild()
+    callbacks = registered_handlers(fx_bot)
+    unknown = set(mix) - set(callbacks)
+    if unknown:
+        raise SystemExit(f"未注册的命令: {', '.join(sorted(unknown))}")
+    return await drive(callbacks, Workload(db_path, mix, seed), rate, duration)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', help="使用已有数据库（会被写入，请传副本）；不指定则生成临时数据集")
+    parser.add_argument('--transactions', type=int, default=100000, help="生成数据集的交易笔数")
+    parser.add_argument('--customers', type=int, default=2000, help="生成数据集的客户数")
+    parser.add_argument('--rate', type=float, default=100, help="每秒发出的请求数")
+    parser.add_argument('--duration', type=float, default=10, help="持续秒数")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="命令配比，如 trade=50,pnl=5")
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--output', help="同时把 JSON 结果写入该文件")
+    parser.add_argument('--log-level', default='ERROR')
+    args = parser.parse_args(argv)
+
+    # 先于导入 fx_bot 配置根日志器，fx_bot 导入时的 basicConfig 便不再把级别改回 INFO
+    logging.basicConfig(level=args.log_level, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = args.db
+        if db_path is None:
+            db_path = os.path.join(tmp, 'fx_bench.db')
+            dataset.generate(db_path, args.transactions, args.customers, seed=args.seed)
+        fx_bot = dataset.open_database(db_path)
+        logging.getLogger(fx_bot.__name__).setLevel(args.log_level)
+        mix = parse_mix(args.mix)
+        samples, elapsed = asyncio.run(run(fx_bot, db_path, mix, args.rate, args.duration, args.seed))
+
+    result = {
+        'config': {'db': args.db, 'transactions': args.transactions if args.db is None else None,
+                   'customers': args.customers if args.db is None else None, 'rate': args.rate,
+                   'duration': args.duration, 'mix': mix, 'seed': args.seed},
+        'elapsed': round(elapsed, 2),
+        'commands': summarize(samples, elapsed),
+    }
+    output = json.dumps(result, ensure_ascii=False)
+    print(output)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
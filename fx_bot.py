@@ -1,32 +1,57 @@
-from collections import defaultdict
+from collections import OrderedDict, defaultdict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta
+from queue import Empty
+import argparse
+import bisect
+import contextlib
+import contextvars
+import functools
+import asyncio
 import calendar
 import os
 import re
+import signal
+import sqlite3
 import io
+import itertools
 import calendar
 import logging
-import pandas as pd
+import multiprocessing
+import threading
 import time
+import urllib.parse
+import weakref
+import zlib
 from sqlalchemy.exc import OperationalError
 import random
+import sys
 from io import BytesIO
 from logging.handlers import RotatingFileHandler
 from decimal import Decimal, getcontext
-from sqlalchemy import create_engine, Column, String, Float, DateTime, Integer, ForeignKey, func, text
+from sqlalchemy import (
+    create_engine, event, Column, String, Float, Date, DateTime, Integer, ForeignKey, Index,
+    case, delete, func, insert, literal, literal_column, select, tuple_, union_all, update
+)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import declarative_base, sessionmaker, scoped_session, relationship
 from telegram import Update
+from telegram.error import RetryAfter
+from telegram.request import HTTPXRequest
 from decimal import Decimal, ROUND_HALF_UP
 from sqlalchemy import Numeric
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
+    BaseRateLimiter,
     MessageHandler,
+    TypeHandler,
     filters,
     ContextTypes
 )
 
 # ================== 初始化配置 ==================
+STARTED_AT = time.perf_counter()  # 模块导入完成的时刻，机器人开始接收更新时据此记录启动耗时
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
@@ -49,6 +74,9 @@ class Balance(Base):
     currency = Column(String(4))
     amount = Column(Float)
     customer = relationship("Customer", back_populates="balances")
+    __table_args__ = (
+        Index('uq_balances_customer_currency', 'customer_name', 'currency', unique=True),
+    )
 
 class Transaction(Base):
     __tablename__ = 'transactions'
@@ -66,6 +94,11 @@ class Transaction(Base):
     timestamp = Column(DateTime, default=datetime.now)
     settled_in = Column(Float, default=0)  
     settled_out = Column(Float, default=0) # 新增：已结算付款
+    __table_args__ = (
+        Index('ix_transactions_customer_status_ts', 'customer_name', 'status', 'timestamp'),
+        Index('ix_transactions_customer_ts', 'customer_name', 'timestamp'),
+        Index('ix_transactions_timestamp', 'timestamp'),
+    )
 
 class Adjustment(Base):
     __tablename__ = 'adjustments'
@@ -75,6 +108,9 @@ class Adjustment(Base):
     amount = Column(Float)
     note = Column(String(200))
     timestamp = Column(DateTime, default=datetime.now)
+    __table_args__ = (
+        Index('ix_adjustments_customer_ts', 'customer_name', 'timestamp'),
+    )
 
 class Expense(Base):
     __tablename__ = 'expenses'
@@ -83,27 +119,1127 @@ class Expense(Base):
     currency = Column(String(4))
     purpose = Column(String(200))
     timestamp = Column(DateTime, default=datetime.now)
+    __table_args__ = (
+        Index('ix_expenses_timestamp', 'timestamp'),
+        Index('ix_expenses_currency_ts', 'currency', 'timestamp'),
+    )
+
+class Sequence(Base):
+    __tablename__ = 'sequences'
+    name = Column(String(32), primary_key=True)   # 序列名称
+    value = Column(Integer, nullable=False)        # 已预留的最大编号
+
+# 按 (交易日, 货币) 增量维护的盈亏汇总，交易/结算/撤销/支出写入时同步更新
+class DailyRollup(Base):
+    __tablename__ = 'daily_rollups'
+    day = Column(Date, primary_key=True)                          # 交易/支出发生日
+    currency = Column(String(4), primary_key=True)
+    total_income = Column(Float, nullable=False, default=0)       # 应收总额
+    settled_income = Column(Float, nullable=False, default=0)     # 已收（settled_in）
+    total_expense = Column(Float, nullable=False, default=0)      # 应付总额
+    settled_expense = Column(Float, nullable=False, default=0)    # 已付（settled_out）
+    expense = Column(Float, nullable=False, default=0)            # 公司支出
+    income_count = Column(Integer, nullable=False, default=0)     # 以该货币为收入侧的交易笔数
+    payout_count = Column(Integer, nullable=False, default=0)     # 以该货币为支出侧的交易笔数
+    expense_count = Column(Integer, nullable=False, default=0)    # 支出笔数
 
 # ================== 数据库初始化 ==================
-engine = create_engine('sqlite:///fx_bot.db', pool_pre_ping=True, connect_args={'timeout': 30})
-Base.metadata.create_all(engine)
+DB_PATH = os.environ.get('FX_DB_PATH', 'fx_bot.db')
+DB_TIMEOUT = float(os.environ.get('FX_DB_TIMEOUT', '30'))  # 等待写锁的秒数
+
+# 存储配置：连接建立时执行的 PRAGMA。WAL 下读事务读取快照，不会阻塞写入，
+# 写入也不会阻塞读取；NORMAL 同步在 WAL 下仍保证一致性，只是掉电时可能丢失最后几次提交。
+STORAGE_PROFILES = {
+    'legacy': {},  # 原有行为：回滚日志，长时间读取期间写入需等待
+    'wal': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -65536,      # 64 MB 页缓存
+        'mmap_size': 268435456,    # 256 MB 内存映射
+        'temp_store': 'MEMORY',
+    },
+    'durable': {
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+        'cache_size': -16384,
+        'temp_store': 'MEMORY',
+    },
+}
+STORAGE_PROFILE = os.environ.get('FX_STORAGE_PROFILE', 'wal').lower()
+
+def storage_pragmas() -> dict:
+    """当前存储配置的 PRAGMA，FX_SQLITE_PRAGMAS（如 "cache_size=-131072,mmap_size=0"）可逐项覆盖"""
+    if STORAGE_PROFILE not in STORAGE_PROFILES:
+        raise ValueError(f"未知存储配置: {STORAGE_PROFILE}（可选 {', '.join(STORAGE_PROFILES)}）")
+    pragmas = dict(STORAGE_PROFILES[STORAGE_PROFILE])
+    for item in filter(None, os.environ.get('FX_SQLITE_PRAGMAS', '').split(',')):
+        name, _, value = item.partition('=')
+        pragmas[name.strip()] = value.strip()
+    return pragmas
+
+def apply_pragmas(dbapi_connection, pragmas: dict):
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+    finally:
+        cursor.close()
+
+engine = create_engine(f'sqlite:///{DB_PATH}', pool_pre_ping=True, connect_args={'timeout': DB_TIMEOUT})
+
+@event.listens_for(engine, 'connect')
+def apply_storage_pragmas(dbapi_connection, connection_record):
+    apply_pragmas(dbapi_connection, storage_pragmas())
+
 session_factory = sessionmaker(bind=engine)
 Session = scoped_session(session_factory)
 
+# 报表专用的只读连接池：以 mode=ro 打开，并设置 query_only，报表查询不可能写库
+report_engine = create_engine(
+    f'sqlite:///file:{urllib.parse.quote(DB_PATH)}?mode=ro&uri=true',
+    pool_pre_ping=True, connect_args={'timeout': DB_TIMEOUT}
+)
 
-# ================== 数据库迁移脚本 ==================
-def run_migrations():
-    engine = create_engine('sqlite:///fx_bot.db')
-    with engine.connect() as conn:
+@event.listens_for(report_engine, 'connect')
+def apply_report_pragmas(dbapi_connection, connection_record):
+    pragmas = {name: value for name, value in storage_pragmas().items() if name != 'journal_mode'}
+    apply_pragmas(dbapi_connection, {**pragmas, 'query_only': 'ON'})
+
+ReportSession = scoped_session(sessionmaker(bind=report_engine))
+
+# ================== 异步数据访问层 ==================
+# 所有同步SQLAlchemy操作都派发到专用的数据库线程池执行，事件循环只负责收发消息，
+# 一个慢查询（如 /pnl）不会再阻塞其他聊天的交易录入。
+DB_WORKERS = int(os.environ.get('FX_DB_WORKERS', '4'))
+db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix='fx-db')
+# 报表与查询类处理器使用独立线程池和只读连接池，慢报表不占用账务线程
+REPORT_WORKERS = int(os.environ.get('FX_REPORT_WORKERS', '2'))
+report_executor = ThreadPoolExecutor(max_workers=REPORT_WORKERS, thread_name_prefix='fx-report')
+
+def run_in_session(registry, fn, args, kwargs):
+    """在数据库线程中以 registry 的线程本地会话执行 fn(session, ...)"""
+    session = registry()
+    try:
+        return fn(session, *args, **kwargs)
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        registry.remove()
+
+async def run_db(fn, *args, **kwargs):
+    """在数据库线程池中执行同步数据库操作并等待结果
+
+    fn 的第一个参数为会话；返回值应为普通数据（而非ORM对象），
+    因为会话在返回前已被释放。
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()  # 让数据库线程中的语句计入当前命令的运行指标
+    return await loop.run_in_executor(db_executor, context.run, run_in_session, Session, fn, args, kwargs)
+
+async def run_report(fn, *args, **kwargs):
+    """同 run_db，但在报表线程池中以只读会话执行（用于报表与只读查询）"""
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(report_executor, context.run, run_in_session, ReportSession, fn, args, kwargs)
+
+def after_commit(session, callback):
+    """登记在会话真正提交后执行的回调；事务回滚时回调被丢弃"""
+    session.info.setdefault('after_commit', []).append(callback)
+
+@event.listens_for(session_factory, 'after_commit')
+def run_after_commit_callbacks(session):
+    for callback in session.info.pop('after_commit', []):
         try:
-            conn.execute(text("ALTER TABLE transactions ADD COLUMN settled_in FLOAT DEFAULT 0"))
-            conn.execute(text("ALTER TABLE transactions ADD COLUMN settled_out FLOAT DEFAULT 0"))
-            conn.commit()
-            logger.info("数据库迁移成功")
+            callback()
         except Exception as e:
-            logger.warning("数据库迁移可能已经完成: %s", str(e))
+            logger.error(f"提交后回调执行失败: {str(e)}", exc_info=True)
+
+@event.listens_for(session_factory, 'after_rollback')
+def discard_after_commit_callbacks(session):
+    session.info.pop('after_commit', None)
+
+# ================== 分组提交写入队列 ==================
+# 账务写操作（交易、收付款、调整、支出、撤销、删除客户）不再各自提交，而是进入同一个
+# 写入队列：单个写线程把一个时间窗口内到达的写操作放进同一个事务，每个操作在各自的
+# SAVEPOINT 中执行，最后一次提交（一次 fsync）。某个操作失败只回滚它自己的 SAVEPOINT，
+# 不影响同组其他操作；各处理器拿到的是自己那一项的结果或异常。
+GROUP_COMMIT_WINDOW = float(os.environ.get('FX_GROUP_COMMIT_MS', '5')) / 1000
+GROUP_COMMIT_MAX = int(os.environ.get('FX_GROUP_COMMIT_MAX', '64'))
+write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='fx-writer')
+
+def commit_batch(batch) -> list:
+    """在写线程中执行一组写操作并一次提交，返回与 batch 对应的 (成功, 结果或异常) 列表
+
+    batch 为 (fn, args, kwargs, 上下文) 列表，fn 在提交者的 contextvars 上下文中运行。
+    """
+    session = Session()
+    outcomes = []
+    try:
+        for fn, args, kwargs, context in batch:
+            callbacks = session.info.setdefault('after_commit', [])
+            registered = len(callbacks)
+            try:
+                with session.begin_nested():
+                    result = context.run(fn, session, *args, **kwargs)
+                outcomes.append((True, result))
+            except Exception as e:
+                # SAVEPOINT 已回滚，丢弃该操作登记的提交后回调
+                del callbacks[registered:]
+                outcomes.append((False, e))
+        if any(ok for ok, _ in outcomes):
+            bump_ledger_version(session)
+        session.commit()
+        return outcomes
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        Session.remove()
+
+class WriteQueue:
+    """收集并发处理器提交的写操作，按 GROUP_COMMIT_WINDOW / GROUP_COMMIT_MAX 分组提交"""
+
+    def __init__(self, window: float, max_batch: int):
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = None
+        self._task = None
+
+    async def submit(self, fn, *args, **kwargs):
+        """提交写操作 fn(session, ...) 并等待所在分组提交完成，返回 fn 的结果或抛出其异常"""
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((fn, args, kwargs, contextvars.copy_context(), future))
+        return await future
+
+    async def _collect(self) -> list:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.window
+        while len(batch) < self.max_batch:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            try:
+                outcomes = await loop.run_in_executor(
+                    write_executor, commit_batch, [item[:4] for item in batch]
+                )
+            except Exception as e:
+                logger.error(f"分组提交失败（{len(batch)} 项）: {str(e)}", exc_info=True)
+                outcomes = [(False, e)] * len(batch)
+            else:
+                logger.debug(f"分组提交完成: {len(batch)} 项")
+            for (*_, future), (ok, value) in zip(batch, outcomes):
+                if future.done():
+                    continue
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+write_queue = WriteQueue(GROUP_COMMIT_WINDOW, GROUP_COMMIT_MAX)
+
+async def run_write(fn, *args, **kwargs):
+    """经写入队列执行账务写操作 fn(session, ...)（fn 不自行提交）"""
+    return await write_queue.submit(fn, *args, **kwargs)
+
+# ================== 客户锁 ==================
+class CustomerLocks:
+    """按客户名（含 COMPANY）分配的 asyncio 锁，用于在并发处理更新时串行化同一客户的账务操作
+
+    锁对象只被弱引用登记：没有协程持有或等待时即被回收，内存占用只与当前活跃客户数有关。
+    多个客户按名称排序后依次加锁，避免交叉等待造成死锁。
+    """
+
+    def __init__(self):
+        self._locks = weakref.WeakValueDictionary()
+
+    def _lock(self, customer: str) -> asyncio.Lock:
+        lock = self._locks.get(customer)
+        if lock is None:
+            lock = self._locks[customer] = asyncio.Lock()
+        return lock
+
+    @contextlib.asynccontextmanager
+    async def hold(self, *customers):
+        locks = [self._lock(customer) for customer in sorted({c for c in customers if c})]
+        acquired = []
+        try:
+            for lock in locks:
+                await lock.acquire()
+                acquired.append(lock)
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+
+    def __len__(self):
+        return len(self._locks)
+
+customer_locks = CustomerLocks()
+CONCURRENT_UPDATES = int(os.environ.get('FX_CONCURRENT_UPDATES', '64'))  # 0 表示逐条处理
+
+# ================== 命令调度 ==================
+# 处理器按类别排队：ledger（交易录入、收付款、撤销等账务写操作）优先，query（余额等轻量查询）
+# 次之，report（/pnl、/report、/creport、/expenses）并发受限、排队有上限，超出时礼貌拒绝。
+# 较低优先级的类别只有在更高优先级没有排队请求时才会启动新的处理。
+SCHEDULER_PRIORITY = ('ledger', 'query', 'report')
+SCHEDULER_LIMITS = {
+    # 类别: (最大并发, 最大排队数，0 表示不限)
+    'ledger': (int(os.environ.get('FX_LEDGER_CONCURRENCY', '32')), 0),
+    'query': (int(os.environ.get('FX_QUERY_CONCURRENCY', '16')), 0),
+    'report': (int(os.environ.get('FX_REPORT_CONCURRENCY', '2')), int(os.environ.get('FX_REPORT_QUEUE', '8'))),
+}
+WAIT_SAMPLES = 500  # 每个类别保留最近多少次排队耗时用于统计
+
+class SchedulerBusy(Exception):
+    """排队已满，请求被拒绝"""
+
+class CommandScheduler:
+    """按类别限制并发并区分优先级的处理器调度器（仅在事件循环内使用，无需加锁）"""
+
+    def __init__(self, limits: dict, priority: tuple):
+        self.limits = limits
+        self.priority = priority
+        self._running = dict.fromkeys(priority, 0)
+        self._waiting = {cls: deque() for cls in priority}
+        self._stats = {cls: {'completed': 0, 'shed': 0, 'failed': 0, 'waits': deque(maxlen=WAIT_SAMPLES)}
+                       for cls in priority}
+
+    def _can_start(self, cls: str) -> bool:
+        if self._running[cls] >= self.limits[cls][0]:
+            return False
+        higher = self.priority[:self.priority.index(cls)]
+        return not any(self._waiting[c] for c in higher)
+
+    def _dispatch(self):
+        for cls in self.priority:
+            waiting = self._waiting[cls]
+            while waiting and self._can_start(cls):
+                future = waiting.popleft()
+                if not future.done():
+                    self._running[cls] += 1
+                    future.set_result(None)
+
+    def _release(self, cls: str):
+        self._running[cls] -= 1
+        self._dispatch()
+
+    async def run(self, cls: str, fn):
+        """在 cls 类别的名额内执行 await fn()；排队已满时抛出 SchedulerBusy"""
+        stats = self._stats[cls]
+        queued_at = time.perf_counter()
+        if self._can_start(cls) and not self._waiting[cls]:
+            self._running[cls] += 1
+        else:
+            max_waiting = self.limits[cls][1]
+            if max_waiting and len(self._waiting[cls]) >= max_waiting:
+                stats['shed'] += 1
+                raise SchedulerBusy(cls)
+            future = asyncio.get_running_loop().create_future()
+            self._waiting[cls].append(future)
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    self._release(cls)  # 已分到名额但调用方被取消
+                else:
+                    self._waiting[cls].remove(future)
+                raise
+        stats['waits'].append(time.perf_counter() - queued_at)
+
+        try:
+            result = await fn()
+            stats['completed'] += 1
+            return result
+        except Exception:
+            stats['failed'] += 1
+            raise
+        finally:
+            self._release(cls)
+
+    def metrics(self) -> dict:
+        """各类别的运行数、排队深度、完成/拒绝/失败数以及排队耗时（秒）"""
+        result = {}
+        for cls in self.priority:
+            stats = self._stats[cls]
+            waits = sorted(stats['waits'])
+            result[cls] = {
+                'running': self._running[cls],
+                'waiting': len(self._waiting[cls]),
+                'limit': self.limits[cls][0],
+                'queue_limit': self.limits[cls][1],
+                'completed': stats['completed'],
+                'shed': stats['shed'],
+                'failed': stats['failed'],
+                'wait_avg': sum(waits) / len(waits) if waits else 0.0,
+                'wait_p95': waits[int(len(waits) * 0.95) - 1] if waits else 0.0,
+                'wait_max': waits[-1] if waits else 0.0,
+            }
+        return result
+
+scheduler = CommandScheduler(SCHEDULER_LIMITS, SCHEDULER_PRIORITY)
+
+def scheduled(cls: str, handler):
+    """把处理器包装为经调度器执行；报表排队已满时直接回复稍后再试"""
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        try:
+            return await scheduler.run(cls, lambda: handler(update, context))
+        except SchedulerBusy:
+            logger.warning(f"{cls} 请求排队已满，已拒绝")
+            await update.message.reply_text("⏳ 当前报表请求较多，请稍后再试（交易录入不受影响）")
+    return wrapper
+
+
+# ================== 消息发送 ==================
+# 长文本报表逐行生成，在行边界处打包成不超过 Telegram 上限的消息，边生成边发送；
+# 所有出站请求经 OutboundRateLimiter 限流：全局速率 + 每个聊天的令牌桶，遇到 429 暂停后重试。
+MESSAGE_LIMIT = 4096  # Telegram 单条消息上限（按 UTF-16 码元计，emoji 等占两个）
+STREAM_BATCH = 500    # 流式报表每批从数据库读取的行数
+STREAM_PREFETCH = 4    # 长报表每批生成的消息条数，发完一批再回到报表线程生成下一批
+OUTBOUND_RATE = float(os.environ.get('FX_OUTBOUND_RATE', '30'))   # 全局每秒请求数
+CHAT_RATE = float(os.environ.get('FX_CHAT_RATE', '1'))            # 私聊每秒消息数
+CHAT_BURST = int(os.environ.get('FX_CHAT_BURST', '3'))            # 私聊允许的突发条数
+GROUP_RATE = float(os.environ.get('FX_GROUP_RATE', str(20 / 60)))  # 群组每秒消息数（每分钟 20 条）
+GROUP_BURST = int(os.environ.get('FX_GROUP_BURST', '20'))
+OUTBOUND_RETRIES = int(os.environ.get('FX_OUTBOUND_RETRIES', '3'))  # 收到 429 后的重试次数
+CHAT_BUCKETS_MAX = 1024  # 超过该数量时清理已回满（空闲）的聊天令牌桶
+
+class TokenBucket:
+    """令牌桶：平均每秒补充 rate 个令牌，最多积累 capacity 个；等待者按先后顺序取得令牌（仅在事件循环内使用）"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def idle(self) -> bool:
+        self._refill()
+        return not self._lock.locked() and self._tokens >= self.capacity
+
+    async def acquire(self):
+        async with self._lock:
+            self._refill()
+            while self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= 1
+
+class OutboundRateLimiter(BaseRateLimiter):
+    """出站请求限流（python-telegram-bot 的 rate_limiter 扩展点）
+
+    带 chat_id 的请求先取该聊天的令牌（私聊与群组速率不同），再取全局令牌；
+    收到 RetryAfter 时所有请求暂停 retry_after 秒，之后最多重试 max_retries 次。
+    """
+
+    def __init__(self, rate: float = OUTBOUND_RATE, max_retries: int = OUTBOUND_RETRIES):
+        self.max_retries = max_retries
+        self._global = TokenBucket(rate, max(1, int(rate)))
+        self._chats = {}
+        self._paused_until = 0.0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        self._chats.clear()
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= CHAT_BUCKETS_MAX:
+                self._chats = {key: b for key, b in self._chats.items() if not b.idle()}
+            is_group = str(chat_id).startswith('-')
+            bucket = self._chats[chat_id] = TokenBucket(GROUP_RATE, GROUP_BURST) if is_group \
+                else TokenBucket(CHAT_RATE, CHAT_BURST)
+        return bucket
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        attempt = 0
+        while True:
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            if chat_id is not None:
+                await self._chat_bucket(chat_id).acquire()
+            await self._global.acquire()
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                delay = e.retry_after
+                delay = delay.total_seconds() if isinstance(delay, timedelta) else float(delay)
+                logger.warning(f"{endpoint} 触发限流，{delay:.0f} 秒后第 {attempt} 次重试")
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+
+def utf16_len(text: str) -> int:
+    return len(text.encode('utf-16-le')) // 2
+
+def split_long_line(line: str, limit: int):
+    """按完整字符切分超过 limit 的单行"""
+    piece, size = [], 0
+    for char in line:
+        width = utf16_len(char)
+        if size + width > limit:
+            yield ''.join(piece)
+            piece, size = [], 0
+        piece.append(char)
+        size += width
+    if piece:
+        yield ''.join(piece)
+
+def pack_lines(lines, limit: int = MESSAGE_LIMIT):
+    """把逐条生成的报表文本打包为不超过 limit 的消息
+
+    每条（可含换行的）记录尽量完整地放在同一条消息里；记录本身超长时按行断开，
+    只有单行超长时才按字符切分。
+    """
+    buffer, size = [], 0
+    for entry in lines:
+        units = [entry] if utf16_len(entry) <= limit else entry.split('\n')
+        for unit in units:
+            length = utf16_len(unit)
+            if length > limit:
+                if buffer:
+                    yield '\n'.join(buffer)
+                *pieces, unit = split_long_line(unit, limit)
+                yield from pieces
+                buffer, size = [], 0
+                length = utf16_len(unit)
+            elif buffer and size + 1 + length > limit:
+                yield '\n'.join(buffer)
+                buffer, size = [], 0
+            size += length + (1 if buffer else 0)
+            buffer.append(unit)
+    if buffer:
+        yield '\n'.join(buffer)
+
+class ReportStream:
+    """在报表线程池中分批推进行生成器 fn(session, ...)，每批打包出若干条消息后即归还线程
+
+    每批生成后即结束只读会话的读事务并归还连接：等待限流发送期间既不占用报表线程，
+    也不持有 WAL 快照（长时间持有会让检查点无法完成、WAL 文件持续增长）。
+    因此行生成器须按块完整读取（见 keyset_chunks），不能在 yield 之间保留打开的游标；
+    各批读取的是各自的快照。
+    """
+
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+        self.session = None
+        self.messages = None
+
+    def _next_batch(self, size: int) -> list:
+        if self.messages is None:
+            # 提交只结束读事务；不让已取出的行在批次之间过期后被逐条重新加载
+            self.session = ReportSession.session_factory(expire_on_commit=False)
+            self.messages = (m for m in pack_lines(self.fn(self.session, *self.args)) if m.strip())
+        batch = list(itertools.islice(self.messages, size))
+        self.session.commit()
+        return batch
+
+    def _close(self):
+        try:
+            if self.messages is not None:
+                self.messages.close()
+        finally:
+            if self.session is not None:
+                self.session.close()
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(report_executor, context.run, fn, *args)
+
+    async def next_batch(self) -> list:
+        """下一批消息；报表结束时返回空列表"""
+        return await self._run(self._next_batch, STREAM_PREFETCH)
+
+    async def close(self):
+        await self._run(self._close)
+
+def with_header(header, message: str) -> list:
+    """把 header 加在消息前；合并后超过 MESSAGE_LIMIT 时 header 单独成条"""
+    if header is None:
+        return [message]
+    combined = f"{header}\n{message}"
+    return [combined] if utf16_len(combined) <= MESSAGE_LIMIT else [header, message]
+
+async def reply_stream(update: Update, fn, *args, header=None, on_message=None) -> int:
+    """以只读会话逐行生成报表，边打包边回复；返回发送的消息条数
+
+    每次只生成 STREAM_PREFETCH 条消息，发完再生成下一批：内存占用与报表长度无关，
+    发送受限流而变慢时也不会占住报表线程，其他报表与查询不必排在长报表后面。
+    header 加在第一条消息前；on_message(消息) 在每条消息发送后调用（不含 header）。
+    """
+    stream = ReportStream(fn, args)
+    sent = 0
+    try:
+        while batch := await stream.next_batch():
+            for message in batch:
+                for text in with_header(header, message):
+                    await update.message.reply_text(text)
+                    sent += 1
+                header = None
+                if on_message:
+                    on_message(message)
+    finally:
+        await stream.close()
+    if header is not None:
+        await update.message.reply_text(header)
+        sent += 1
+    return sent
+
+# ================== 报表缓存 ==================
+# /pnl、/report、/creport 的生成结果（文本、分条消息或 xlsx 字节）按 (命令, 参数, 账本版本) 缓存。
+# 版本号在生成之前读取，结果只可能比键更新而不会更旧；任何账务写入都会使版本号前进，旧条目随即失效。
+REPORT_CACHE_ENTRIES = int(os.environ.get('FX_REPORT_CACHE_ENTRIES', '32'))   # 0 表示不缓存
+REPORT_CACHE_SIZE = int(os.environ.get('FX_REPORT_CACHE_MB', '32')) * 1024 * 1024  # 总大小上限（字符/字节）
+REPORT_CACHE_ITEM_SIZE = REPORT_CACHE_SIZE // 8  # 单个结果超过该大小时不缓存
+MISSING = object()
+
+def result_size(value) -> int:
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, list):
+        return sum(len(item) for item in value)
+    return 0
+
+class ReportCache:
+    """有大小上限的 LRU 报表缓存（仅在事件循环内使用，无需加锁）
+
+    只保留当前账本版本的条目：以更新的版本写入时，旧版本的条目全部丢弃。
+    """
+
+    def __init__(self, max_entries: int, max_size: int):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self._entries = OrderedDict()  # 键 -> (结果, 大小)
+        self._version = None
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, version: int, key):
+        if version != self._version or key not in self._entries:
+            self.misses += 1
+            return MISSING
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return self._entries[key][0]
+
+    def put(self, version: int, key, value):
+        size = result_size(value)
+        if not self.max_entries or size > REPORT_CACHE_ITEM_SIZE:
+            return
+        if self._version is None or version > self._version:
+            self._entries.clear()
+            self._size = 0
+            self._version = version
+        elif version < self._version:
+            return
+        if key in self._entries:
+            self._size -= self._entries.pop(key)[1]
+        self._entries[key] = (value, size)
+        self._size += size
+        while len(self._entries) > self.max_entries or self._size > self.max_size:
+            self._size -= self._entries.popitem(last=False)[1][1]
+
+    def __len__(self):
+        return len(self._entries)
+
+report_cache = ReportCache(REPORT_CACHE_ENTRIES, REPORT_CACHE_SIZE)
+
+async def cached_report(key, build):
+    """返回 key 对应的报表结果；未命中当前账本版本时 await build() 生成并缓存"""
+    version = await run_report(ledger_version)
+    result = report_cache.get(version, key)
+    if result is MISSING:
+        result = await build()
+        report_cache.put(version, key, result)
+    return result
+
+async def render_report(fn, *args):
+    """在报表线程生成工作表记录并渲染为 xlsx 字节；fn 返回 None（无数据）时返回 None"""
+    sheets = await run_report(fn, *args)
+    return None if sheets is None else (await render_excel(sheets)).getvalue()
+
+async def reply_cached_stream(update: Update, key, fn, *args, header=None) -> int:
+    """同 reply_stream，但缓存打包后的消息；命中时直接重发缓存的消息
+
+    header（如生成时间）不进入缓存，每次发送时重新加在第一条消息前。
+    """
+    version = await run_report(ledger_version)
+    messages = report_cache.get(version, key)
+    if messages is not MISSING:
+        sent = 0
+        for message in messages:
+            for text in with_header(header, message):
+                await update.message.reply_text(text)
+                sent += 1
+            header = None
+        if header is not None:
+            await update.message.reply_text(header)
+            sent += 1
+        return sent
+
+    captured, size = [], 0
+    def capture(message):
+        nonlocal size
+        size += len(message)
+        if size <= REPORT_CACHE_ITEM_SIZE:
+            captured.append(message)
+
+    sent = await reply_stream(update, fn, *args, header=header, on_message=capture)
+    if size <= REPORT_CACHE_ITEM_SIZE:
+        report_cache.put(version, key, captured)
+    return sent
+
+# ================== 运行指标 ==================
+# 每个注册的处理器经 instrumented() 包装：记录整体耗时、SQL 语句数与执行耗时、向 Telegram 发送的字节数。
+# 当前命令的计数对象放在 contextvars 中，run_db / run_report / 写入队列把上下文带进数据库线程，
+# 引擎事件与 CountingRequest 据此把语句和流量记到发起它们的命令上。
+# 可选地以 Prometheus 文本格式定期写入 FX_METRICS_FILE，或在 FX_METRICS_PORT 上提供 HTTP 抓取。
+METRICS_FILE = os.environ.get('FX_METRICS_FILE')
+METRICS_LISTEN = os.environ.get('FX_METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('FX_METRICS_PORT', '0'))  # 0 表示不开启
+METRICS_INTERVAL = float(os.environ.get('FX_METRICS_INTERVAL', '15'))  # 写文件间隔（秒）
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+STATEMENT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+class Histogram:
+    """累积分桶直方图（Prometheus 语义），分位数按桶内线性插值估算"""
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最后一格为 +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def percentile(self, p: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = p * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                low = self.buckets[i - 1] if i else 0.0
+                high = self.buckets[i] if i < len(self.buckets) else self.max
+                return min(low + (high - low) * (rank - seen) / n, self.max)
+            seen += n
+        return self.max
+
+class RequestStats:
+    """单次命令处理中累计的数据库与发送开销（可能在数据库线程中累加）"""
+    __slots__ = ('command', 'statements', 'db_seconds', 'bytes_sent', 'shapes', '_lock')
+
+    def __init__(self, command: str):
+        self.command = command
+        self.statements = 0
+        self.db_seconds = 0.0
+        self.bytes_sent = 0
+        self.shapes = {}  # 归一化语句 -> 执行次数，用于 N+1 检测
+        self._lock = threading.Lock()
+
+    def add_statement(self, seconds: float, statement: str):
+        shape = statement_shape(statement) if REPEATED_QUERY_LIMIT else None
+        with self._lock:
+            self.statements += 1
+            self.db_seconds += seconds
+            if shape is not None:
+                self.shapes[shape] = self.shapes.get(shape, 0) + 1
+
+    def add_bytes(self, size: int):
+        with self._lock:
+            self.bytes_sent += size
+
+current_request = contextvars.ContextVar('current_request', default=None)
+
+class HandlerMetrics:
+    """各命令的耗时、数据库耗时、SQL 语句数直方图与发送字节数（仅在事件循环内更新）"""
+
+    def __init__(self):
+        self.commands = {}
+        self.worker = None  # 多进程部署时为工作进程序号
+
+    def _command(self, command: str) -> dict:
+        metrics = self.commands.get(command)
+        if metrics is None:
+            metrics = self.commands[command] = {
+                'seconds': Histogram(SECONDS_BUCKETS),
+                'db_seconds': Histogram(SECONDS_BUCKETS),
+                'statements': Histogram(STATEMENT_BUCKETS),
+                'bytes_sent': 0,
+                'errors': 0,
+                'repeated': 0,
+            }
+        return metrics
+
+    def observe(self, command: str, seconds: float, stats: RequestStats, failed: bool):
+        metrics = self._command(command)
+        metrics['seconds'].observe(seconds)
+        metrics['db_seconds'].observe(stats.db_seconds)
+        metrics['statements'].observe(stats.statements)
+        metrics['bytes_sent'] += stats.bytes_sent
+        metrics['errors'] += failed
+        metrics['repeated'] += bool(repeated_statements(stats))
+
+    def prometheus(self) -> str:
+        """Prometheus 文本格式（0.0.4）"""
+        worker = f',worker="{self.worker}"' if self.worker is not None else ''
+        lines = []
+        for name, field, help_text in (
+            ('fx_handler_seconds', 'seconds', '处理器整体耗时（含排队）'),
+            ('fx_handler_db_seconds', 'db_seconds', '处理器内 SQL 执行耗时'),
+            ('fx_handler_sql_statements', 'statements', '处理器执行的 SQL 语句数'),
+        ):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+            for command, metrics in sorted(self.commands.items()):
+                histogram = metrics[field]
+                labels = f'command="{command}"{worker}'
+                cumulative = 0
+                for bound, n in zip((*histogram.buckets, '+Inf'), histogram.counts):
+                    cumulative += n
+                    lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f"{name}_sum{{{labels}}} {histogram.sum}")
+                lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+        for name, field, help_text in (
+            ('fx_handler_sent_bytes_total', 'bytes_sent', '处理器向 Telegram 发送的字节数'),
+            ('fx_handler_errors_total', 'errors', '处理器抛出的未处理异常数'),
+            ('fx_handler_repeated_queries_total', 'repeated', '出现同一语句重复执行（N+1 嫌疑）的处理次数'),
+        ):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+            for command, metrics in sorted(self.commands.items()):
+                lines.append(f'{name}{{command="{command}"{worker}}} {metrics[field]}')
+        return "\n".join(lines) + "\n"
+
+handler_metrics = HandlerMetrics()
+
+def instrumented(command: str, handler):
+    """包装处理器，记录本次处理的耗时、SQL 与发送字节数"""
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        stats = RequestStats(command)
+        token = current_request.set(stats)
+        started = time.perf_counter()
+        failed = False
+        try:
+            return await handler(update, context)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            current_request.reset(token)
+            handler_metrics.observe(command, time.perf_counter() - started, stats, failed)
+            report_repeated_statements(stats)
+    return wrapper
+
+def record_statement_start(conn, cursor, statement, parameters, context, executemany):
+    # 开始时间记在本条语句的执行上下文上：语句抛出异常时结束钩子不会运行，
+    # 记在连接上会残留在连接池里，并错配之后语句的计时
+    if context is not None:
+        context.statement_started = time.perf_counter()
+
+def record_statement_end(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, 'statement_started', None)
+    if started is None:
+        return
+    seconds = time.perf_counter() - started
+    stats = current_request.get()
+    if stats is not None:
+        stats.add_statement(seconds, statement)
+    if SLOW_QUERY_MS and seconds * 1000 >= SLOW_QUERY_MS:
+        report_slow_statement(cursor, statement, parameters, executemany, seconds, stats)
+
+for instrumented_engine in (engine, report_engine):
+    event.listen(instrumented_engine, 'before_cursor_execute', record_statement_start)
+    event.listen(instrumented_engine, 'after_cursor_execute', record_statement_end)
+
+class CountingRequest(HTTPXRequest):
+    """统计每条出站请求的字节数并计入当前命令"""
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        stats = current_request.get()
+        if stats is not None and request_data is not None:
+            size = len(request_data.json_payload)
+            if request_data.contains_files:
+                size += sum(len(part[1]) for part in request_data.multipart_data.values()
+                            if isinstance(part[1], bytes))
+            stats.add_bytes(size)
+        return await super().do_request(url, method, request_data, *args, **kwargs)
+
+def metrics_target(base, index):
+    """多进程部署时各工作进程写入各自的文件、监听各自的端口"""
+    if index is None:
+        return base
+    return f"{base}.{index}" if isinstance(base, str) else base + index
+
+async def export_metrics(application):
+    """按配置开启 Prometheus 指标导出（文件与/或 HTTP 端口）"""
+    if METRICS_PORT:
+        async def serve(reader, writer):
+            try:
+                while (await reader.readline()).strip():
+                    pass  # 忽略请求行与请求头，任何路径都返回指标
+                body = handler_metrics.prometheus().encode('utf-8')
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                    + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+                )
+                await writer.drain()
+            finally:
+                writer.close()
+
+        port = metrics_target(METRICS_PORT, handler_metrics.worker)
+        application.bot_data['metrics_server'] = await asyncio.start_server(serve, METRICS_LISTEN, port)
+        logger.info(f"指标导出已开启: http://{METRICS_LISTEN}:{port}/metrics")
+
+    if METRICS_FILE:
+        path = metrics_target(METRICS_FILE, handler_metrics.worker)
+
+        async def write_periodically():
+            while True:
+                await asyncio.sleep(METRICS_INTERVAL)
+                write_metrics_file(path)
+
+        # 不用 application.create_task：Application.stop() 会等待这类任务结束
+        application.bot_data['metrics_writer'] = (asyncio.create_task(write_periodically()), path)
+        logger.info(f"指标每 {METRICS_INTERVAL:g} 秒写入 {path}")
+
+def write_metrics_file(path: str):
+    try:
+        with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+            f.write(handler_metrics.prometheus())
+        os.replace(f"{path}.tmp", path)
+    except OSError as e:
+        logger.error(f"指标文件写入失败: {str(e)}")
+
+async def stop_metrics(application):
+    """关闭指标导出；指标文件在退出前再写一次最终结果"""
+    writer = application.bot_data.pop('metrics_writer', None)
+    if writer:
+        task, path = writer
+        task.cancel()
+        write_metrics_file(path)
+    server = application.bot_data.pop('metrics_server', None)
+    if server:
+        server.close()
+        await server.wait_closed()
+
+# ================== 慢查询与 N+1 检测 ==================
+# 复用运行指标的游标事件：每条语句都带着发起它的命令（current_request）。
+# 超过 FX_SLOW_QUERY_MS 的语句连同 EXPLAIN QUERY PLAN 记入警告日志；
+# 一次命令处理中同一形状（参数、IN 列表长度归一化后）的语句超过 FX_REPEATED_QUERY_LIMIT 次时
+# 视为 N+1 嫌疑并记录。两者设为 0 即关闭；归一化结果有缓存，常开的开销只是一次字典查找。
+SLOW_QUERY_MS = float(os.environ.get('FX_SLOW_QUERY_MS', '200'))
+REPEATED_QUERY_LIMIT = int(os.environ.get('FX_REPEATED_QUERY_LIMIT', '20'))
+SLOW_QUERY_EXPLAINED_MAX = 256  # 每种慢语句只附一次执行计划，记住最近这么多种
+SQL_LOG_LIMIT = 500  # 日志中语句与参数的最大长度
+
+@functools.lru_cache(maxsize=1024)
+def statement_shape(statement: str) -> str:
+    """去掉字面量并把 IN (?, ?, ...) 折叠为 IN (?)，使只差参数的语句归为一类"""
+    shape = re.sub(r"'(?:[^']|'')*'", '?', statement)
+    shape = re.sub(r'\b\d+(?:\.\d+)?\b', '?', shape)
+    shape = re.sub(r'\(\s*\?(?:\s*,\s*\?)*\s*\)', '(?)', shape)
+    return ' '.join(shape.split())
+
+def clip(text, limit: int = SQL_LOG_LIMIT) -> str:
+    text = str(text)
+    return text if len(text) <= limit else text[:limit] + '…'
+
+def brief_statement(statement: str) -> str:
+    """日志用：省略 SELECT 的列清单（不含函数或子查询时），保留 FROM 之后的条件部分"""
+    return clip(re.sub(r'^SELECT [^()]*?\bFROM\b', 'SELECT … FROM', ' '.join(statement.split())))
+
+def explain_statement(cursor, statement: str, parameters) -> str:
+    """在同一连接上取语句的执行计划；EXPLAIN 不执行语句，也不受只读连接限制"""
+    try:
+        rows = cursor.connection.execute("EXPLAIN QUERY PLAN " + statement, parameters or ()).fetchall()
+    except sqlite3.Error as e:
+        return f"（无法获取: {str(e)}）"
+    return '; '.join(row[3] for row in rows)
+
+EXPLAINABLE = re.compile(r'\s*(SELECT|INSERT|UPDATE|DELETE|REPLACE|WITH)\b', re.IGNORECASE)
+explained_statements = OrderedDict()
+explained_lock = threading.Lock()
+
+def report_slow_statement(cursor, statement, parameters, executemany, seconds, stats):
+    command = f"/{stats.command}" if stats is not None else "后台"
+    shape = statement_shape(statement)
+    with explained_lock:
+        first = shape not in explained_statements
+        explained_statements[shape] = True
+        explained_statements.move_to_end(shape)
+        while len(explained_statements) > SLOW_QUERY_EXPLAINED_MAX:
+            explained_statements.popitem(last=False)
+    plan = ""
+    if first and not executemany and EXPLAINABLE.match(statement):
+        plan = f"\n执行计划: {explain_statement(cursor, statement, parameters)}"
+    logger.warning(
+        f"慢查询 [{command}] {seconds * 1000:.1f}ms: {brief_statement(statement)}"
+        f"\n参数: {clip(parameters)}{plan}"
+    )
+
+def repeated_statements(stats: RequestStats) -> list:
+    """本次处理中执行次数超过上限的语句形状 [(形状, 次数)]"""
+    if not REPEATED_QUERY_LIMIT:
+        return []
+    return [(shape, n) for shape, n in stats.shapes.items() if n > REPEATED_QUERY_LIMIT]
+
+def report_repeated_statements(stats: RequestStats):
+    for shape, count in repeated_statements(stats):
+        logger.warning(
+            f"N+1 嫌疑 [/{stats.command}] 同一语句执行 {count} 次（本次共 {stats.statements} 条SQL）: {brief_statement(shape)}"
+        )
+
+# ================== 数据库迁移脚本 ==================
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def alembic_config():
+    """机器人进程内使用的 Alembic 配置：复用机器人的引擎、日志与模型元数据"""
+    from alembic.config import Config as AlembicConfig
+
+    config = AlembicConfig(os.path.join(BASE_DIR, 'alembic.ini'))
+    config.set_main_option('script_location', os.path.join(BASE_DIR, 'alembic'))
+    config.attributes['configure_logger'] = False
+    config.attributes['target_metadata'] = Base.metadata
+    return config
+
+def run_migrations():
+    """通过 Alembic 将数据库升级到最新版本（基础表由 alembic/env.py 按模型元数据建立）"""
+    from alembic import command as alembic_command
+
+    config = alembic_config()
+    with engine.begin() as conn:
+        config.attributes['connection'] = conn
+        alembic_command.upgrade(config, 'head')
+    logger.info("数据库迁移成功")
+
+def migration_heads() -> set:
+    """迁移脚本的最新版本号（只读取脚本目录，不连接数据库）"""
+    from alembic.script import ScriptDirectory
+
+    return set(ScriptDirectory.from_config(alembic_config()).get_heads())
+
+def schema_revisions() -> set:
+    """数据库 alembic_version 表记录的版本号；尚未迁移过的数据库返回空集"""
+    try:
+        with engine.connect() as conn:
+            return {row[0] for row in conn.exec_driver_sql("SELECT version_num FROM alembic_version")}
+    except OperationalError:
+        return set()
+
+def ensure_schema():
+    """启动时检查一次数据库结构版本，只有落后于迁移脚本时才执行迁移"""
+    heads = migration_heads()
+    current = schema_revisions()
+    if heads and current == heads:
+        logger.info(f"数据库结构已是最新版本: {', '.join(sorted(current))}")
+        return
+    logger.info(f"数据库结构版本 {', '.join(sorted(current)) or '（无）'}，需要升级到 {', '.join(sorted(heads))}")
+    run_migrations()
+
+# ================== 查询计划检查 ==================
+# 按设计需要读取整表（或整个索引）的查询；其余查询出现全表扫描即视为检查失败
+FULL_SCAN_ALLOWED = {
+    "/debts 全部客户": "列出所有客户余额；余额表每个客户每种货币仅一行",
+    "/report 信用余额": "汇总所有客户的正余额；余额表每个客户每种货币仅一行",
+    "/expenses 首页": "按时间索引倒序读取，LIMIT 取满一页即停止",
+}
+def handler_query_samples(session) -> list:
+    """各处理器实际使用的查询（以示例参数构造），供查询计划检查使用"""
+    now = datetime.now()
+    start, end = now - timedelta(days=30), now
+    return [
+        ("/received 未结订单", open_orders_query(session, 'sample', 'USDT', 'in')),
+        ("/paid 未结订单", open_orders_query(session, 'sample', 'MYR', 'out')),
+        ("/received /paid 载入索引订单", session.query(Transaction).filter(
+            Transaction.order_id.in_(['YS000000001', 'YS000000002']))),
+        ("/balance 客户余额", customer_balances_query(session, 'sample')),
+        ("/debts 指定客户", customer_balances_query(session, 'sample')),
+        ("/debts 全部客户", debts_query(session)),
+        ("/report 信用余额", credit_balances_query(session)),
+        ("/cancel 订单", session.query(Transaction).filter_by(order_id='YS000000001')),
+        ("/pnl /report 区间交易", transactions_in_range_query(session, start, end)),
+        ("/pnl 区间支出", expenses_in_range_query(session, start, end)),
+        ("/pnl 货币汇总", pnl_totals_query(start, end)),
+        ("/pnl 日汇总", rollups_in_range_query(start, end)),
+        ("/expenses 首页", expenses_page_query(session).limit(EXPENSES_PAGE + 1)),
+        ("/expenses 翻页", expenses_page_query(session, after=(now, 1)).limit(EXPENSES_PAGE + 1)),
+        ("/expenses 货币筛选", expenses_page_query(session, start, end, 'USD', (now, 1)).limit(EXPENSES_PAGE + 1)),
+        ("/expenses 月度汇总", expense_summary_query(start, end)),
+        ("/creport 客户交易", customer_transactions_query(session, 'sample', start, end)),
+        ("/creport 调整记录", customer_adjustments_query(session, 'sample', start, end)),
+        ("/delete_customer 交易", session.query(Transaction).filter_by(customer_name='sample')),
+        ("/delete_customer 调整", session.query(Adjustment).filter_by(customer_name='sample')),
+    ]
+
+def check_query_plans() -> bool:
+    """对处理器查询执行 EXPLAIN QUERY PLAN，出现全表扫描时返回 False
+
+    全表扫描包括未使用索引的 SCAN 和无检索条件、顺序读完整个索引的 SCAN ... USING INDEX；
+    FULL_SCAN_ALLOWED 中的查询除外。
+    """
+    session = Session()
+    ok = True
+    try:
+        for label, query in handler_query_samples(session):
+            statement = getattr(query, 'statement', query)
+            sql = str(statement.compile(dialect=engine.dialect, compile_kwargs={'literal_binds': True}))
+            plan = [row[3] for row in session.connection().exec_driver_sql("EXPLAIN QUERY PLAN " + sql)]
+            scans = [step for step in plan if re.match(r'SCAN \w+( USING (COVERING )?INDEX \w+)?$', step)]
+            if scans and label in FULL_SCAN_ALLOWED:
+                logger.info(f"查询计划检查通过 [{label}]（允许全表扫描：{FULL_SCAN_ALLOWED[label]}）: {'; '.join(plan)}")
+            elif scans:
+                ok = False
+                logger.error(f"查询计划检查失败 [{label}]: {'; '.join(plan)}")
+            else:
+                logger.info(f"查询计划检查通过 [{label}]: {'; '.join(plan)}")
+    finally:
+        Session.remove()
+    return ok
 
 # ================== 核心工具函数 ==================
+# 管理员 Telegram 用户ID（逗号分隔）；未配置时不限制
+ADMIN_IDS = {int(uid) for uid in os.environ.get('FX_ADMIN_IDS', '').split(',') if uid.strip()}
+
+def is_admin(update: Update) -> bool:
+    """判断发送者是否有权执行管理命令"""
+    return not ADMIN_IDS or (update.effective_user is not None and update.effective_user.id in ADMIN_IDS)
+
 def setup_logging():
     """配置日志系统"""
     log_dir = "logs"
@@ -120,41 +1256,121 @@ def setup_logging():
     )
     logger.info("日志系统初始化完成")
 
-def generate_order_id(session):
+class SequenceAllocator:
+    """基于 sequences 计数表的区段编号分配器
+
+    每次从数据库原子地预留 block_size 个编号（独立事务、立即提交），之后在进程内
+    加锁逐个发放，因此热路径上没有查询，并发请求和多个进程之间也不会拿到重复编号。
+    重启后未用完的区段会被跳过（编号出现空洞）但绝不会重复使用；
+    需要连续编号时把区段大小设为 1。
+    """
+
+    def __init__(self, name: str, block_size: int, seed=None):
+        self.name = name
+        self.block_size = max(1, block_size)
+        self.seed = seed            # seed(conn) -> 计数表首次建行时的起始值
+        self._lock = threading.Lock()
+        self._next = 0
+        self._limit = 0
+
+    def _reserve(self):
+        """预留下一个编号区段"""
+        with engine.begin() as conn:
+            exists = conn.execute(
+                select(Sequence.value).where(Sequence.name == self.name)
+            ).first()
+            if exists is None:
+                start = self.seed(conn) if self.seed else 0
+                conn.execute(
+                    sqlite_insert(Sequence)
+                    .values(name=self.name, value=start)
+                    .on_conflict_do_nothing()
+                )
+            high = conn.execute(
+                update(Sequence)
+                .where(Sequence.name == self.name)
+                .values(value=Sequence.value + self.block_size)
+                .returning(Sequence.value)
+            ).scalar_one()
+        self._next = high - self.block_size + 1
+        self._limit = high + 1
+
+    def next_value(self) -> int:
+        with self._lock:
+            if self._next >= self._limit:
+                self._reserve()
+            value = self._next
+            self._next += 1
+            return value
+
+def seed_order_sequence(conn) -> int:
+    """从现有订单号中取最大序号，作为计数表的起始值（仅首次建行时执行一次）"""
+    last_order_id = conn.execute(select(func.max(Transaction.order_id))).scalar()
+    return int(last_order_id[2:]) if last_order_id else 0
+
+order_sequence = SequenceAllocator(
+    'order_id',
+    int(os.environ.get('FX_ORDER_ID_BLOCK', '20')),
+    seed=seed_order_sequence
+)
+
+# 账本版本号：与订单号共用 sequences 计数表，每个提交了账务写入的分组提交加一。
+# 报表缓存以它作为键的一部分，多进程部署时各进程读到的是同一个版本号。
+LEDGER_VERSION = 'ledger_version'
+
+def bump_ledger_version(session):
+    session.execute(
+        sqlite_insert(Sequence)
+        .values(name=LEDGER_VERSION, value=1)
+        .on_conflict_do_update(index_elements=['name'], set_={'value': Sequence.value + 1})
+    )
+
+def ledger_version(session) -> int:
+    return session.execute(
+        select(Sequence.value).where(Sequence.name == LEDGER_VERSION)
+    ).scalar() or 0
+
+def generate_order_id():
     """生成递增订单号"""
-    last_order = session.query(Transaction).order_by(Transaction.order_id.desc()).first()
-    if last_order:
-        last_num = int(last_order.order_id[2:])
-        return f"YS{last_num + 1:09d}"
-    return "YS000000001"
-
-def update_balance(session, customer: str, currency: str, amount: float):
-    """安全的余额更新（支持4位货币代码）"""
+    return f"YS{order_sequence.next_value():09d}"
+
+def apply_balance_legs(session, legs) -> dict:
+    """批量更新余额（支持4位货币代码）
+
+    legs 为 (客户, 货币, 变动额) 列表。同一键的多条腿先在内存合并，然后用一条
+    INSERT … ON CONFLICT DO NOTHING 补建客户、一条 INSERT … ON CONFLICT DO UPDATE
+    完成全部余额变动，均在调用方事务内执行。返回 {(客户, 货币): 新余额}。
+    """
     try:
+        merged = {}
+        for customer, currency, amount in legs:
+            key = (customer, currency.upper())  # 移除截断，保留完整货币代码
+            merged[key] = round(merged.get(key, 0.0) + round(amount, 2), 2)
+        if not merged:
+            return {}
+
         # 确保客户记录存在
-        customer_obj = session.query(Customer).filter_by(name=customer).first()
-        if not customer_obj:
-            customer_obj = Customer(name=customer)
-            session.add(customer_obj)
-            session.flush()  # 立即写入数据库但不提交事务
-
-        currency = currency.upper()  # 移除截断，保留完整货币代码
-        balance = session.query(Balance).filter_by(
-            customer_name=customer,
-            currency=currency
-        ).with_for_update().first()
-
-        new_amount = round(amount, 2)
-        if balance:
-            balance.amount = round(balance.amount + new_amount, 2)
-        else:
-            balance = Balance(
-                customer_name=customer,
-                currency=currency,
-                amount=new_amount
-            )
-            session.add(balance)
-        logger.info(f"余额更新: {customer} {currency} {new_amount:+}")
+        session.execute(
+            sqlite_insert(Customer)
+            .values([{'name': name} for name in {customer for customer, _ in merged}])
+            .on_conflict_do_nothing()
+        )
+
+        stmt = sqlite_insert(Balance).values([
+            {'customer_name': customer, 'currency': currency, 'amount': amount}
+            for (customer, currency), amount in merged.items()
+        ])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Balance.customer_name, Balance.currency],
+            set_={'amount': func.round(Balance.amount + stmt.excluded.amount, 2)}
+        ).returning(Balance.customer_name, Balance.currency, Balance.amount)
+        new_balances = {(row.customer_name, row.currency): row.amount for row in session.execute(stmt)}
+
+        for (customer, currency), amount in merged.items():
+            logger.info(f"余额更新: {customer} {currency} {amount:+}")
+        # 写穿缓存：提交成功后按增量更新（增量可交换，不受并发提交顺序影响）
+        after_commit(session, lambda: balance_cache.apply_deltas(merged))
+        return new_balances
     except Exception as e:
         logger.error(f"余额更新失败: {str(e)}")
         raise
@@ -171,54 +1387,708 @@ def parse_date_range(date_str: str):
     except Exception as e:
         raise ValueError("日期格式错误，请使用 DD/MM/YYYY-DD/MM/YYYY 格式")
 
+# ================== 余额缓存 ==================
+class BalanceCache:
+    """进程级余额缓存，键为 (客户, 货币)
+
+    启动时从 balances 表整体加载一次；之后只由 apply_balance_legs 在事务提交后
+    写入增量，因此 /balance 与 /debts 可以直接在内存中作答。
+    verify() 与数据库逐项比对，rebuild() 重新加载。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_customer = {}  # 客户 -> {货币: 余额}
+        self.warmed = False
+        self.owns = None  # 多进程部署时由工作进程设置：owns(客户) 判断该客户是否路由到本进程
+
+    def serves(self, customer: str = None) -> bool:
+        """缓存能否直接回答该客户（None 表示全部客户）的查询
+
+        多进程部署时每个工作进程只看得到分给自己的客户的增量，
+        公司账户与跨客户查询仍须读数据库。
+        """
+        if not self.warmed:
+            return False
+        return self.owns is None or (customer not in (None, 'COMPANY') and self.owns(customer))
+
+    def load(self, rows):
+        by_customer = defaultdict(dict)
+        for customer, currency, amount in rows:
+            by_customer[customer][currency] = amount
+        with self._lock:
+            self._by_customer = dict(by_customer)
+            self.warmed = True
+
+    def rebuild(self):
+        """从数据库重新加载全部余额"""
+        with engine.connect() as conn:
+            rows = conn.execute(select(Balance.customer_name, Balance.currency, Balance.amount)).all()
+        self.load(rows)
+        logger.info(f"余额缓存已加载: {len(rows)} 条")
+
+    def apply_deltas(self, deltas: dict):
+        if not self.warmed:
+            return
+        with self._lock:
+            for (customer, currency), amount in deltas.items():
+                currencies = self._by_customer.setdefault(customer, {})
+                currencies[currency] = round(currencies.get(currency, 0.0) + amount, 2)
+
+    def drop_customer(self, customer: str):
+        with self._lock:
+            self._by_customer.pop(customer, None)
+
+    def customer_balances(self, customer: str) -> list:
+        """返回 (货币, 金额) 列表"""
+        with self._lock:
+            return list(self._by_customer.get(customer, {}).items())
+
+    def debts(self, customer: str = None) -> list:
+        """返回非公司账户的 (客户, 货币, 金额) 列表"""
+        with self._lock:
+            if customer:
+                items = [(customer, self._by_customer.get(customer, {}))] if customer != 'COMPANY' else []
+            else:
+                items = [(c, v) for c, v in self._by_customer.items() if c != 'COMPANY']
+            return [(cust, curr, amt) for cust, currencies in items for curr, amt in currencies.items()]
+
+    def verify(self, session) -> list:
+        """与数据库比对，返回 (客户, 货币, 缓存值, 数据库值) 差异列表"""
+        actual = {
+            (row.customer_name, row.currency): row.amount
+            for row in session.query(Balance.customer_name, Balance.currency, Balance.amount)
+        }
+        with self._lock:
+            cached = {
+                (customer, currency): amount
+                for customer, currencies in self._by_customer.items()
+                for currency, amount in currencies.items()
+            }
+        if self.owns is not None:
+            # 其他进程负责的客户不在本进程维护范围内，不参与比对
+            actual = {key: amount for key, amount in actual.items() if self.serves(key[0])}
+            cached = {key: amount for key, amount in cached.items() if self.serves(key[0])}
+        mismatches = []
+        for key in cached.keys() | actual.keys():
+            cached_amount, actual_amount = cached.get(key), actual.get(key)
+            if cached_amount is None or actual_amount is None or abs(cached_amount - actual_amount) > 0.005:
+                mismatches.append((*key, cached_amount, actual_amount))
+        return sorted(mismatches, key=lambda m: (str(m[0]), str(m[1])))
+
+balance_cache = BalanceCache()
+
+# ================== 未结订单索引 ==================
+OPEN_STATUSES = ('pending', 'partial')
+SETTLEMENT_ORDER = os.environ.get('FX_SETTLEMENT_ORDER', 'fifo').lower()  # fifo / lifo
+SETTLE_EPSILON = 0.005  # 未结金额低于半分即视为该侧已结清
+
+# 索引与结算后回写所需的交易字段（提交后回调不能再访问 ORM 对象）
+OrderSnapshot = namedtuple('OrderSnapshot', [
+    'order_id', 'customer_name', 'transaction_type', 'base_currency', 'quote_currency',
+    'amount', 'rate', 'operator', 'settled_in', 'settled_out', 'timestamp', 'status'
+])
+
+def order_snapshot(tx) -> OrderSnapshot:
+    return OrderSnapshot(*(getattr(tx, field) for field in OrderSnapshot._fields))
+
+def open_sides(tx) -> dict:
+    """交易各侧的 (货币, 未结金额)：'in' 为客户应付一侧，'out' 为公司应付一侧；已结清的一侧不出现"""
+    if tx.status not in OPEN_STATUSES:
+        return {}
+    (income_currency, income_total), (payout_currency, payout_total) = transaction_sides(tx)
+    sides = {
+        'in': (income_currency, income_total - (tx.settled_in or 0.0)),
+        'out': (payout_currency, payout_total - (tx.settled_out or 0.0)),
+    }
+    return {direction: side for direction, side in sides.items() if side[1] > SETTLE_EPSILON}
+
+def settlement_state(tx) -> str:
+    """两侧均结清为 settled，有任一侧已结算为 partial，否则 pending"""
+    (_, income_total), (_, payout_total) = transaction_sides(tx)
+    settled_in, settled_out = tx.settled_in or 0.0, tx.settled_out or 0.0
+    if settled_in >= income_total - SETTLE_EPSILON and settled_out >= payout_total - SETTLE_EPSILON:
+        return 'settled'
+    return 'partial' if settled_in or settled_out else 'pending'
+
+class OpenOrderIndex:
+    """进程级未结订单索引，键为 (客户, 货币, 方向)
+
+    每个键对应按 (下单时间, 订单号) 排序的列表，插入与删除用 bisect 定位；
+    另记录每个订单各侧的未结金额，供结算时预估需要载入多少订单。
+    启动后在后台整体加载（见 warm_open_orders），之后由下单、结算、撤销、删除客户在事务提交后更新；
+    加载期间提交的变更先记下，加载完成后按提交顺序重放，不会因读取的快照较旧而丢失。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._orders = {}  # (客户, 货币, 方向) -> [(时间, 订单号)]
+        self._sides = {}   # 订单号 -> {方向: ((客户, 货币, 方向), (时间, 订单号), 未结金额)}
+        self._pending = None  # 加载期间提交的变更
+        self.warmed = False
+        self.owns = None  # 多进程部署时由工作进程设置：只加载并回答路由到本进程的客户
+
+    def serves(self, customer: str) -> bool:
+        """索引能否回答该客户的结算查询；否则应退回到数据库查询"""
+        return self.warmed and (self.owns is None or self.owns(customer))
+
+    def rebuild(self):
+        """从数据库重新加载全部（多进程部署时为本进程负责的）未结订单"""
+        with self._lock:
+            self.warmed = False
+            self._pending = []
+        try:
+            with engine.connect() as conn:
+                rows = conn.execute(
+                    select(*(getattr(Transaction, field) for field in OrderSnapshot._fields))
+                    .where(Transaction.status.in_(OPEN_STATUSES))
+                ).all()
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+        with self._lock:
+            # 重放与切换到直接更新在同一把锁内完成，其间提交的变更不会落进已重放完的列表
+            pending, self._pending = self._pending, None
+            self._orders, self._sides = {}, {}
+            for row in rows:
+                if self.owns is None or self.owns(row.customer_name):
+                    self._track(row)
+            for change in pending:
+                change()
+            self.warmed = True
+        logger.info(f"未结订单索引已加载: {len(self._sides)} 笔")
+
+    def _apply(self, change):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append(change)
+            elif self.warmed:
+                change()
+
+    def _track(self, tx):
+        self._untrack(tx.order_id)
+        entry = (tx.timestamp or datetime.min, tx.order_id)
+        sides = {}
+        for direction, (currency, remaining) in open_sides(tx).items():
+            key = (tx.customer_name, currency, direction)
+            bisect.insort(self._orders.setdefault(key, []), entry)
+            sides[direction] = (key, entry, remaining)
+        if sides:
+            self._sides[tx.order_id] = sides
+
+    def _untrack(self, order_id: str):
+        for key, entry, _ in self._sides.pop(order_id, {}).values():
+            orders = self._orders[key]
+            pos = bisect.bisect_left(orders, entry)
+            if pos < len(orders) and orders[pos] == entry:
+                del orders[pos]
+            if not orders:
+                del self._orders[key]
+
+    def track(self, *txs):
+        """登记或更新订单（已结清的一侧/订单会被移除）"""
+        def change():
+            for tx in txs:
+                self._track(tx)
+        self._apply(change)
+
+    def remove(self, order_id: str):
+        self._apply(lambda: self._untrack(order_id))
+
+    def drop_customer(self, customer: str):
+        def change():
+            for order_id in [order_id for order_id, sides in self._sides.items()
+                             if any(key[0] == customer for key, _, _ in sides.values())]:
+                self._untrack(order_id)
+        self._apply(change)
+
+    def candidates(self, customer: str, currency: str, direction: str, amount: float, skip=()) -> list:
+        """按 SETTLEMENT_ORDER 返回 [订单号]：跳过 skip 中的订单，未结金额累计覆盖 amount 即停止
+
+        只走到覆盖本次付款的订单为止，不复制客户的整个未结订单列表。
+        """
+        with self._lock:
+            orders = self._orders.get((customer, currency, direction), [])
+            if SETTLEMENT_ORDER != 'fifo':
+                orders = reversed(orders)
+            order_ids, cover = [], 0.0
+            for _, order_id in orders:
+                if order_id in skip:
+                    continue
+                order_ids.append(order_id)
+                cover += self._sides[order_id][direction][2]
+                if cover >= amount:
+                    break
+            return order_ids
+
+open_orders = OpenOrderIndex()
+
+def warm_open_orders():
+    """在后台线程加载未结订单索引，不推迟开始接收更新；加载完成前结算使用数据库查询"""
+    def run():
+        try:
+            open_orders.rebuild()
+        except Exception as e:
+            logger.error(f"未结订单索引加载失败，结算继续使用数据库查询: {str(e)}", exc_info=True)
+    threading.Thread(target=run, name='fx-open-orders', daemon=True).start()
+
+# ================== 常用查询 ==================
+def open_orders_query(session, customer: str, currency: str, direction: str):
+    """客户在指定货币上的未结订单，按 SETTLEMENT_ORDER 排列（fifo 最早的在前）
+
+    direction='in' 为客户向公司付款的一侧（买入的报价货币/卖出的基础货币），
+    'out' 为公司向客户付款的一侧。
+    """
+    if direction == 'in':
+        currency_match = (
+            (Transaction.transaction_type == 'buy') & (Transaction.quote_currency == currency) |
+            (Transaction.transaction_type == 'sell') & (Transaction.base_currency == currency)
+        )
+    else:
+        currency_match = (
+            (Transaction.transaction_type == 'buy') & (Transaction.base_currency == currency) |
+            (Transaction.transaction_type == 'sell') & (Transaction.quote_currency == currency)
+        )
+    return session.query(Transaction).filter(
+        Transaction.customer_name == customer,
+        currency_match,
+        Transaction.status.in_(OPEN_STATUSES)
+    ).order_by(
+        Transaction.timestamp.asc() if SETTLEMENT_ORDER == 'fifo' else Transaction.timestamp.desc()
+    )
+
+def customer_balances_query(session, customer: str):
+    return session.query(Balance).filter_by(customer_name=customer)
+
+def debts_query(session):
+    """全部非公司账户余额（/debts 未指定客户且缓存不可用时）"""
+    return session.query(Balance).filter(Balance.customer_name != 'COMPANY')
+
+def credit_balances_query(session):
+    """各客户各货币的正余额（信用余额）"""
+    return session.query(
+        Balance.customer_name,
+        Balance.currency,
+        func.sum(Balance.amount).label('credit')
+    ).filter(Balance.amount > 0).group_by(Balance.customer_name, Balance.currency)
+
+def transactions_in_range_query(session, start_date: datetime, end_date: datetime):
+    return session.query(Transaction).filter(
+        Transaction.timestamp.between(start_date, end_date)
+    )
+
+def expenses_in_range_query(session, start_date: datetime, end_date: datetime):
+    return session.query(Expense).filter(
+        Expense.timestamp.between(start_date, end_date)
+    )
+
+def expenses_page_query(session, start_date: datetime = None, end_date: datetime = None,
+                        currency: str = None, after=None):
+    """支出按 (timestamp, id) 倒序；after 为上一页最后一条 (timestamp, id)，只取其后的记录"""
+    query = session.query(Expense)
+    if currency:
+        query = query.filter(Expense.currency == currency)
+    if start_date:
+        query = query.filter(Expense.timestamp.between(start_date, end_date))
+    if after:
+        query = query.filter(tuple_(Expense.timestamp, Expense.id) < tuple_(*after))
+    return query.order_by(Expense.timestamp.desc(), Expense.id.desc())
+
+def expense_summary_query(start_date: datetime = None, end_date: datetime = None, currency: str = None):
+    """按月份与货币合计支出（读日汇总表，成本与支出笔数无关）"""
+    month = func.strftime('%Y-%m', DailyRollup.day)
+    query = select(
+        month.label('month'), DailyRollup.currency,
+        func.sum(DailyRollup.expense).label('amount'), func.sum(DailyRollup.expense_count).label('count')
+    ).where(DailyRollup.expense_count > 0)
+    if start_date:
+        query = query.where(DailyRollup.day.between(start_date.date(), end_date.date()))
+    if currency:
+        query = query.where(DailyRollup.currency == currency)
+    return query.group_by(month, DailyRollup.currency).order_by(month.desc(), DailyRollup.currency)
+
+def customer_transactions_query(session, customer: str, start_date: datetime, end_date: datetime):
+    return session.query(Transaction).filter(
+        Transaction.customer_name == customer,
+        Transaction.timestamp.between(start_date, end_date)
+    )
+
+def customer_adjustments_query(session, customer: str, start_date: datetime, end_date: datetime):
+    return session.query(Adjustment).filter(
+        Adjustment.customer_name == customer,
+        Adjustment.timestamp.between(start_date, end_date)
+    )
+
+def keyset_chunks(query, columns: tuple, size: int):
+    """按 columns 升序分块读取 query 的结果，每块完整取出后才交给调用方
+
+    块与块之间不保留打开的游标，流式报表可在两块之间结束读事务（见 ReportStream）。
+    columns 的首列另加一个可走索引的下界，后面的块不必从范围开头重新扫描。
+    """
+    after = None
+    while True:
+        chunk = query
+        if after is not None:
+            chunk = chunk.filter(columns[0] >= after[0], tuple_(*columns) > tuple_(*after))
+        rows = chunk.order_by(*columns).limit(size).all()
+        if rows:
+            yield rows
+        if len(rows) < size:
+            return
+        after = tuple(getattr(rows[-1], column.key) for column in columns)
+
+# ================== 日汇总 ==================
+ROLLUP_FIELDS = ('total_income', 'settled_income', 'total_expense', 'settled_expense',
+                 'expense', 'income_count', 'payout_count', 'expense_count')
+
+def transaction_sides(tx):
+    """交易的收入侧与支出侧：((收入货币, 应收总额), (支出货币, 应付总额))
+
+    买入：客户支付报价货币（公司收入），获得基础货币（公司支出）；卖出相反。
+    """
+    quote_total = tx.amount / tx.rate if tx.operator == '/' else tx.amount * tx.rate
+    if tx.transaction_type == 'buy':
+        return (tx.quote_currency, quote_total), (tx.base_currency, tx.amount)
+    return (tx.base_currency, tx.amount), (tx.quote_currency, quote_total)
+
+def transaction_rollup_deltas(tx, sign: int = 1) -> list:
+    """交易（含已结算金额）对日汇总的贡献，sign=-1 用于撤销"""
+    (income_currency, income_total), (payout_currency, payout_total) = transaction_sides(tx)
+    day = tx.timestamp.date()
+    return [
+        (day, income_currency, {
+            'total_income': sign * income_total,
+            'settled_income': sign * (tx.settled_in or 0.0),
+            'income_count': sign,
+        }),
+        (day, payout_currency, {
+            'total_expense': sign * payout_total,
+            'settled_expense': sign * (tx.settled_out or 0.0),
+            'payout_count': sign,
+        }),
+    ]
+
+def settlement_rollup_delta(tx, direction: str, amount: float) -> tuple:
+    """登记到交易上的收款（direction='in'）或付款（'out'）对日汇总的贡献"""
+    (income_currency, _), (payout_currency, _) = transaction_sides(tx)
+    if direction == 'in':
+        return (tx.timestamp.date(), income_currency, {'settled_income': amount})
+    return (tx.timestamp.date(), payout_currency, {'settled_expense': amount})
+
+def apply_rollup_deltas(session, deltas) -> None:
+    """把 (日期, 货币, {字段: 增量}) 列表合并后用一条 upsert 写入日汇总（在调用方事务内）"""
+    merged = {}
+    for day, currency, values in deltas:
+        row = merged.setdefault((day, currency), dict.fromkeys(ROLLUP_FIELDS, 0))
+        for field, value in values.items():
+            row[field] += value
+    if not merged:
+        return
+
+    stmt = sqlite_insert(DailyRollup).values([
+        {'day': day, 'currency': currency, **values} for (day, currency), values in merged.items()
+    ])
+    # 金额保留6位小数，避免反复增减后残留浮点误差
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[DailyRollup.day, DailyRollup.currency],
+        set_={
+            field: (func.round(getattr(DailyRollup, field) + stmt.excluded[field], 6)
+                    if field.endswith(('income', 'expense')) else
+                    getattr(DailyRollup, field) + stmt.excluded[field])
+            for field in ROLLUP_FIELDS
+        }
+    )
+    session.execute(stmt)
+
+def rollup_source_query(customer: str = None):
+    """从原始交易与支出计算日汇总（按日期、货币分组），customer 限定某客户的交易"""
+    is_buy = Transaction.transaction_type == 'buy'
+    quote_total = quote_total_expr()
+    day = func.date(Transaction.timestamp, type_=Date)
+    zero = literal(0.0)
+    tx_filter = [Transaction.customer_name == customer] if customer is not None else []
+
+    income = select(
+        day.label('day'),
+        case((is_buy, Transaction.quote_currency), else_=Transaction.base_currency).label('currency'),
+        case((is_buy, quote_total), else_=Transaction.amount).label('total_income'),
+        func.coalesce(Transaction.settled_in, 0).label('settled_income'),
+        zero.label('total_expense'), zero.label('settled_expense'), zero.label('expense'),
+        literal(1).label('income_count'), literal(0).label('payout_count'), literal(0).label('expense_count')
+    ).where(*tx_filter)
+    payout = select(
+        day, case((is_buy, Transaction.base_currency), else_=Transaction.quote_currency),
+        zero, zero,
+        case((is_buy, Transaction.amount), else_=quote_total),
+        func.coalesce(Transaction.settled_out, 0),
+        zero, literal(0), literal(1), literal(0)
+    ).where(*tx_filter)
+    parts = [income, payout]
+    if customer is None:
+        parts.append(select(
+            func.date(Expense.timestamp, type_=Date), Expense.currency,
+            zero, zero, zero, zero, Expense.amount,
+            literal(0), literal(0), literal(1)
+        ))
+    rows = union_all(*parts).subquery()
+    return select(
+        rows.c.day, rows.c.currency, *(func.sum(rows.c[field]).label(field) for field in ROLLUP_FIELDS)
+    ).group_by(rows.c.day, rows.c.currency)
+
+def rebuild_rollups() -> int:
+    """从原始交易与支出历史重新生成日汇总，返回生成的行数"""
+    with engine.begin() as conn:
+        conn.execute(delete(DailyRollup))
+        conn.execute(insert(DailyRollup).from_select(['day', 'currency', *ROLLUP_FIELDS], rollup_source_query()))
+        count = conn.execute(select(func.count()).select_from(DailyRollup)).scalar()
+    logger.info(f"日汇总已重建: {count} 行")
+    return count
+
+def rollups_in_range_query(start_date: datetime, end_date: datetime):
+    """区间内按货币合计的日汇总（已全部撤销的货币不出现）"""
+    return select(
+        DailyRollup.currency, *(func.sum(getattr(DailyRollup, field)).label(field) for field in ROLLUP_FIELDS)
+    ).where(
+        DailyRollup.day.between(start_date.date(), end_date.date())
+    ).group_by(DailyRollup.currency).having(
+        func.sum(DailyRollup.income_count + DailyRollup.payout_count + DailyRollup.expense_count) > 0
+    )
+
+def covers_whole_days(start_date: datetime, end_date: datetime) -> bool:
+    """区间是否由整天组成（起点为0点、终点为23:59:59之后），只有这时才能直接使用日汇总"""
+    return (start_date == start_date.replace(hour=0, minute=0, second=0, microsecond=0)
+            and end_date >= end_date.replace(hour=23, minute=59, second=59, microsecond=0))
+
+# ================== 盈亏汇总 ==================
+def quote_total_expr():
+    """报价货币总额（按运算符计算）的SQL表达式"""
+    return case(
+        (Transaction.operator == '/', Transaction.amount / Transaction.rate),
+        else_=Transaction.amount * Transaction.rate
+    )
+
+def pnl_totals_query(start_date: datetime, end_date: datetime):
+    """按货币分组的收入侧、支出侧与公司支出汇总，合并为一条 UNION ALL 语句
+
+    买入：客户支付报价货币（公司收入），获得基础货币（公司支出）；
+    卖出：客户支付基础货币，获得报价货币。
+    """
+    is_buy = Transaction.transaction_type == 'buy'
+    quote_total = quote_total_expr()
+    in_range = Transaction.timestamp.between(start_date, end_date)
+
+    income = select(
+        literal('income').label('kind'),
+        case((is_buy, Transaction.quote_currency), else_=Transaction.base_currency).label('currency'),
+        func.sum(case((is_buy, quote_total), else_=Transaction.amount)).label('total'),
+        func.sum(func.coalesce(Transaction.settled_in, 0)).label('settled'),
+        func.count().label('n')
+    ).where(in_range).group_by(literal_column('currency'))
+    outgoing = select(
+        literal('expense').label('kind'),
+        case((is_buy, Transaction.base_currency), else_=Transaction.quote_currency).label('currency'),
+        func.sum(case((is_buy, Transaction.amount), else_=quote_total)).label('total'),
+        func.sum(func.coalesce(Transaction.settled_out, 0)).label('settled'),
+        func.count().label('n')
+    ).where(in_range).group_by(literal_column('currency'))
+    spent = select(
+        literal('spent').label('kind'),
+        Expense.currency.label('currency'),
+        func.sum(Expense.amount).label('total'),
+        literal(0.0).label('settled'),
+        func.count().label('n')
+    ).where(Expense.timestamp.between(start_date, end_date)).group_by(Expense.currency)
+    return union_all(income, outgoing, spent)
+
+def pnl_totals(session, start_date: datetime, end_date: datetime):
+    """汇总区间盈亏，返回 (currency_report, 交易笔数, 支出笔数)
+
+    整天区间直接合计日汇总；区间含非整天部分时退回到原始交易与支出的 SQL 汇总。
+    """
+    currency_report = defaultdict(lambda: {
+        'actual_income': 0.0,  # 实际收入（已结算）
+        'actual_expense': 0.0,  # 实际支出（已结算）
+        'pending_income': 0.0,  # 应收未收
+        'pending_expense': 0.0,  # 应付未付
+        'credit_balance': 0.0,  # 客户多付的信用余额
+        'total_income': 0.0,    # 总应收款
+        'total_expense': 0.0,   # 总应付款
+        'expense': 0.0          # 支出
+    })
+    tx_count = expense_count = 0
+    if covers_whole_days(start_date, end_date):
+        for row in session.execute(rollups_in_range_query(start_date, end_date)):
+            data = currency_report[row.currency]
+            data['total_income'] += row.total_income          # 总应收款
+            data['actual_income'] += row.settled_income       # 已收款
+            data['total_expense'] += row.total_expense        # 总应付款
+            data['actual_expense'] += row.settled_expense     # 已付款
+            data['expense'] += row.expense                    # 支出
+            tx_count += row.income_count
+            expense_count += row.expense_count
+    else:
+        for kind, currency, total, settled, n in session.execute(pnl_totals_query(start_date, end_date)):
+            data = currency_report[currency]
+            if kind == 'income':
+                data['total_income'] += total or 0.0          # 总应收款
+                data['actual_income'] += settled or 0.0       # 已收款
+                tx_count += n
+            elif kind == 'expense':
+                data['total_expense'] += total or 0.0         # 总应付款
+                data['actual_expense'] += settled or 0.0      # 已付款
+            else:
+                data['expense'] += total or 0.0               # 支出
+                expense_count += n
+
+    for data in currency_report.values():
+        data['pending_income'] = data['total_income'] - data['actual_income']     # 应收未收
+        data['pending_expense'] = data['total_expense'] - data['actual_expense']  # 应付未付
+        data['actual_expense'] += data['expense']
+        # 信用余额 = 已收款 - 总应收款
+        data['credit_balance'] = max(0, data['actual_income'] - data['total_income'])
+
+    return dict(sorted(currency_report.items())), tx_count, expense_count
+
 # ================== Excel报表生成工具函数 ==================
-def generate_excel_buffer(df_dict: dict, sheet_names: list) -> BytesIO:
-    """生成Excel文件内存缓冲"""
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        for idx, df in enumerate(df_dict.values()):
-            df.to_excel(writer, sheet_name=sheet_names[idx], index=False)
-            # 自动调整列宽
-            worksheet = writer.sheets[sheet_names[idx]]
-            for column in df:
-                column_width = max(df[column].astype(str).map(len).max(), len(column)) + 2
-                col_idx = df.columns.get_loc(column)
-                worksheet.column_dimensions[chr(65 + col_idx)].width = column_width
-    output.seek(0)
-    return output
+# Excel 渲染在独立进程池中执行，大报表不会占用事件循环或数据库线程；
+# 使用 spawn 启动，避免在已有数据库线程的进程里 fork
+EXCEL_WORKERS = int(os.environ.get('FX_EXCEL_WORKERS', '2'))
+excel_executor = None
+
+def get_excel_executor() -> ProcessPoolExecutor:
+    """首次需要时才创建Excel进程池"""
+    global excel_executor
+    if excel_executor is None:
+        excel_executor = ProcessPoolExecutor(
+            max_workers=EXCEL_WORKERS,
+            mp_context=multiprocessing.get_context('spawn')
+        )
+    return excel_executor
+
+async def render_excel(sheets: list) -> BytesIO:
+    """在进程池中将 [(工作表名, 记录列表)] 渲染为Excel文件缓冲"""
+    import fx_excel  # openpyxl 较重，首次导出Excel时才加载
+    loop = asyncio.get_running_loop()
+    data = await loop.run_in_executor(get_excel_executor(), fx_excel.render_workbook, sheets)
+    return BytesIO(data)
+
+# ================== 结算状态引擎 ==================
+# 报表读取的交易列，行对象可按属性访问（tx.amount 等）
+TX_REPORT_COLUMNS = (
+    Transaction.order_id, Transaction.customer_name, Transaction.transaction_type,
+    Transaction.base_currency, Transaction.quote_currency, Transaction.amount,
+    Transaction.rate, Transaction.operator, Transaction.settled_in,
+    Transaction.settled_out, Transaction.timestamp
+)
+
+# 引擎输出的各列（每个字段是与输入行等长的列表）
+SettlementColumns = namedtuple('SettlementColumns', [
+    'total_quote', 'settled_base', 'settled_quote',
+    'base_progress', 'quote_progress', 'min_progress', 'done'
+])
+
+def settlement_status(amount, rate, is_div, is_buy, settled_in, settled_out) -> dict:
+    """一次向量化计算整批交易的结算进度与完成状态
+
+    参数均为等长数组，is_div / is_buy 为布尔数组（运算符为 '/'、交易类型为买入）。
+    买入时基础货币由公司支付（settled_out）、报价货币由客户支付（settled_in），卖出相反；
+    两侧已结金额的整数部分都达到应付额即视为完成。返回各字段的 NumPy 数组。
+    """
+    import numpy as np  # 只有报表用到，不在启动时加载
+    amount = np.asarray(amount, dtype=float)
+    rate = np.asarray(rate, dtype=float)
+    is_div = np.asarray(is_div, dtype=bool)
+    is_buy = np.asarray(is_buy, dtype=bool)
+    settled_in = np.nan_to_num(np.asarray(settled_in, dtype=float))
+    settled_out = np.nan_to_num(np.asarray(settled_out, dtype=float))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        total_quote = np.where(is_div, amount / rate, amount * rate)
+        settled_base = np.where(is_buy, settled_out, settled_in)
+        settled_quote = np.where(is_buy, settled_in, settled_out)
+        base_progress = np.where(amount != 0, settled_base / amount, 0.0)
+        quote_progress = np.where(total_quote != 0, settled_quote / total_quote, 0.0)
+
+    # 取整后判断（与 int() 一致，向零截断）
+    done = (np.trunc(settled_base) >= np.trunc(amount)) & (np.trunc(settled_quote) >= np.trunc(total_quote))
+
+    return {
+        'total_quote': total_quote,
+        'settled_base': settled_base,
+        'settled_quote': settled_quote,
+        'base_progress': base_progress,
+        'quote_progress': quote_progress,
+        'min_progress': np.minimum(base_progress, quote_progress),
+        'done': done,
+    }
+
+def settlements(rows) -> SettlementColumns:
+    """对交易行（含 TX_REPORT_COLUMNS 中的列）整体计算结算状态，按列返回 Python 列表"""
+    result = settlement_status(
+        [tx.amount for tx in rows],
+        [tx.rate for tx in rows],
+        [tx.operator == '/' for tx in rows],
+        [tx.transaction_type == 'buy' for tx in rows],
+        [tx.settled_in for tx in rows],
+        [tx.settled_out for tx in rows],
+    )
+    return SettlementColumns(*(result[field].tolist() for field in SettlementColumns._fields))
 
 # 通用状态判断函数
 def get_tx_status(tx):
-    if tx.operator == '/':
-        total_quote = tx.amount / tx.rate
-    else:
-        total_quote = tx.amount * tx.rate
-
-    # 获取结算金额
-    settled_base = tx.settled_out if tx.transaction_type == 'buy' else tx.settled_in
-    settled_quote = tx.settled_in if tx.transaction_type == 'buy' else tx.settled_out
-    
-    # 计算整数部分
-    base_done = int(settled_base) >= int(tx.amount)
-    quote_done = int(settled_quote) >= int(total_quote)
-    
-    # 计算进度百分比
-    base_progress = settled_base / tx.amount if tx.amount != 0 else 0
-    quote_progress = settled_quote / total_quote if total_quote != 0 else 0
-    min_progress = min(base_progress, quote_progress)
-    
-    # 状态判断
-    if base_done and quote_done:
+    st = settlements([tx])
+    min_progress = st.min_progress[0]
+    if st.done[0]:
         return "已完成", min_progress
     elif min_progress > 0:
         return f"部分结算 ({min_progress:.1%})", min_progress
     else:
         return "未结算", min_progress
-    
+
 # ================== 交易处理模块 ==================
+def book_transaction(session, order_id: str, customer: str, transaction_type: str, base_currency: str,
+                     quote_currency: str, amount: float, rate: float, operator: str,
+                     quote_amount: float) -> str:
+    """写入交易记录并更新客户余额，返回订单号
+
+    订单号须在进入写入队列前分配：号段预留使用独立事务，在写线程持有写锁时
+    预留会互相等待。
+    """
+    new_tx = Transaction(
+        timestamp=datetime.now(),
+        order_id=order_id,
+        customer_name=customer,
+        transaction_type=transaction_type,
+        base_currency=base_currency,
+        quote_currency=quote_currency,
+        amount=amount,
+        rate=rate,
+        status='pending',
+        operator=operator,  
+        payment_in=0,
+        payment_out=0,
+        settled_in=0,
+        settled_out=0
+    )
+
+    # 关键修改：更新余额逻辑
+    session.add(new_tx)
+    if transaction_type == 'buy':
+        # 客户获得基础货币（MYR），支付报价货币（USDT）
+        legs = [(customer, base_currency, amount), (customer, quote_currency, -quote_amount)]
+    else:
+        # 客户支付基础货币（MYR），获得报价货币（USDT）
+        legs = [(customer, base_currency, -amount), (customer, quote_currency, quote_amount)]
+    apply_balance_legs(session, legs)
+    apply_rollup_deltas(session, transaction_rollup_deltas(new_tx))
+    snapshot = order_snapshot(new_tx)
+    after_commit(session, lambda: open_orders.track(snapshot))
+
+    return order_id
+
 async def handle_transaction(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """处理交易指令"""
-    session = Session()
     try:
         text = update.message.text.strip()
         logger.info(f"收到交易指令: {text}")
@@ -270,52 +2140,23 @@ async def handle_transaction(update: Update, context: ContextTypes.DEFAULT_TYPE)
             # 客户应支付报价货币（USDT），获得基础货币（MYR）
             receive_currency = base_currency   # 客户收到的货币
             pay_currency = quote_currency      # 客户需要支付的货币
+            payment_amount = quote_amount
+            received_amount = amount
         else:
             transaction_type = 'sell'
             # 客户应支付基础货币（MYR），获得报价货币（USDT）
             receive_currency = quote_currency  # 客户收到的货币
             pay_currency = base_currency       # 客户需要支付的货币
+            payment_amount = amount
+            received_amount = quote_amount
 
         # 创建交易记录
-        order_id = generate_order_id(session)
-        new_tx = Transaction(
-            order_id=order_id,
-            customer_name=customer,
-            transaction_type=transaction_type,
-            base_currency=base_currency,
-            quote_currency=quote_currency,
-            amount=amount,
-            rate=rate,
-            status='pending',
-            operator=operator,  
-            payment_in=0,
-            payment_out=0,
-            settled_in=0,
-            settled_out=0
-        )
-        session.add(new_tx)
-
-        # 关键修改：更新余额逻辑
-        with session.begin_nested():
-            session.add(new_tx)
-            if transaction_type == 'buy':
-                received_curr = quote_currency
-                paid_curr = base_currency
-                payment_amount = quote_amount
-                received_amount = amount
-                # 客户获得基础货币（MYR），支付报价货币（USDT）
-                update_balance(session, customer, base_currency, amount)
-                update_balance(session, customer, quote_currency, -quote_amount)
-            else:
-                received_curr = base_currency
-                paid_curr = quote_currency
-                payment_amount = amount
-                received_amount = quote_amount
-                # 客户支付基础货币（MYR），获得报价货币（USDT）
-                update_balance(session, customer, base_currency, -amount)
-                update_balance(session, customer, quote_currency, quote_amount)
-        
-        session.commit()
+        async with customer_locks.hold(customer):
+            order_id = await asyncio.get_running_loop().run_in_executor(db_executor, generate_order_id)
+            await run_write(
+                book_transaction, order_id, customer, transaction_type, base_currency,
+                quote_currency, amount, rate, operator, quote_amount
+            )
 
         # 成功响应（保持原格式）
         await update.message.reply_text(
@@ -347,18 +2188,95 @@ async def handle_transaction(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
 
     except Exception as e:
-        session.rollback()
         logger.error(f"交易处理失败：{str(e)}", exc_info=True)
         await update.message.reply_text(
             "❌ 交易创建失败！\n"
             "⚠️ 错误详情请查看日志"
         )
-    finally:
-        Session.remove()
+
+def settlement_candidates(session, customer: str, currency: str, direction: str, amount: float, seen: set) -> list:
+    """按结算顺序返回客户在该货币、方向上的下一批未结订单，空列表表示没有更多
+
+    索引已加载时只按主键载入索引中未结金额刚好覆盖 amount 的订单（跳过 seen 中已取过的）；
+    索引尚未加载（或该客户不归本进程）时退回到数据库过滤查询，一次返回全部未结订单。
+    返回的订单号会加入 seen。
+    """
+    if not open_orders.serves(customer):
+        if seen:
+            return []
+        rows = open_orders_query(session, customer, currency, direction).all()
+        seen.update(tx.order_id for tx in rows)
+        return rows
+
+    while order_ids := open_orders.candidates(customer, currency, direction, amount, seen):
+        seen.update(order_ids)
+        rows = {tx.order_id: tx for tx in session.query(Transaction).filter(Transaction.order_id.in_(order_ids))}
+        batch = [rows[order_id] for order_id in order_ids if order_id in rows]
+        if batch:
+            return batch
+    return []
+
+def allocate_settlement(session, customer: str, currency: str, direction: str, amount: float) -> list:
+    """把一笔收款（direction='in'）或付款（'out'）按结算顺序分摊到多笔未结订单
+
+    每笔订单最多分摊到该侧结清为止；全部订单结清后仍有剩余时，余数记在最后一笔
+    订单上（形成客户信用余额）。只修改会话中的订单，由调用方统一提交。
+    返回 [(订单号, 分摊金额)]。
+    """
+    settled_field = 'settled_in' if direction == 'in' else 'settled_out'
+    allocations = {}
+    touched = {}
+    left = round(amount, 2)
+    seen = set()
+
+    # 只在当前一批分摊不完时才取下一批订单
+    while left > 0:
+        batch = settlement_candidates(session, customer, currency, direction, left, seen)
+        if not batch:
+            break
+        for tx in batch:
+            remaining = open_sides(tx).get(direction, (None, 0.0))[1]
+            if remaining <= SETTLE_EPSILON:
+                continue  # 索引稍旧：该侧已被其他请求结清
+            share = round(min(left, remaining), 2)
+            setattr(tx, settled_field, (getattr(tx, settled_field) or 0.0) + share)
+            allocations[tx.order_id] = share
+            touched[tx.order_id] = tx
+            left = round(left - share, 2)
+            if left <= 0:
+                break
+
+    if left > 0 and touched:
+        # 超付部分记在最后一笔订单上
+        tx = list(touched.values())[-1]
+        setattr(tx, settled_field, getattr(tx, settled_field) + left)
+        allocations[tx.order_id] += left
+
+    deltas = []
+    for order_id, tx in touched.items():
+        tx.status = settlement_state(tx)
+        deltas.append(settlement_rollup_delta(tx, direction, allocations[order_id]))
+    apply_rollup_deltas(session, deltas)
+
+    snapshots = [order_snapshot(tx) for tx in touched.values()]
+    after_commit(session, lambda: open_orders.track(*snapshots))
+    return list(allocations.items())
+
+def apply_received(session, customer: str, currency: str, amount: float) -> list:
+    """登记客户付款：更新双方余额并按结算顺序分摊到未结订单的 settled_in，返回分摊明细"""
+    # ✅ 直接更新余额
+    apply_balance_legs(session, [
+        (customer, currency, amount),   # 客户支付，余额减少
+        ('COMPANY', currency, amount),  # 公司收到，余额增加
+    ])
+
+    allocations = allocate_settlement(session, customer, currency, 'in', amount)
+    if not allocations:
+        logger.warning(f"No matching transaction found for {customer} and {currency}")
+    return allocations
 
 async def handle_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """处理客户付款（直接增加公司余额，减少客户余额）"""
-    session = Session()
     try:
         args = context.args
         if len(args) < 2:
@@ -375,36 +2293,8 @@ async def handle_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ 金额格式错误！示例: /received 客户A 1000USD")
             return
 
-        # ✅ 直接更新余额
-        with session.begin_nested():
-            update_balance(session, customer, currency, amount)  # 客户支付，余额减少
-            update_balance(session, 'COMPANY', currency, amount)  # 公司收到，余额增加
-
-        tx = session.query(Transaction).filter(
-            Transaction.customer_name == customer,
-            (
-                (Transaction.transaction_type == 'buy') & (Transaction.quote_currency == currency) |
-                (Transaction.transaction_type == 'sell') & (Transaction.base_currency == currency)
-            ),
-            Transaction.status.in_(['pending', 'partial'])
-        ).order_by(Transaction.timestamp.desc()).first()
-        if tx:
-            with session.begin_nested():
-                tx.settled_in += amount  # Add to settled_in rather than setting it
-                if tx.transaction_type == 'buy':
-                    total_quote = tx.amount / tx.rate if tx.operator == '/' else tx.amount * tx.rate
-                    if tx.settled_in >= total_quote:
-                        tx.status = 'settled'
-                    else:
-                        tx.status = 'partial'
-                elif tx.transaction_type == 'sell':
-                    if tx.settled_out >= (tx.amount / tx.rate if tx.operator == '/' else tx.amount * tx.rate):
-                       tx.status = 'settled'
-                    else:
-                       tx.status = 'partial'
-            session.commit()
-        else:
-            logger.warning(f"No matching transaction found for {customer} and {currency}")
+        async with customer_locks.hold(customer):
+            allocations = await run_write(apply_received, customer, currency, amount)
 
         # 构建响应
         response = [
@@ -413,19 +2303,29 @@ async def handle_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"▸ 客户 {customer} {currency} 余额减少 {amount:,.2f}",
             f"▸ 公司 {currency} 余额增加 {amount:,.2f}"
         ]
+        response += [f"▸ 订单 {order_id} 结算 {share:,.2f}{currency}" for order_id, share in allocations]
 
         await update.message.reply_text("\n".join(response))
 
     except Exception as e:
-        session.rollback()
         logger.error(f"收款处理失败: {str(e)}")
         await update.message.reply_text("❌ 操作失败")
-    finally:
-        Session.remove()
+
+def apply_paid(session, customer: str, currency: str, amount: float) -> list:
+    """登记向客户付款：更新双方余额并按结算顺序分摊到未结订单的 settled_out，返回分摊明细"""
+    # ✅ 直接更新余额
+    apply_balance_legs(session, [
+        (customer, currency, -amount),   # 客户获得，余额增加
+        ('COMPANY', currency, -amount),  # 公司支付，余额减少
+    ])
+
+    allocations = allocate_settlement(session, customer, currency, 'out', amount)
+    if not allocations:
+        logger.warning(f"No matching transaction found for {customer} and {currency}")
+    return allocations
 
 async def handle_paid(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """处理向客户付款（直接减少公司余额，增加客户余额）"""
-    session = Session()
     try:
         args = context.args
         if len(args) < 2:
@@ -442,37 +2342,8 @@ async def handle_paid(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ 金额格式错误！示例: /paid 客户A 1000USD")
             return
 
-        # ✅ 直接更新余额
-        with session.begin_nested():
-            update_balance(session, customer, currency, -amount)    # 客户获得，余额增加
-            update_balance(session, 'COMPANY', currency, -amount)  # 公司支付，余额减少
-
-        # 更新 settled_out 字段
-        tx = session.query(Transaction).filter(
-            Transaction.customer_name == customer,
-            (
-                (Transaction.transaction_type == 'buy') & (Transaction.base_currency == currency) |
-                (Transaction.transaction_type == 'sell') & (Transaction.quote_currency == currency)
-            ),
-            Transaction.status.in_(['pending', 'partial'])
-        ).order_by(Transaction.timestamp.desc()).first()
-        if tx:
-            with session.begin_nested():
-                tx.settled_out += amount  # Add to settled_out instead of setting it
-                if tx.transaction_type == 'buy':
-                    if tx.settled_out >= tx.amount:
-                        tx.status = 'settled'
-                    else:
-                        tx.status = 'partial'
-                elif tx.transaction_type == 'sell':
-                    total_quote = tx.amount * tx.rate if tx.operator == '*' else tx.amount / tx.rate
-                    if tx.settled_out >= total_quote:
-                       tx.status = 'settled'
-                    else:
-                       tx.status = 'partial'
-            session.commit()
-        else:
-            logger.warning(f"No matching transaction found for {customer} and {currency}")
+        async with customer_locks.hold(customer):
+            allocations = await run_write(apply_paid, customer, currency, amount)
 
         # 构建响应
         response = [
@@ -481,29 +2352,34 @@ async def handle_paid(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"▸ 客户 {customer} {currency} 余额增加 {amount:,.2f}",
             f"▸ 公司 {currency} 余额减少 {amount:,.2f}"
         ]
+        response += [f"▸ 订单 {order_id} 结算 {share:,.2f}{currency}" for order_id, share in allocations]
 
         await update.message.reply_text("\n".join(response))
 
     except Exception as e:
-        session.rollback()
         logger.error(f"付款处理失败: {str(e)}")
         await update.message.reply_text("❌ 操作失败")
-    finally:
-        Session.remove()
 
 # ================== 余额管理模块 ==================
+def fetch_balances(session, customer: str) -> list:
+    """读取客户的全部余额，返回 (货币, 金额) 列表"""
+    balances = customer_balances_query(session, customer).all()
+    return [(b.currency, b.amount) for b in balances]
+
 async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """查询余额"""
-    session = Session()
     try:
         customer = context.args[0] if context.args else 'COMPANY'
-        balances = session.query(Balance).filter_by(customer_name=customer).all()
+        if balance_cache.serves(customer):
+            balances = balance_cache.customer_balances(customer)
+        else:
+            balances = await run_report(fetch_balances, customer)
         
         if not balances:
             await update.message.reply_text(f"📭 {customer} 当前没有余额记录")
             return
             
-        balance_list = "\n".join([f"▫️ {b.currency}: {b.amount:+,.2f} 💵" for b in balances])
+        balance_list = "\n".join([f"▫️ {currency}: {amount:+,.2f} 💵" for currency, amount in balances])
         await update.message.reply_text(
             f"📊 *余额报告* 🏦\n"
             f"━━━━━━━━━━━━━━━━━━━━\n"
@@ -516,12 +2392,23 @@ async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         logger.error(f"余额查询失败: {str(e)}")
         await update.message.reply_text("❌ 查询失败")
-    finally:
-        Session.remove()
+
+def record_adjustment(session, customer: str, currency: str, amount: float, note: str):
+    """记录手动调整并更新余额"""
+    # 记录调整
+    adj = Adjustment(
+        customer_name=customer,
+        currency=currency,
+        amount=amount,
+        note=note
+    )
+    session.add(adj)
+    
+    # 更新余额
+    apply_balance_legs(session, [(customer, currency, amount)])
 
 async def adjust_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """手动调整余额"""
-    session = Session()
     try:
         args = context.args
         if len(args) < 4:
@@ -538,18 +2425,8 @@ async def adjust_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ 金额格式错误")
             return
 
-        # 记录调整
-        adj = Adjustment(
-            customer_name=customer,
-            currency=currency,
-            amount=amount,
-            note=note
-        )
-        session.add(adj)
-        
-        # 更新余额
-        update_balance(session, customer, currency, amount)
-        session.commit()
+        async with customer_locks.hold(customer):
+            await run_write(record_adjustment, customer, currency, amount, note)
         
         await update.message.reply_text(
             f"⚖️ *余额调整完成* ✅\n"
@@ -560,27 +2437,30 @@ async def adjust_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"📝 备注：{note}"
         )
     except Exception as e:
-        session.rollback()
         logger.error(f"余额调整失败: {str(e)}")
         await update.message.reply_text("❌ 调整失败")
-    finally:
-        Session.remove()
+
+def fetch_debts(session, customer: str = None) -> list:
+    """读取非公司账户余额，返回 (客户, 货币, 金额) 列表"""
+    if customer:
+        query = customer_balances_query(session, customer).filter(Balance.customer_name != 'COMPANY')
+    else:
+        query = debts_query(session)
+    return [(b.customer_name, b.currency, b.amount) for b in query.all()]
 
 async def list_debts(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """查询欠款明细（排除公司账户）"""
-    session = Session()
     try:
         customer = context.args[0] if context.args else None
-        query = session.query(Balance).filter(Balance.customer_name != 'COMPANY')
-        if customer:
-            query = query.filter_by(customer_name=customer)
-        
-        balances = query.all()
+        if balance_cache.serves(customer):
+            balances = balance_cache.debts(customer)
+        else:
+            balances = await run_report(fetch_debts, customer)
         debt_report = ["📋 *欠款明细报告* ⚠️", "━━━━━━━━━━━━━━━━━━━━"]
         
         grouped = defaultdict(dict)
-        for b in balances:
-            grouped[b.customer_name][b.currency] = b.amount
+        for cust, curr, amt in balances:
+            grouped[cust][curr] = amt
         
         for cust, currencies in grouped.items():
             debt_report.append(f"👤 客户: {cust}")
@@ -595,13 +2475,100 @@ async def list_debts(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         logger.error(f"欠款查询失败: {str(e)}")
         await update.message.reply_text("❌ 查询失败")
-    finally:
-        Session.remove()
+
+def check_balance_cache(session, rebuild: bool) -> list:
+    """比对余额缓存与数据库，可选地在比对后重建缓存"""
+    mismatches = balance_cache.verify(session)
+    if rebuild:
+        balance_cache.rebuild()
+    return mismatches
+
+async def cache_check(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """校验（或重建）余额缓存"""
+    try:
+        if not is_admin(update):
+            await update.message.reply_text("⛔ 仅管理员可用")
+            return
+
+        rebuild = 'rebuild' in (context.args or [])
+        mismatches = await run_db(check_balance_cache, rebuild)
+
+        report = ["🧮 *余额缓存校验*", "━━━━━━━━━━━━━━━━━━━━"]
+        if mismatches:
+            report.append(f"⚠️ 发现 {len(mismatches)} 处不一致：")
+            for customer, currency, cached, actual in mismatches[:30]:
+                cached_str = f"{cached:,.2f}" if cached is not None else "无"
+                actual_str = f"{actual:,.2f}" if actual is not None else "无"
+                report.append(f"▫️ {customer} {currency}: 缓存 {cached_str} / 数据库 {actual_str}")
+            if len(mismatches) > 30:
+                report.append(f"… 另有 {len(mismatches) - 30} 处")
+        else:
+            report.append("✅ 缓存与数据库一致")
+        if rebuild:
+            report.append("🔄 缓存已从数据库重建")
+        await update.message.reply_text("\n".join(report))
+    except Exception as e:
+        logger.error(f"缓存校验失败: {str(e)}", exc_info=True)
+        await update.message.reply_text("❌ 校验失败")
                 
+async def scheduler_metrics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """查看命令调度器各队列的运行数、排队深度与排队耗时"""
+    if not is_admin(update):
+        await update.message.reply_text("⛔ 仅管理员可用")
+        return
+
+    names = {'ledger': '账务操作', 'query': '查询', 'report': '报表'}
+    report = ["📈 *调度队列状态*", "━━━━━━━━━━━━━━━━━━━━"]
+    for cls, m in scheduler.metrics().items():
+        queue_limit = m['queue_limit'] or '不限'
+        report.append(
+            f"🔘 {names.get(cls, cls)} ({cls})\n"
+            f"▸ 运行中：{m['running']}/{m['limit']} | 排队：{m['waiting']}/{queue_limit}\n"
+            f"▸ 完成：{m['completed']} | 拒绝：{m['shed']} | 失败：{m['failed']}\n"
+            f"▸ 排队耗时：平均 {m['wait_avg'] * 1000:.1f}ms | P95 {m['wait_p95'] * 1000:.1f}ms | 最大 {m['wait_max'] * 1000:.1f}ms"
+        )
+    report.append(f"🗂 报表缓存：{len(report_cache)} 条 | 命中：{report_cache.hits} | 未命中：{report_cache.misses}")
+    await update.message.reply_text("\n".join(report))
+
+async def handler_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """查看各命令的耗时分位数、数据库耗时、SQL 语句数与发送字节数"""
+    if not is_admin(update):
+        await update.message.reply_text("⛔ 仅管理员可用")
+        return
+
+    report = ["⏱ *命令运行统计*", "━━━━━━━━━━━━━━━━━━━━"]
+    for command, m in sorted(handler_metrics.commands.items(), key=lambda item: -item[1]['seconds'].count):
+        seconds, db_seconds, statements = m['seconds'], m['db_seconds'], m['statements']
+        report.append(
+            f"🔘 /{command} × {seconds.count}" + (f"（异常 {m['errors']}）" if m['errors'] else "") + "\n"
+            f"▸ 耗时：P50 {seconds.percentile(0.5) * 1000:.1f}ms | P95 {seconds.percentile(0.95) * 1000:.1f}ms"
+            f" | P99 {seconds.percentile(0.99) * 1000:.1f}ms | 最大 {seconds.max * 1000:.1f}ms\n"
+            f"▸ 数据库：P50 {db_seconds.percentile(0.5) * 1000:.1f}ms | P95 {db_seconds.percentile(0.95) * 1000:.1f}ms"
+            f" | 平均 {statements.sum / statements.count:.1f} 条SQL\n"
+            f"▸ 发送：{m['bytes_sent'] / seconds.count / 1024:.1f}KB/次"
+            + (f"\n▸ ⚠️ 重复语句（N+1 嫌疑）：{m['repeated']} 次" if m['repeated'] else "")
+        )
+    if len(report) == 2:
+        report.append("暂无数据")
+    await update.message.reply_text("\n".join(report))
+
 # ================== 支出管理模块 ==================
+def record_expense(session, amount: float, currency: str, purpose: str):
+    """记录公司支出并扣减公司余额"""
+    expense = Expense(
+        amount=amount,
+        currency=currency,
+        purpose=purpose,
+        timestamp=datetime.now()
+    )
+    session.add(expense)
+    apply_balance_legs(session, [('COMPANY', currency, -amount)])
+    apply_rollup_deltas(session, [
+        (expense.timestamp.date(), currency, {'expense': amount, 'expense_count': 1})
+    ])
+
 async def add_expense(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """记录公司支出"""
-    session = Session()
     try:
         args = context.args
         if len(args) < 2:
@@ -618,14 +2585,8 @@ async def add_expense(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ 金额格式错误！示例: /expense 100USD 办公室租金")
             return
 
-        expense = Expense(
-            amount=amount,
-            currency=currency,
-            purpose=purpose
-        )
-        session.add(expense)
-        update_balance(session, 'COMPANY', currency, -amount)
-        session.commit()
+        async with customer_locks.hold('COMPANY'):
+            await run_write(record_expense, amount, currency, purpose)
         
         await update.message.reply_text(
             f"💸 *支出记录已添加* ✅\n"
@@ -635,61 +2596,110 @@ async def add_expense(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"📌 公司余额已自动更新！"
         )
     except Exception as e:
-        session.rollback()
         logger.error(f"支出记录失败: {str(e)}")
         await update.message.reply_text("❌ 记录失败")
-    finally:
-        Session.remove()
+
+def order_customer(session, order_id: str):
+    """订单所属客户，找不到时返回 None"""
+    return session.query(Transaction.customer_name).filter_by(order_id=order_id).scalar()
+
+def revert_transaction(session, order_id: str):
+    """撤销交易并恢复余额，返回被撤销交易的摘要；找不到时返回 None"""
+    tx = session.query(Transaction).filter_by(order_id=order_id).first()
+    if not tx:
+        return None
+
+    # 计算实际交易金额（根据运算符）
+    if tx.operator == '/':
+        quote_amount = tx.amount / tx.rate
+    else:
+        quote_amount = tx.amount * tx.rate
+
+    # 撤销初始交易影响
+    if tx.transaction_type == 'buy':
+        # 反向操作：
+        apply_balance_legs(session, [
+            (tx.customer_name, tx.base_currency, -tx.amount),    # 扣除获得的基础货币
+            (tx.customer_name, tx.quote_currency, quote_amount),  # 恢复支付的报价货币
+        ])
+    else:
+        apply_balance_legs(session, [
+            (tx.customer_name, tx.base_currency, tx.amount),      # 恢复支付的基础货币
+            (tx.customer_name, tx.quote_currency, -quote_amount),  # 扣除获得的报价货币
+        ])
+
+    summary = {
+        'transaction_type': tx.transaction_type,
+        'base_currency': tx.base_currency,
+        'quote_currency': tx.quote_currency,
+        'amount': tx.amount,
+        'quote_amount': quote_amount,
+    }
+    apply_rollup_deltas(session, transaction_rollup_deltas(tx, sign=-1))
+    after_commit(session, lambda: open_orders.remove(order_id))
+    session.delete(tx)
+    return summary
 
 async def cancel_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """撤销交易并恢复初始余额"""
-    session = Session()
     try:
         if not context.args:
             await update.message.reply_text("❌ 需要订单号！用法: /cancel YS000000001")
             return
 
         order_id = context.args[0].upper()
-        tx = session.query(Transaction).filter_by(order_id=order_id).first()
+        customer = await run_db(order_customer, order_id)
+        async with customer_locks.hold(customer):
+            tx = await run_write(revert_transaction, order_id)
         if not tx:
             await update.message.reply_text("❌ 找不到该交易")
             return
 
-        # 计算实际交易金额（根据运算符）
-        if tx.operator == '/':
-            quote_amount = tx.amount / tx.rate
-        else:
-            quote_amount = tx.amount * tx.rate
-
-        # 撤销初始交易影响
-        if tx.transaction_type == 'buy':
-            # 反向操作：
-            update_balance(session, tx.customer_name, tx.base_currency, -tx.amount)  # 扣除获得的基础货币
-            update_balance(session, tx.customer_name, tx.quote_currency, quote_amount)  # 恢复支付的报价货币
-        else:
-            update_balance(session, tx.customer_name, tx.base_currency, tx.amount)  # 恢复支付的基础货币
-            update_balance(session, tx.customer_name, tx.quote_currency, -quote_amount)  # 扣除获得的报价货币
-
-        session.delete(tx)
-        session.commit()
-
+        quote_amount = tx['quote_amount']
         await update.message.reply_text(
             f"✅ 交易 {order_id} 已撤销\n"
             f"━━━━━━━━━━━━━━\n"
-            f"▸ {tx.base_currency} 调整：{-tx.amount if tx.transaction_type == 'buy' else tx.amount:+,.2f}\n"
-            f"▸ {tx.quote_currency} 调整：{quote_amount if tx.transaction_type == 'buy' else -quote_amount:+,.2f}"
+            f"▸ {tx['base_currency']} 调整：{-tx['amount'] if tx['transaction_type'] == 'buy' else tx['amount']:+,.2f}\n"
+            f"▸ {tx['quote_currency']} 调整：{quote_amount if tx['transaction_type'] == 'buy' else -quote_amount:+,.2f}"
         )
 
     except Exception as e:
-        session.rollback()
         logger.error(f"撤销失败: {str(e)}")
         await update.message.reply_text(f"❌ 撤销失败: {str(e)}")
-    finally:
-        Session.remove()
+
+def purge_customer(session, customer_name: str) -> dict:
+    """删除客户及其余额、交易、调整记录，返回各类删除条数"""
+    # 删除所有相关记录（使用事务保证原子性）
+    with session.begin_nested():
+        # 删除余额记录（须先于客户资料删除，否则关系映射会把余额的客户外键置空）
+        balance_count = session.query(Balance).filter_by(customer_name=customer_name).delete()
+
+        # 删除客户基本信息（如果存在）
+        customer = session.query(Customer).filter_by(name=customer_name).first()
+        if customer:
+            session.delete(customer)
+        
+        # 删除交易记录（先从日汇总中扣除这些交易的贡献）
+        apply_rollup_deltas(session, [
+            (row.day, row.currency, {field: -getattr(row, field) for field in ROLLUP_FIELDS})
+            for row in session.execute(rollup_source_query(customer_name))
+        ])
+        tx_count = session.query(Transaction).filter_by(customer_name=customer_name).delete()
+        
+        # 删除调整记录
+        adj_count = session.query(Adjustment).filter_by(customer_name=customer_name).delete()
+
+    after_commit(session, lambda: balance_cache.drop_customer(customer_name))
+    after_commit(session, lambda: open_orders.drop_customer(customer_name))
+    return {
+        'balances': balance_count,
+        'transactions': tx_count,
+        'adjustments': adj_count,
+        'customer': 1 if customer else 0,
+    }
 
 async def delete_customer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """删除客户及其所有相关数据"""
-    session = Session()
     try:
         args = context.args
         if not args:
@@ -697,78 +2707,195 @@ async def delete_customer(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         customer_name = args[0]
 
-        # 删除所有相关记录（使用事务保证原子性）
-        with session.begin_nested():
-            # 删除客户基本信息（如果存在）
-            customer = session.query(Customer).filter_by(name=customer_name).first()
-            if customer:
-                session.delete(customer)
-                
-            # 删除余额记录
-            balance_count = session.query(Balance).filter_by(customer_name=customer_name).delete()
-            
-            # 删除交易记录
-            tx_count = session.query(Transaction).filter_by(customer_name=customer_name).delete()
-            
-            # 删除调整记录
-            adj_count = session.query(Adjustment).filter_by(customer_name=customer_name).delete()
-
-        session.commit()
+        async with customer_locks.hold(customer_name):
+            counts = await run_write(purge_customer, customer_name)
 
         response = (
             f"✅ 客户 *{customer_name}* 数据已清除\n"
             f"━━━━━━━━━━━━━━━━━━━━━━\n"
-            f"▫️ 删除余额记录：{balance_count} 条\n"
-            f"▫️ 删除交易记录：{tx_count} 条\n"
-            f"▫️ 删除调整记录：{adj_count} 条\n"
-            f"▫️ 删除客户资料：{1 if customer else 0} 条\n\n"
+            f"▫️ 删除余额记录：{counts['balances']} 条\n"
+            f"▫️ 删除交易记录：{counts['transactions']} 条\n"
+            f"▫️ 删除调整记录：{counts['adjustments']} 条\n"
+            f"▫️ 删除客户资料：{counts['customer']} 条\n\n"
             f"⚠️ 该操作不可逆，所有相关数据已从数据库中清除"
         )
         await update.message.reply_text(response, parse_mode="Markdown")
 
     except Exception as e:
-        session.rollback()
         logger.error(f"删除客户失败: {str(e)}", exc_info=True)
         await update.message.reply_text(
             "❌ 删除操作失败！\n"
             "⚠️ 错误详情请查看服务器日志"
         )
-    finally:
-        Session.remove()
 
 # ================== 支出管理模块（续） ==================
+EXPENSES_PAGE = int(os.environ.get('FX_EXPENSES_PAGE', '20'))  # /expenses 每页条数
+EXPENSES_USAGE = "格式: /expenses [DD/MM/YYYY-DD/MM/YYYY] [货币] [summary] [p分页标记]"
+
+def parse_expense_args(args: list) -> dict:
+    """解析 /expenses 参数：日期范围、货币、summary（汇总）与分页标记 p<编号>，顺序不限"""
+    options = {'start_date': None, 'end_date': None, 'currency': None, 'summary': False, 'cursor': None}
+    for arg in args:
+        if re.fullmatch(r'p\d+', arg):
+            options['cursor'] = int(arg[1:])
+        elif arg.lower() in ('summary', '汇总'):
+            options['summary'] = True
+        elif '/' in arg:
+            options['start_date'], options['end_date'] = parse_date_range(arg)
+        elif re.fullmatch(r'[A-Za-z]{3,4}', arg):
+            options['currency'] = arg.upper()
+        else:
+            raise ValueError(f"无法识别的参数: {arg}\n{EXPENSES_USAGE}")
+    return options
+
+def expense_page_lines(session, start_date=None, end_date=None, currency=None, cursor=None):
+    """生成一页支出记录（按时间倒序），有下一页时附上翻页命令；无记录时不产生任何内容"""
+    after = None
+    if cursor:
+        anchor = session.get(Expense, cursor)
+        if anchor is None:
+            raise ValueError("分页标记无效，请重新执行 /expenses")
+        after = (anchor.timestamp, anchor.id)
+    expenses = expenses_page_query(session, start_date, end_date, currency, after).limit(EXPENSES_PAGE + 1).all()
+    if not expenses:
+        return
+
+    yield "📋 公司支出记录"
+    yield "━━━━━━━━━━━━━━━"
+    for exp in expenses[:EXPENSES_PAGE]:
+        yield (
+            f"▫️ {exp.timestamp.strftime('%Y-%m-%d %H:%M')}\n"
+            f"金额: {exp.amount:,.2f} {exp.currency}\n"
+            f"用途: {exp.purpose}\n"
+            "━━━━━━━━━━━━━━━"
+        )
+    if len(expenses) > EXPENSES_PAGE:
+        filters_args = [
+            f"{start_date.strftime('%d/%m/%Y')}-{end_date.strftime('%d/%m/%Y')}" if start_date else None,
+            currency, f"p{expenses[EXPENSES_PAGE - 1].id}"
+        ]
+        yield f"➡️ 下一页: /expenses {' '.join(a for a in filters_args if a)}"
+
+def expense_summary_lines(session, start_date=None, end_date=None, currency=None):
+    """生成按月份、货币合计的支出汇总"""
+    rows = session.execute(expense_summary_query(start_date, end_date, currency)).all()
+    if not rows:
+        return
+
+    yield "📊 支出月度汇总"
+    yield "━━━━━━━━━━━━━━━"
+    month = None
+    for row in rows:
+        if row.month != month:
+            month = row.month
+            yield f"📅 {month}"
+        yield f"▫️ {row.currency}: {row.amount:,.2f}（{row.count}笔）"
+
 async def list_expenses(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """查询支出记录"""
-    session = Session()
+    """分页查询支出记录，或按月份与货币汇总"""
     try:
-        expenses = session.query(Expense).order_by(Expense.timestamp.desc()).all()
-        if not expenses:
-            await update.message.reply_text("📝 当前无支出记录")
+        try:
+            options = parse_expense_args(context.args or [])
+        except ValueError as e:
+            await update.message.reply_text(f"❌ {str(e)}")
             return
 
-        report = ["📋 公司支出记录", "━━━━━━━━━━━━━━━"]
-        for exp in expenses:
-            report.append(
-                f"▫️ {exp.timestamp.strftime('%Y-%m-%d %H:%M')}\n"
-                f"金额: {exp.amount:,.2f} {exp.currency}\n"
-                f"用途: {exp.purpose}\n"
-                "━━━━━━━━━━━━━━━"
-            )
-        
-        # 分页发送防止消息过长
-        full_report = "\n".join(report)
-        for i in range(0, len(full_report), 4000):
-            await update.message.reply_text(full_report[i:i+4000])
+        filters_args = (options['start_date'], options['end_date'], options['currency'])
+        if options['summary']:
+            sent = await reply_stream(update, expense_summary_lines, *filters_args)
+        else:
+            sent = await reply_stream(update, expense_page_lines, *filters_args, options['cursor'])
+        if not sent:
+            await update.message.reply_text("📝 当前无支出记录")
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {str(e)}")
     except Exception as e:
         logger.error(f"支出查询失败: {str(e)}")
         await update.message.reply_text("❌ 查询失败")
-    finally:
-        Session.remove()
 
 # ================== 报表生成模块 ==================
+def build_pnl_report(session, start_date: datetime, end_date: datetime, excel_mode: bool):
+    """计算盈亏报告，Excel模式返回各工作表的记录，否则返回文本"""
+    # 货币汇总完全在SQL中计算，只有Excel明细才需要逐行读取
+    currency_report, tx_count, expense_count = pnl_totals(session, start_date, end_date)
+
+    # ================== Excel报表生成 ==================
+    if excel_mode:
+        txs = transactions_in_range_query(session, start_date, end_date).with_entities(*TX_REPORT_COLUMNS).all()
+        expenses = expenses_in_range_query(session, start_date, end_date).all()
+
+        # 交易明细
+        tx_data = []
+        st = settlements(txs)
+        for tx, total_quote, settled_base, settled_quote, base_progress, quote_progress, done in zip(
+                txs, st.total_quote, st.settled_base, st.settled_quote, st.base_progress, st.quote_progress, st.done):
+            status = "已完成" if done else "进行中"
+
+            tx_data.append({
+                "订单号": tx.order_id,
+                "客户名称": tx.customer_name,
+                "交易类型": '买入' if tx.transaction_type == 'buy' else '卖出',
+                "基础货币总额": f"{tx.amount:,.2f} {tx.base_currency}",
+                "报价货币总额": f"{total_quote:,.2f} {tx.quote_currency}",
+                "已结基础货币": f"{settled_base:,.2f} {tx.base_currency}",
+                "已结报价货币": f"{settled_quote:,.2f} {tx.quote_currency}",  # 新增结算金额
+                "基础货币进度": f"{base_progress:.1%}",
+                "报价货币进度": f"{quote_progress:.1%}",
+                "状态": status
+            })
+
+        # 货币汇总
+        currency_data = []
+        for curr, data in currency_report.items():
+            currency_data.append({
+                "货币": curr,
+                "实际收入": f"{data['actual_income']:,.2f}",
+                "实际支出": f"{data['actual_expense']:,.2f}",
+                "应收未收": f"{data['pending_income']:,.2f}",
+                "应付未付": f"{data['pending_expense']:,.2f}",
+                "信用余额": f"{data['credit_balance']:,.2f}",
+                "净盈亏": f"{data['actual_income'] - data['actual_expense']:,.2f}"
+            })
+
+        # 支出记录
+        expense_data = [{
+            "日期": exp.timestamp.strftime('%Y-%m-%d'),
+            "金额": f"{exp.amount:,.2f}",
+            "货币": exp.currency,
+            "用途": exp.purpose
+        } for exp in expenses]
+
+        # 生成Excel
+        return [
+            ("交易明细", tx_data),
+            ("货币汇总", currency_data),
+            ("支出记录", expense_data)
+        ]
+
+    # ================== 生成文本报告 ==================
+    report = [
+        f"📊 *盈亏报告* ({start_date.strftime('%d/%m/%Y')} - {end_date.strftime('%d/%m/%Y')})",
+        f"▫️ 有效交易：{tx_count}笔 | 支出记录：{expense_count}笔",
+        "━━━━━━━━━━━━━━━━━━━━━━━━━━"
+    ]
+
+    for curr, data in currency_report.items():
+        profit = data['actual_income'] - data['actual_expense']
+        report.append(
+            f"🔘 *{curr}* 货币\n"
+            f"▸ 实际收入：{data['actual_income']:+,.2f}\n"
+            f"▸ 实际支出：{data['actual_expense']:+,.2f}\n"
+            f"▸ 应收未收：{data['pending_income']:,.2f}\n"
+            f"▸ 应付未付：{data['pending_expense']:,.2f}\n"
+            f"▸ 信用余额：{data['credit_balance']:,.2f}\n"
+            f"🏁 净盈亏：{profit:+,.2f}\n"
+            "━━━━━━━━━━━━━━━━━━"
+        )
+
+    return "\n".join(report)
+
 async def pnl_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """生成精准的货币独立盈亏报告（针对订单计算盈亏）"""
-    session = Session()
     try:
         # 解析参数
         args = context.args or []
@@ -784,169 +2911,96 @@ async def pnl_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return
         else:
             now = datetime.now()
-            start_date = now.replace(day=1, hour=0, minute=0, second=0)
+            start_date = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
             end_date = now.replace(day=calendar.monthrange(now.year, now.month)[1], 
-                                hour=23, minute=59, second=59)
-
-        # 获取交易记录和支出记录
-        txs = session.query(Transaction).filter(
-            Transaction.timestamp.between(start_date, end_date)
-        ).all()
-        
-        expenses = session.query(Expense).filter(
-            Expense.timestamp.between(start_date, end_date)
-        ).all()
-
-        # 初始化货币报告
-        currency_report = defaultdict(lambda: {
-            'actual_income': 0.0,  # 实际收入（已结算）
-            'actual_expense': 0.0,  # 实际支出（已结算）
-            'pending_income': 0.0,  # 应收未收
-            'pending_expense': 0.0,  # 应付未付
-            'credit_balance': 0.0,  # 客户多付的信用余额
-            'total_income': 0.0,    # 总应收款
-            'total_expense': 0.0,   # 总应付款
-            'expense': 0.0          # 支出
-        })
+                                hour=23, minute=59, second=59, microsecond=0)
 
-        # 处理交易记录
-        for tx in txs:
-            # 根据运算符计算报价货币金额
-            if tx.operator == '/':
-                total_quote = tx.amount / tx.rate
-            else:
-                total_quote = tx.amount * tx.rate
-
-            if tx.transaction_type == 'buy':
-                # 买入交易：客户支付报价货币，获得基础货币
-                currency_report[tx.quote_currency]['total_income'] += total_quote  # 总应收款
-                currency_report[tx.quote_currency]['actual_income'] += tx.settled_in  # 已收款
-                currency_report[tx.quote_currency]['pending_income'] += total_quote - tx.settled_in  # 应收未收
-                currency_report[tx.base_currency]['total_expense'] += tx.amount  # 总应付款
-                currency_report[tx.base_currency]['actual_expense'] += tx.settled_out  # 已付款
-                currency_report[tx.base_currency]['pending_expense'] += tx.amount - tx.settled_out  # 应付未付
-            else:
-                # 卖出交易：客户支付基础货币，获得报价货币
-                currency_report[tx.base_currency]['total_income'] += tx.amount  # 总应收款
-                currency_report[tx.base_currency]['actual_income'] += tx.settled_in  # 已收款
-                currency_report[tx.base_currency]['pending_income'] += tx.amount - tx.settled_in  # 应收未收
-                currency_report[tx.quote_currency]['total_expense'] += total_quote  # 总应付款
-                currency_report[tx.quote_currency]['actual_expense'] += tx.settled_out  # 已付款
-                currency_report[tx.quote_currency]['pending_expense'] += total_quote - tx.settled_out  # 应付未付
-
-        # 处理支出记录
-        for exp in expenses:
-            currency_report[exp.currency]['expense'] += exp.amount
-            currency_report[exp.currency]['actual_expense'] += exp.amount
-
-        # 计算客户多付的信用余额
-        for currency, data in currency_report.items():
-            # 信用余额 = 已收款 - 总应收款
-            data['credit_balance'] = max(0, data['actual_income'] - data['total_income'])
-
-        # ================== Excel报表生成 ==================
         if excel_mode:
-            # 交易明细
-            tx_data = []
-            for tx in txs:
-                if tx.operator == '/':
-                    total_quote = tx.amount / tx.rate
-                else:
-                    total_quote = tx.amount * tx.rate
+            data = await cached_report(('pnl', start_date, end_date, 'excel'),
+                                       lambda: render_report(build_pnl_report, start_date, end_date, True))
+            await update.message.reply_document(
+                document=BytesIO(data),
+                filename=f"盈亏报告_{start_date.strftime('%Y%m%d')}-{end_date.strftime('%Y%m%d')}.xlsx",
+                caption="📊 包含货币独立盈亏的Excel报告"
+            )
+            return
 
-                # 结算金额计算
-                settled_base = tx.settled_out if tx.transaction_type == 'buy' else tx.settled_in
-                settled_quote = tx.settled_in if tx.transaction_type == 'buy' else tx.settled_out
-    
-                # 计算双货币进度
-                base_progress = settled_base / tx.amount if tx.amount != 0 else 0
-                quote_progress = settled_quote / total_quote if total_quote != 0 else 0
-                min_progress = min(base_progress, quote_progress)
-    
-                # 状态判断（取整后判断）
-                base_done = int(settled_base) >= int(tx.amount)
-                quote_done = int(settled_quote) >= int(total_quote)
-                status = "已完成" if base_done and quote_done else "进行中"
+        result = await cached_report(('pnl', start_date, end_date),
+                                     lambda: run_report(build_pnl_report, start_date, end_date, False))
+        await update.message.reply_text(result)
+
+    except Exception as e:
+        logger.error(f"盈亏报告生成失败: {str(e)}", exc_info=True)
+        await update.message.reply_text("❌ 报告生成失败，请检查日志")
 
-                tx_data.append({
+def build_detailed_report(session, start_date: datetime, end_date: datetime, excel_mode: bool):
+    """生成交易结算明细，Excel模式返回各工作表的记录（无交易时返回 None），否则返回文本"""
+    txs = transactions_in_range_query(session, start_date, end_date).with_entities(*TX_REPORT_COLUMNS).all()
+    st = settlements(txs)
+
+    # Excel生成修正
+    if excel_mode:
+        tx_data = []
+        for tx, total_quote, settled_base, settled_quote, base_progress, quote_progress, done in zip(
+                txs, st.total_quote, st.settled_base, st.settled_quote, st.base_progress, st.quote_progress, st.done):
+            try:
+                # settled_base 买入为公司已支付、卖出为客户已支付的基础货币；settled_quote 相反
+                status = "已完成" if done else "进行中"
+
+                record = {
                     "订单号": tx.order_id,
                     "客户名称": tx.customer_name,
                     "交易类型": '买入' if tx.transaction_type == 'buy' else '卖出',
                     "基础货币总额": f"{tx.amount:,.2f} {tx.base_currency}",
                     "报价货币总额": f"{total_quote:,.2f} {tx.quote_currency}",
                     "已结基础货币": f"{settled_base:,.2f} {tx.base_currency}",
-                    "已结报价货币": f"{settled_quote:,.2f} {tx.quote_currency}",  # 新增结算金额
-                    "基础货币进度": f"{base_progress:.1%}",
-                    "报价货币进度": f"{quote_progress:.1%}",
-                    "状态": status
-                })
-
-            # 货币汇总
-            currency_data = []
-            for curr, data in currency_report.items():
-                currency_data.append({
-                    "货币": curr,
-                    "实际收入": f"{data['actual_income']:,.2f}",
-                    "实际支出": f"{data['actual_expense']:,.2f}",
-                    "应收未收": f"{data['pending_income']:,.2f}",
-                    "应付未付": f"{data['pending_expense']:,.2f}",
-                    "信用余额": f"{data['credit_balance']:,.2f}",
-                    "净盈亏": f"{data['actual_income'] - data['actual_expense']:,.2f}"
-                })
-
-            # 支出记录
-            expense_data = [{
-                "日期": exp.timestamp.strftime('%Y-%m-%d'),
-                "金额": f"{exp.amount:,.2f}",
-                "货币": exp.currency,
-                "用途": exp.purpose
-            } for exp in expenses]
-
-            # 生成Excel
-            df_dict = {
-                "交易明细": pd.DataFrame(tx_data),
-                "货币汇总": pd.DataFrame(currency_data),
-                "支出记录": pd.DataFrame(expense_data)
-            }
-            
-            excel_buffer = generate_excel_buffer(df_dict, ["交易明细", "货币汇总", "支出记录"])
-            await update.message.reply_document(
-                document=excel_buffer,
-                filename=f"盈亏报告_{start_date.strftime('%Y%m%d')}-{end_date.strftime('%Y%m%d')}.xlsx",
-                caption="📊 包含货币独立盈亏的Excel报告"
-            )
-            return
-        
-        # ================== 生成文本报告 ==================
-        report = [
-            f"📊 *盈亏报告* ({start_date.strftime('%d/%m/%Y')} - {end_date.strftime('%d/%m/%Y')})",
-            f"▫️ 有效交易：{len(txs)}笔 | 支出记录：{len(expenses)}笔",
-            "━━━━━━━━━━━━━━━━━━━━━━━━━━"
+                    "已结报价货币": f"{settled_quote:,.2f} {tx.quote_currency}", 
+                    "基础货币进度": f"{base_progress * 100:.1f}%",
+                    "报价货币进度": f"{quote_progress * 100:.1f}%",
+                    "状态": status  # 使用新的状态判断
+                }
+                tx_data.append(record)
+            except Exception as e:
+                logger.error(f"处理交易 {tx.order_id} 失败: {str(e)}")
+                continue
+
+        if not tx_data:
+            return None
+
+        # 生成信用余额表（信用余额只在此表中列出，不抵扣各笔交易的结算进度）
+        credit_data = [{
+            "客户名称": cb.customer_name,
+            "货币": cb.currency,
+            "信用余额": f"{cb.credit:,.2f}"
+        } for cb in credit_balances_query(session)]
+
+        return [
+            ("交易明细", tx_data),
+            ("信用余额", credit_data)
         ]
-        
-        for curr, data in currency_report.items():
-            profit = data['actual_income'] - data['actual_expense']
-            report.append(
-                f"🔘 *{curr}* 货币\n"
-                f"▸ 实际收入：{data['actual_income']:+,.2f}\n"
-                f"▸ 实际支出：{data['actual_expense']:+,.2f}\n"
-                f"▸ 应收未收：{data['pending_income']:,.2f}\n"
-                f"▸ 应付未付：{data['pending_expense']:,.2f}\n"
-                f"▸ 信用余额：{data['credit_balance']:,.2f}\n"
-                f"🏁 净盈亏：{profit:+,.2f}\n"
-                "━━━━━━━━━━━━━━━━━━"
-            )
-            
-        await update.message.reply_text("\n".join(report))
 
-    except Exception as e:
-        logger.error(f"盈亏报告生成失败: {str(e)}", exc_info=True)
-        await update.message.reply_text("❌ 报告生成失败，请检查日志")
-    finally:
-        Session.remove()
+    # 文本报告生成
+    report = [
+        f"📋 交易结算明细报告 ({start_date.strftime('%d/%m/%Y')} - {end_date.strftime('%d/%m/%Y')}",
+        f"总交易数: {len(txs)}",
+        "━━━━━━━━━━━━━━━━━━"
+    ]
+
+    for tx, total_quote, base_settled, quote_settled, done in zip(
+            txs, st.total_quote, st.settled_base, st.settled_quote, st.done):
+        report.append(
+            f"📌 {tx.timestamp.strftime('%d/%m %H:%M')} {tx.order_id}\n"
+            f"{tx.customer_name} {'买入' if tx.transaction_type == 'buy' else '卖出'} "
+            f"{tx.amount:,.2f} {tx.base_currency} @ {tx.rate:.4f}\n"
+            f"▸ 应付基础货币: {tx.amount:,.2f} {tx.base_currency} (已结: {base_settled:,.2f})\n"
+            f"▸ 应付报价货币: {total_quote:,.2f} {tx.quote_currency} (已结: {quote_settled:,.2f})\n"
+            f"▸ 状态: {'✅ 已完成' if done else '🟡 进行中'}"
+            "━━━━━━━━━━━━━━━━━━"
+        )
+
+    return "\n".join(report)
 
 async def generate_detailed_report(update: Update, context: ContextTypes.DEFAULT_TYPE, period: str):
-    session = Session()
     try:
         args = context.args or []
         excel_mode = 'excel' in args
@@ -966,171 +3020,148 @@ async def generate_detailed_report(update: Update, context: ContextTypes.DEFAULT
                 return
         else:
             now = datetime.now()
-            start_date = now.replace(day=1, hour=0, minute=0, second=0)
+            start_date = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
             end_date = now.replace(day=calendar.monthrange(now.year, now.month)[1], 
-                                hour=23, minute=59, second=59)
+                                hour=23, minute=59, second=59, microsecond=0)
 
-        # 获取交易记录和客户信用余额
-        txs = session.query(Transaction).filter(
-            Transaction.timestamp.between(start_date, end_date)
-        ).all()
-        
-        # 获取所有客户的信用余额
-        credit_balances = session.query(
-            Balance.customer_name,
-            Balance.currency,
-            func.sum(Balance.amount).label('credit')
-        ).filter(Balance.amount > 0).group_by(Balance.customer_name, Balance.currency).all()
-
-        # Excel生成修正
         if excel_mode:
-            tx_data = []
-            for tx in txs:
-                try:
-                    # 计算应付总额和信用余额
-                    if tx.operator == '/':
-                        total_quote = tx.amount / tx.rate
-                    else:
-                        total_quote = tx.amount * tx.rate
-                        
-                    # 获取该客户的信用余额
-                    credit = next(
-                        (cb.credit for cb in credit_balances 
-                         if cb.customer_name == tx.customer_name 
-                         and cb.currency == tx.quote_currency),
-                        0.0
-                    )
-
-                    # 根据交易类型确定结算逻辑
-                    if tx.transaction_type == 'buy':
-                        # 买入交易：客户应支付报价货币
-                        required = total_quote
-                        settled = tx.settled_in
-                        credit_used = min(credit, required - settled)
-                    else:
-                        # 卖出交易：客户应支付基础货币
-                        required = tx.amount
-                        settled = tx.settled_in
-                        credit_used = min(credit, required - settled)
-
-                    # 计算实际需要支付的金额
-                    actual_payment = settled + credit_used
-                    remaining = required - actual_payment
-                    progress = actual_payment / required if required != 0 else 0
-
-                    # 判断状态
-                    if tx.transaction_type == 'buy':
-                        # 买入交易判断逻辑
-                        base_done = int(tx.settled_out) >= int(tx.amount)  # 公司支付的基础货币
-                        quote_done = int(tx.settled_in) >= int(total_quote)  # 客户支付的报价货币
-                    else:
-                        # 卖出交易判断逻辑
-                        base_done = int(tx.settled_in) >= int(tx.amount)    # 客户支付的基础货币
-                        quote_done = int(tx.settled_out) >= int(total_quote) # 公司支付的报价货币
-
-                    status = "已完成" if base_done and quote_done else "进行中"    
-
-                    if tx.transaction_type == 'buy':
-                        settled_base = tx.settled_out  # 公司已支付的基础货币
-                        settled_quote = tx.settled_in  # 客户已支付的报价货币
-                    else:
-                        settled_base = tx.settled_in   # 客户已支付的基础货币
-                        settled_quote = tx.settled_out # 公司已支付的报价货币                        
-
-                    record = {
-                        "订单号": tx.order_id,
-                        "客户名称": tx.customer_name,
-                        "交易类型": '买入' if tx.transaction_type == 'buy' else '卖出',
-                        "基础货币总额": f"{tx.amount:,.2f} {tx.base_currency}",
-                        "报价货币总额": f"{total_quote:,.2f} {tx.quote_currency}",
-                        "已结基础货币": f"{settled_base:,.2f} {tx.base_currency}",
-                        "已结报价货币": f"{settled_quote:,.2f} {tx.quote_currency}", 
-                        "基础货币进度": f"{(tx.settled_out / tx.amount * 100):.1f}%" if tx.transaction_type == 'buy' else f"{(tx.settled_in / tx.amount * 100):.1f}%",
-                        "报价货币进度": f"{(tx.settled_in / total_quote * 100):.1f}%" if tx.transaction_type == 'buy' else f"{(tx.settled_out / total_quote * 100):.1f}%",
-                        "状态": status  # 使用新的状态判断
-                    }
-                    tx_data.append(record)
-                except Exception as e:
-                    logger.error(f"处理交易 {tx.order_id} 失败: {str(e)}")
-                    continue
-            
-            if not tx_data:
+            data = await cached_report((period, start_date, end_date, 'excel'),
+                                       lambda: render_report(build_detailed_report, start_date, end_date, True))
+            if data is None:
                 await update.message.reply_text("⚠️ 该时间段内无交易记录")
                 return
-
-            # 生成信用余额表
-            credit_data = [{
-                "客户名称": cb.customer_name,
-                "货币": cb.currency,
-                "信用余额": f"{cb.credit:,.2f}"
-            } for cb in credit_balances]
-
-            df_dict = {
-                "交易明细": pd.DataFrame(tx_data),
-                "信用余额": pd.DataFrame(credit_data)
-            }
-            
-            excel_buffer = generate_excel_buffer(df_dict, ["交易明细", "信用余额"])
             await update.message.reply_document(
-                document=excel_buffer,
+                document=BytesIO(data),
                 filename=f"交易明细_{start_date.strftime('%Y%m%d')}-{end_date.strftime('%Y%m%d')}.xlsx",
                 caption="📊 包含信用对冲的Excel交易明细"
             )
             return
 
-        # 文本报告生成
-        report = [
-            f"📋 交易结算明细报告 ({start_date.strftime('%d/%m/%Y')} - {end_date.strftime('%d/%m/%Y')}",
-            f"总交易数: {len(txs)}",
-            "━━━━━━━━━━━━━━━━━━"
-        ]
+        result = await cached_report((period, start_date, end_date),
+                                     lambda: run_report(build_detailed_report, start_date, end_date, False))
+        await update.message.reply_text(result)
         
-        for tx in txs:
-            # 计算应付总额
-            if tx.operator == '/':
-                total_quote = tx.amount / tx.rate
-            else:
-                total_quote = tx.amount * tx.rate
-
-            # 获取信用余额
-            credit = next(
-                (cb.credit for cb in credit_balances 
-                 if cb.customer_name == tx.customer_name 
-                 and cb.currency == (tx.quote_currency if tx.transaction_type == 'buy' else tx.base_currency)),
-                0.0
-            )
+    except Exception as e:
+        logger.error(f"交易报表生成失败: {str(e)}")
+        await update.message.reply_text("❌ 生成失败")
+                
+def build_customer_statement(session, customer: str, start_date: datetime, end_date: datetime):
+    """生成 Excel 客户对账单各工作表的记录"""
+    # 获取数据
+    balances = customer_balances_query(session, customer).all()
+    txs = customer_transactions_query(session, customer, start_date, end_date).with_entities(*TX_REPORT_COLUMNS).all()
+    st = settlements(txs)
+
+    adjs = customer_adjustments_query(session, customer, start_date, end_date).all()
+
+    # 交易明细
+    tx_data = []
+    # 买入：基础货币由公司支付（settled_out），报价货币由客户支付（settled_in）；卖出相反
+    for tx, total_quote, settled_base, settled_quote, min_progress, done in zip(
+            txs, st.total_quote, st.settled_base, st.settled_quote, st.min_progress, st.done):
+        status = "已完成" if done else "进行中"
+        tx_data.append({
+            "日期": tx.timestamp.strftime('%Y-%m-%d'),
+            "订单号": tx.order_id,
+            "交易类型": '买入' if tx.transaction_type == 'buy' else '卖出',
+            "基础货币总额": f"{tx.amount:,.2f} {tx.base_currency}",
+            "报价货币总额": f"{total_quote:,.2f} {tx.quote_currency}",
+            "已结基础货币": f"{settled_base:,.2f} {tx.base_currency}",
+            "已结报价货币": f"{settled_quote:,.2f} {tx.quote_currency}",
+            "进度": f"{min_progress:.1%}",
+            "状态": status
+        })
 
-            # 状态判断
-            required = total_quote if tx.transaction_type == 'buy' else tx.amount
-            settled = tx.settled_in
-            remaining = required - settled - min(credit, required - settled)
-            
-            base_settled = tx.settled_in if tx.transaction_type == 'sell' else tx.settled_out
-            quote_settled = tx.settled_out if tx.transaction_type == 'sell' else tx.settled_in
+    # 余额数据
+    balance_data = [{
+        "货币": b.currency,
+        "余额": f"{b.amount:,.2f}"
+    } for b in balances]
+
+    # 将余额数据添加到交易明细中
+    for balance in balance_data:
+        tx_data.append({
+            "日期": "",
+            "订单号": "",
+            "交易类型": "",
+            "基础货币总额": "",
+            "报价货币总额": "",
+            "已结基础货币": "",
+            "已结报价货币": "",
+            "进度": "",
+            "状态": "",
+            "货币余额": f"{balance['货币']}: {balance['余额']}"
+        })
 
-            status = "✅ 已完成" if abs(remaining) <= 1.00 else f"🟡 部分结算 (剩余: {remaining:,.2f})"
+    # 调整记录
+    adj_data = [{
+        "日期": adj.timestamp.strftime('%Y-%m-%d'),
+        "金额": f"{adj.amount:+,.2f}",
+        "货币": adj.currency,
+        "备注": adj.note
+    } for adj in adjs]
+
+    # 生成Excel
+    return [
+        ("交易明细与余额", tx_data),
+        ("调整记录", adj_data)
+    ]
 
-            report.append(
-                f"📌 {tx.timestamp.strftime('%d/%m %H:%M')} {tx.order_id}\n"
-                f"{tx.customer_name} {'买入' if tx.transaction_type == 'buy' else '卖出'} "
+def customer_statement_header(customer: str, start_date: datetime, end_date: datetime) -> str:
+    """对账单抬头；含生成时间，每次发送时重新生成，不进入报表缓存"""
+    return "\n".join([
+        f"📑 客户对账单 - {customer}",
+        f"日期范围: {start_date.strftime('%d/%m/%Y')} - {end_date.strftime('%d/%m/%Y')}",
+        f"生成时间: {datetime.now().strftime('%d/%m/%Y %H:%M')}",
+        "━━━━━━━━━━━━━━━━━━",
+    ])
+
+def customer_statement_lines(session, customer: str, start_date: datetime, end_date: datetime):
+    """逐条生成客户对账单正文（抬头见 customer_statement_header）；交易按批读取并计算结算进度"""
+    # 余额部分
+    yield "📊 当前余额:"
+    for b in customer_balances_query(session, customer):
+        yield f"• {b.currency}: {b.amount:+,.2f}"
+
+    # 交易记录
+    yield "\n💵 交易记录:"
+    txs = customer_transactions_query(session, customer, start_date, end_date).with_entities(*TX_REPORT_COLUMNS)
+    empty = True
+    for batch in keyset_chunks(txs, (Transaction.timestamp, Transaction.order_id), STREAM_BATCH):
+        empty = False
+        st = settlements(batch)
+        for tx, total_quote, settled_base, settled_quote, base_progress, quote_progress, done in zip(
+                batch, st.total_quote, st.settled_base, st.settled_quote, st.base_progress, st.quote_progress, st.done):
+            status = "已完成" if done else "进行中"
+
+            yield (
+                f"▫️ {tx.timestamp.strftime('%d/%m %H:%M')} {tx.order_id}\n"
+                f"{'买入' if tx.transaction_type == 'buy' else '卖出'} "
                 f"{tx.amount:,.2f} {tx.base_currency} @ {tx.rate:.4f}\n"
-                f"▸ 应付基础货币: {tx.amount:,.2f} {tx.base_currency} (已结: {base_settled:,.2f})\n"
-                f"▸ 应付报价货币: {total_quote:,.2f} {tx.quote_currency} (已结: {quote_settled:,.2f})\n"
-                f"▸ 状态: {'✅ 已完成' if int(base_settled) >= int(tx.amount) and int(quote_settled) >= int(total_quote) else '🟡 进行中'}"
-                "━━━━━━━━━━━━━━━━━━"
+                f"├─ 已结基础货币: {settled_base:,.2f}/{tx.amount:,.2f} {tx.base_currency} ({base_progress:.1%})\n"
+                f"├─ 已结报价货币: {settled_quote:,.2f}/{total_quote:,.2f} {tx.quote_currency} ({quote_progress:.1%})\n"
+                f"└─ 状态: {status}"
             )
-        
-        await update.message.reply_text("\n".join(report))
-        
-    except Exception as e:
-        logger.error(f"交易报表生成失败: {str(e)}")
-        await update.message.reply_text("❌ 生成失败")
-    finally:
-        Session.remove()
-                
+    if empty:
+        yield "无交易记录"
+
+    # 调整记录
+    yield "\n📝 调整记录:"
+    adjs = customer_adjustments_query(session, customer, start_date, end_date).with_entities(
+        Adjustment.id, Adjustment.timestamp, Adjustment.currency, Adjustment.amount, Adjustment.note)
+    empty = True
+    for adj in itertools.chain.from_iterable(
+            keyset_chunks(adjs, (Adjustment.timestamp, Adjustment.id), STREAM_BATCH)):
+        empty = False
+        yield (
+            f"{adj.timestamp.strftime('%d/%m %H:%M')}\n"
+            f"{adj.currency}: {adj.amount:+,.2f} - {adj.note}"
+        )
+    if empty:
+        yield "无调整记录"
+
 async def customer_statement(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """生成客户对账单，支持Excel格式"""
-    session = Session()
     try:
         args = context.args or []
         if not args:
@@ -1152,184 +3183,177 @@ async def customer_statement(update: Update, context: ContextTypes.DEFAULT_TYPE)
         else:
             # 如果没有提供日期范围，默认使用当前月份的范围
             now = datetime.now()
-            start_date = now.replace(day=1, hour=0, minute=0, second=0)
+            start_date = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
             end_date = now.replace(day=calendar.monthrange(now.year, now.month)[1], 
-                                hour=23, minute=59, second=59)
-
-        # 获取数据
-        balances = session.query(Balance).filter_by(customer_name=customer).all()
-        txs = session.query(Transaction).filter(
-            Transaction.customer_name == customer,
-            Transaction.timestamp.between(start_date, end_date)
-        ).all()
-        
-        adjs = session.query(Adjustment).filter(
-            Adjustment.customer_name == customer,
-            Adjustment.timestamp.between(start_date, end_date)
-        ).all()
+                                hour=23, minute=59, second=59, microsecond=0)
 
-        # 生成Excel报表
-        # 生成Excel报表
         if excel_mode:
-            # 交易明细
-            tx_data = []
-            for tx in txs:
-                if tx.operator == '/':
-                    total_quote = tx.amount / tx.rate
-                else:
-                    total_quote = tx.amount * tx.rate
-                # ==== 关键修复1：结算金额与进度计算 ====
-                if tx.transaction_type == 'buy':
-                    # 买入交易：
-                    # - 基础货币（公司支付给客户）：settled_out
-                    # - 报价货币（客户支付给公司）：settled_in
-                    settled_base = tx.settled_out
-                    settled_quote = tx.settled_in
-                    base_progress = settled_base / tx.amount if tx.amount != 0 else 0
-                    quote_progress = settled_quote / total_quote if total_quote != 0 else 0
-                else:
-                    # 卖出交易：
-                    # - 基础货币（客户支付给公司）：settled_in
-                    # - 报价货币（公司支付给客户）：settled_out
-                    settled_base = tx.settled_in
-                    settled_quote = tx.settled_out
-                    base_progress = settled_base / tx.amount if tx.amount != 0 else 0
-                    quote_progress = settled_quote / total_quote if total_quote != 0 else 0
-                # ==== 关键修复2：状态判断 ====
-                base_done = int(settled_base) >= int(tx.amount)
-                quote_done = int(settled_quote) >= int(total_quote)
-                status = "已完成" if base_done and quote_done else "进行中"
-                tx_data.append({
-                    "日期": tx.timestamp.strftime('%Y-%m-%d'),
-                    "订单号": tx.order_id,
-                    "交易类型": '买入' if tx.transaction_type == 'buy' else '卖出',
-                    "基础货币总额": f"{tx.amount:,.2f} {tx.base_currency}",
-                    "报价货币总额": f"{total_quote:,.2f} {tx.quote_currency}",
-                    "已结基础货币": f"{settled_base:,.2f} {tx.base_currency}",
-                    "已结报价货币": f"{settled_quote:,.2f} {tx.quote_currency}",
-                    "进度": f"{min(base_progress, quote_progress):.1%}",
-                    "状态": status
-                })
-    
-            # 余额数据
-            balance_data = [{
-                "货币": b.currency,
-                "余额": f"{b.amount:,.2f}"
-            } for b in balances]
-    
-            # 将余额数据添加到交易明细中
-            for balance in balance_data:
-                tx_data.append({
-                    "日期": "",
-                    "订单号": "",
-                    "交易类型": "",
-                    "基础货币总额": "",
-                    "报价货币总额": "",
-                    "已结基础货币": "",
-                    "已结报价货币": "",
-                    "进度": "",
-                    "状态": "",
-                    "货币余额": f"{balance['货币']}: {balance['余额']}"
-                })
-    
-            # 调整记录
-            adj_data = [{
-                "日期": adj.timestamp.strftime('%Y-%m-%d'),
-                "金额": f"{adj.amount:+,.2f}",
-                "货币": adj.currency,
-                "备注": adj.note
-            } for adj in adjs]
-    
-            # 生成Excel
-            df_dict = {
-                "交易明细与余额": pd.DataFrame(tx_data),
-                "调整记录": pd.DataFrame(adj_data)
-            }
-    
-            excel_buffer = generate_excel_buffer(df_dict, ["交易明细与余额", "调整记录"])
+            data = await cached_report(('creport', customer, start_date, end_date, 'excel'),
+                                       lambda: render_report(build_customer_statement, customer, start_date, end_date))
             await update.message.reply_document(
-                document=excel_buffer,
+                document=BytesIO(data),
                 filename=f"客户对账单_{customer}_{start_date.strftime('%Y%m%d')}-{end_date.strftime('%Y%m%d')}.xlsx",
                 caption=f"📊 {customer} Excel对账单"
             )
             return
 
-        # 生成文本报告
-        report = [
-            f"📑 客户对账单 - {customer}",
-            f"日期范围: {start_date.strftime('%d/%m/%Y')} - {end_date.strftime('%d/%m/%Y')}",
-            f"生成时间: {datetime.now().strftime('%d/%m/%Y %H:%M')}",
-            "━━━━━━━━━━━━━━━━━━"
-        ]
-
-        # 余额部分
-        balance_section = ["📊 当前余额:"]
-        if balances:
-            balance_section += [f"• {b.currency}: {b.amount:+,.2f}" for b in balances]
-        report.extend(balance_section)
-
-        # 交易记录
-        tx_section = ["\n💵 交易记录:"]
-        if txs:
-            for tx in txs:
-                if tx.operator == '/':
-                    total_quote = tx.amount / tx.rate
-                else:
-                    total_quote = tx.amount * tx.rate
-
-                # ==== 关键修复3：文本报表的结算金额与进度 ====
-                if tx.transaction_type == 'buy':
-                    settled_base = tx.settled_out
-                    settled_quote = tx.settled_in
-                else:
-                    settled_base = tx.settled_in
-                    settled_quote = tx.settled_out
-
-                base_progress = settled_base / tx.amount if tx.amount != 0 else 0
-                quote_progress = settled_quote / total_quote if total_quote != 0 else 0
-                base_done = int(settled_base) >= int(tx.amount)
-                quote_done = int(settled_quote) >= int(total_quote)
-                status = "已完成" if base_done and quote_done else "进行中"
-
-                tx_section.append(
-                    f"▫️ {tx.timestamp.strftime('%d/%m %H:%M')} {tx.order_id}\n"
-                    f"{'买入' if tx.transaction_type == 'buy' else '卖出'} "
-                    f"{tx.amount:,.2f} {tx.base_currency} @ {tx.rate:.4f}\n"
-                    f"├─ 已结基础货币: {settled_base:,.2f}/{tx.amount:,.2f} {tx.base_currency} ({base_progress:.1%})\n"
-                    f"├─ 已结报价货币: {settled_quote:,.2f}/{total_quote:,.2f} {tx.quote_currency} ({quote_progress:.1%})\n"
-                    f"└─ 状态: {status}"
-                )
-        else:
-            tx_section.append("无交易记录")
-        report.extend(tx_section)
-
-        # 调整记录
-        adj_section = ["\n📝 调整记录:"]
-        if adjs:
-            for adj in adjs:
-                adj_section.append(
-                    f"{adj.timestamp.strftime('%d/%m %H:%M')}\n"
-                    f"{adj.currency}: {adj.amount:+,.2f} - {adj.note}"
-                )
-        else:
-            adj_section.append("无调整记录")
-        report.extend(adj_section)
-
         # 发送报告
-        full_report = "\n".join(report)
-        for i in range(0, len(full_report), 4000):
-            await update.message.reply_text(full_report[i:i+4000])
+        await reply_cached_stream(update, ('creport', customer, start_date, end_date),
+                                  customer_statement_lines, customer, start_date, end_date,
+                                  header=customer_statement_header(customer, start_date, end_date))
     except Exception as e:
         logger.error(f"对账单生成失败: {str(e)}")
         await update.message.reply_text("❌ 生成失败")
+
+# ================== 多进程部署 ==================
+# 入口进程只负责接收更新（polling 或 webhook），按客户名哈希分发给工作进程；
+# 工作进程运行完整的处理器。同一客户始终落在同一进程，进程内的客户锁、
+# 余额缓存与未结订单索引因此仍然有效；跨进程的写入由 SQLite WAL 与忙等待超时串行化。
+WORKERS = int(os.environ.get('FX_WORKERS', '0'))  # 0 或 1 表示单进程运行
+# 首个参数即客户名的命令
+CUSTOMER_COMMANDS = {'received', 'paid', 'adjust', 'balance', 'debts', 'creport', 'delete_customer'}
+
+def worker_for(key: str, workers: int) -> int:
+    """路由键 -> 工作进程序号（进程重启后保持不变，不能用内置 hash）"""
+    return zlib.crc32(key.encode('utf-8')) % workers
+
+async def route_key(update: Update):
+    """取出更新涉及的客户名作为路由键；与客户无关的更新返回 None"""
+    message = update.effective_message
+    text = (message.text or '').strip() if message else ''
+    if not text:
+        return None
+    if not text.startswith('/'):
+        match = re.match(r'^(\w+)\s+', text)  # 与 handle_transaction 的客户名解析一致
+        return match.group(1) if match else None
+
+    parts = text.split()
+    command = parts[0][1:].split('@')[0].lower()
+    args = parts[1:]
+    if command in CUSTOMER_COMMANDS:
+        return args[0] if args else ('COMPANY' if command == 'balance' else None)
+    if command == 'expense':
+        return 'COMPANY'
+    if command == 'cancel' and args:
+        return await run_db(order_customer, args[0].upper())
+    return None
+
+def build_ingress_application(queues: list):
+    """入口进程的 Application：不注册业务处理器，只把更新转发到工作进程队列"""
+    # 逐条分发，保证同一客户的更新按到达顺序进入工作进程
+    application = application_builder(False).build()
+    round_robin = itertools.count()
+
+    async def dispatch(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        try:
+            key = await route_key(update)
+        except Exception as e:
+            logger.error(f"更新路由失败: {str(e)}")
+            key = None
+        index = worker_for(key, len(queues)) if key else next(round_robin) % len(queues)
+        queues[index].put(update.to_dict())
+
+    application.add_handler(TypeHandler(Update, dispatch))
+    return application
+
+def worker_main(index: int, workers: int, updates):
+    """工作进程入口：加载本进程缓存后处理入口进程转发的更新，收到 None 时退出"""
+    # Ctrl+C 会发给整个进程组：只由入口进程响应，工作进程处理完队列中的更新后随 None 退出
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    setup_logging()
+    balance_cache.owns = open_orders.owns = lambda customer: worker_for(customer, workers) == index
+    handler_metrics.worker = index
+    balance_cache.rebuild()
+    try:
+        asyncio.run(serve_worker(build_application(), updates))
     finally:
-        Session.remove()
+        # 进程池的子进程是非守护进程，工作进程退出前会等待它们，必须先关闭进程池
+        if excel_executor is not None:
+            excel_executor.shutdown()
+
+def next_update(updates):
+    """从入口进程的队列取下一条更新；入口进程已退出（未发送 None）时返回 None"""
+    while True:
+        try:
+            return updates.get(timeout=1)
+        except Empty:
+            if not multiprocessing.parent_process().is_alive():
+                logger.warning("入口进程已退出，工作进程停止")
+                return None
+
+async def serve_worker(application, updates):
+    loop = asyncio.get_running_loop()
+    async with application:
+        await export_metrics(application)
+        await application.start()
+        warm_open_orders()
+        try:
+            while True:
+                data = await loop.run_in_executor(None, next_update, updates)
+                if data is None:
+                    break
+                await application.update_queue.put(Update.de_json(data, application.bot))
+        finally:
+            await application.stop()
+            await stop_metrics(application)
+
+def run_ingress(mode: str, workers: int):
+    """启动工作进程并运行入口进程，退出时通知工作进程处理完已分发的更新"""
+    ctx = multiprocessing.get_context('spawn')
+    queues = [ctx.Queue() for _ in range(workers)]
+    processes = [
+        ctx.Process(target=worker_main, args=(index, workers, queue), name=f"fx-worker-{index}")
+        for index, queue in enumerate(queues)
+    ]
+    # 子进程在导入模块期间就可能收到 Ctrl+C，启动时先让它们继承"忽略 SIGINT"
+    previous = signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        for process in processes:
+            process.start()
+    finally:
+        signal.signal(signal.SIGINT, previous)
+    logger.info(f"已启动 {workers} 个工作进程")
+    try:
+        start_application(build_ingress_application(queues), mode)
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for process in processes:
+            process.join(timeout=30)
 
 # ================== 机器人命令注册 ==================
-def main():
-    run_migrations()  # 新增此行
-    setup_logging()
-    application = ApplicationBuilder().token("7706817515:AAHuQL4myZYqg6HMzejc82RDJTvkMCI8JXo").build()
+# 运行方式：polling（长轮询）或 webhook（本地 HTTP 端点接收 Telegram 推送）
+RUN_MODE = os.environ.get('FX_RUN_MODE', 'polling')
+WEBHOOK_LISTEN = os.environ.get('FX_WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('FX_WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.environ.get('FX_WEBHOOK_PATH', 'telegram')
+WEBHOOK_URL = os.environ.get('FX_WEBHOOK_URL')        # 向 Telegram 登记的外部地址（负载均衡/反向代理入口）
+WEBHOOK_SECRET = os.environ.get('FX_WEBHOOK_SECRET')  # X-Telegram-Bot-Api-Secret-Token 校验
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get('FX_WEBHOOK_MAX_CONNECTIONS', '40'))  # Telegram 并发推送连接数上限
+TELEGRAM_BASE_URL = os.environ.get('FX_TELEGRAM_BASE_URL')  # 指向本地假 Bot API 服务时用于测试
+
+def application_builder(concurrent_updates=False):
+    builder = (
+        ApplicationBuilder()
+        .token("7706817515:AAHuQL4myZYqg6HMzejc82RDJTvkMCI8JXo")
+        .concurrent_updates(concurrent_updates)
+        .rate_limiter(OutboundRateLimiter())
+        .request(CountingRequest(connection_pool_size=256))
+    )
+    if TELEGRAM_BASE_URL:
+        base_url = TELEGRAM_BASE_URL.rstrip('/')
+        builder = builder.base_url(f"{base_url}/bot").base_file_url(f"{base_url}/file/bot")
+    return builder
+
+async def on_startup(application):
+    """Application 初始化完成、开始接收更新前调用"""
+    await export_metrics(application)
+    warm_open_orders()
+
+def build_application():
+    """创建并注册好全部处理器的 Application"""
+    # 同一客户的账务操作由 customer_locks 串行化，不同客户的更新可以并发处理
+    application = application_builder(CONCURRENT_UPDATES or False).post_init(on_startup).post_stop(stop_metrics).build()
     
     handlers = [
         CommandHandler('start', lambda u,c: u.message.reply_text(
@@ -1341,6 +3365,9 @@ def main():
             "▫️ `/debts [客户]` 查看欠款明细 🧾\n"
             "▫️ `/adjust [客户] [货币] [±金额] [备注]` 调整余额 ⚖️\n\n"
             "▫️ `/delete_customer [客户名]` 删除客户及其所有数据 ⚠️\n\n"  # 
+            "▫️ `/cachecheck [rebuild]` 校验/重建余额缓存（管理员）🧮\n"
+            "▫️ `/metrics` 调度队列状态（管理员）📈\n"
+            "▫️ `/stats` 各命令耗时与SQL统计（管理员）⏱\n\n"
             "💸 *交易操作*\n"
             "▫️ `客户A 买 10000USD /4.42 MYR` 创建交易\n"
             "▫️ `/received [客户] [金额+货币]` 登记客户付款\n"
@@ -1351,30 +3378,86 @@ def main():
             "▫️ `/report [日期范围] [excel]` 交易明细 📋\n"
             "▫️ `/creport [客户] [日期范围] [excel]` 客户对账单 📑\n"
             "▫️ `/expense [金额+货币] [用途]` 记录支出 💸\n"
-            "▫️ `/expenses` 支出记录 🧮\n\n"
+            "▫️ `/expenses [日期范围] [货币] [summary]` 支出记录/月度汇总 🧮\n\n"
             "💡 *使用提示*\n"
             "🔸 日期格式：`DD/MM/YYYY-DD/MM/YYYY`\n"
             "🔸 添加 `excel` 参数获取表格文件 📤\n"
             "🔸 示例：`/pnl 01/01/2025-31/03/2025 excel`"
         )),
-        CommandHandler('balance', balance),
-        CommandHandler('debts', list_debts),
-        CommandHandler('adjust', adjust_balance),
-        CommandHandler('received', handle_received),
-        CommandHandler('paid', handle_paid),
-        CommandHandler('cancel', cancel_order),
-        CommandHandler('pnl', pnl_report),
-        CommandHandler('expense', add_expense),
-        CommandHandler('expenses', list_expenses),
-        CommandHandler('creport', customer_statement),
-        CommandHandler('report', lambda u,c: generate_detailed_report(u, c, 'daily')),
-        CommandHandler('delete_customer', delete_customer),
-        MessageHandler(filters.TEXT & ~filters.COMMAND, handle_transaction)
+        CommandHandler('balance', scheduled('query', balance)),
+        CommandHandler('debts', scheduled('query', list_debts)),
+        CommandHandler('adjust', scheduled('ledger', adjust_balance)),
+        CommandHandler('received', scheduled('ledger', handle_received)),
+        CommandHandler('paid', scheduled('ledger', handle_paid)),
+        CommandHandler('cancel', scheduled('ledger', cancel_order)),
+        CommandHandler('pnl', scheduled('report', pnl_report)),
+        CommandHandler('expense', scheduled('ledger', add_expense)),
+        CommandHandler('expenses', scheduled('report', list_expenses)),
+        CommandHandler('creport', scheduled('report', customer_statement)),
+        CommandHandler('report', scheduled('report', lambda u,c: generate_detailed_report(u, c, 'daily'))),
+        CommandHandler('delete_customer', scheduled('ledger', delete_customer)),
+        CommandHandler('cachecheck', scheduled('query', cache_check)),
+        CommandHandler('metrics', scheduler_metrics),
+        CommandHandler('stats', handler_stats),
+        MessageHandler(filters.TEXT & ~filters.COMMAND, scheduled('ledger', handle_transaction))
     ]
+    for handler in handlers:
+        command = next(iter(handler.commands)) if isinstance(handler, CommandHandler) else 'trade'
+        handler.callback = instrumented(command, handler.callback)
     
     application.add_handlers(handlers)
-    logger.info("机器人启动成功")
-    application.run_polling()
+    return application
+
+def start_application(application, mode: str):
+    """以 polling 或 webhook 方式运行 Application，直到收到停止信号"""
+    elapsed = time.perf_counter() - STARTED_AT  # 从模块导入完成到开始接收更新
+    if mode == 'webhook':
+        logger.info(f"机器人启动成功（webhook 模式，监听 {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}，"
+                    f"导入后启动用时 {elapsed:.2f} 秒）")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    else:
+        logger.info(f"机器人启动成功（导入后启动用时 {elapsed:.2f} 秒）")
+        application.run_polling()
+
+def main(mode: str = RUN_MODE, workers: int = WORKERS):
+    setup_logging()
+    ensure_schema()
+    if workers > 1:
+        run_ingress(mode, workers)
+        return
+    balance_cache.rebuild()
+    start_application(build_application(), mode)
+
+def cli(argv=None) -> int:
+    """命令行入口：默认启动机器人，另提供维护子命令"""
+    parser = argparse.ArgumentParser(description="阳陞国际会计机器人")
+    subparsers = parser.add_subparsers(dest='command')
+    run_parser = subparsers.add_parser('run', help="启动机器人（默认）")
+    run_parser.add_argument('--mode', choices=['polling', 'webhook'], default=RUN_MODE,
+                            help="接收更新的方式（默认取 FX_RUN_MODE，未设置时为 polling）")
+    run_parser.add_argument('--workers', type=int, default=WORKERS,
+                            help="工作进程数（默认取 FX_WORKERS；0 或 1 表示单进程）")
+    subparsers.add_parser('check-plans', help="检查处理器查询计划，出现全表扫描时以非零状态退出")
+    subparsers.add_parser('rebuild-rollups', help="从原始交易与支出历史重新生成日汇总")
+    args = parser.parse_args(argv)
+
+    if args.command == 'check-plans':
+        ensure_schema()
+        return 0 if check_query_plans() else 1
+    if args.command == 'rebuild-rollups':
+        ensure_schema()
+        rebuild_rollups()
+        return 0
+    main(getattr(args, 'mode', RUN_MODE), getattr(args, 'workers', WORKERS))
+    return 0
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    sys.exit(cli())
\ No newline at end of file
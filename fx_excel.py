@@ -0,0 +1,45 @@
+"""Excel 报表渲染
+
+在独立的工作进程中执行（见 fx_bot.render_excel），因此本模块只依赖 openpyxl，
+不导入机器人本身。工作表以只写（流式）模式生成，内存占用与行数无关。
+"""
+from io import BytesIO
+
+from openpyxl import Workbook
+from openpyxl.utils import get_column_letter
+
+# 列宽按表头和前若干行抽样估算，避免为大表逐格计算字符串长度
+WIDTH_SAMPLE_ROWS = 500
+
+
+def collect_columns(records: list) -> list:
+    """按首次出现的顺序收集所有记录的列名（与 DataFrame 构造行为一致）"""
+    columns = {}
+    for record in records:
+        for key in record:
+            columns.setdefault(key, None)
+    return list(columns)
+
+
+def render_workbook(sheets: list) -> bytes:
+    """将 [(工作表名, 记录列表)] 渲染为 xlsx 文件内容"""
+    workbook = Workbook(write_only=True)
+    for sheet_name, records in sheets:
+        worksheet = workbook.create_sheet(title=sheet_name)
+        columns = collect_columns(records)
+        if not columns:
+            continue
+
+        # 自动调整列宽（只写模式下必须在写入行之前设置）
+        sample = records[:WIDTH_SAMPLE_ROWS]
+        for idx, column in enumerate(columns, start=1):
+            longest = max((len(str(record[column])) for record in sample if record.get(column) is not None), default=0)
+            worksheet.column_dimensions[get_column_letter(idx)].width = max(longest, len(column)) + 2
+
+        worksheet.append(columns)
+        for record in records:
+            worksheet.append([record.get(column) for column in columns])
+
+    output = BytesIO()
+    workbook.save(output)
+    return output.getvalue()
@@ -0,0 +1,40 @@
+"""进程内测试共用的 fx_bot 模块：导入时按 FX_DB_PATH 绑定到一个临时数据库（整个测试会话共用）"""
+import contextvars
+from types import SimpleNamespace
+
+import pytest
+
+from bench.dataset import open_database
+
+
+@pytest.fixture(scope='session')
+def fx(tmp_path_factory):
+    module = open_database(str(tmp_path_factory.mktemp('db') / 'fx_bot.db'))
+    module.open_orders.rebuild()
+    return module
+
+
+@pytest.fixture
+def write(fx):
+    """经分组提交的写入路径执行 fn(session, ...) 并提交，返回 fn 的结果"""
+    def run(fn, *args):
+        ok, result = fx.commit_batch([(fn, args, {}, contextvars.copy_context())])[0]
+        if not ok:
+            raise result
+        return result
+    return run
+
+
+class FakeMessage:
+    """代替 telegram Message：记录 reply_text 发出的文本"""
+
+    def __init__(self):
+        self.sent = []
+
+    async def reply_text(self, text, **kwargs):
+        self.sent.append(text)
+
+
+@pytest.fixture
+def update():
+    return SimpleNamespace(message=FakeMessage())
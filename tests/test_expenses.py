@@ -0,0 +1,81 @@
+"""/expenses 按 (时间, 编号) 倒序的游标分页"""
+import asyncio
+import itertools
+import re
+import string
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+# 每个测试用一个其他测试不会用到的货币，与共用数据库中的其他支出隔开
+CURRENCIES = (f'Q{a}{b}' for a, b in itertools.product(string.ascii_uppercase, repeat=2))
+
+
+@pytest.fixture
+def currency():
+    return next(CURRENCIES)
+
+
+@pytest.fixture
+def expenses(fx, write, currency):
+    """25 条支出：每两条同一时间（检验同一时间按编号排序），金额即序号；按分页顺序返回 [(编号, 金额)]"""
+    base = datetime(2001, 3, 1, 9, 0)
+
+    def add(session):
+        rows = [fx.Expense(amount=float(i), currency=currency, purpose=f'p{i}',
+                           timestamp=base + timedelta(minutes=i // 2)) for i in range(25)]
+        session.add_all(rows)
+        session.flush()
+        return [(row.timestamp, row.id, int(row.amount)) for row in rows]
+
+    return [(expense_id, amount) for _, expense_id, amount in sorted(write(add), reverse=True)]
+
+
+@pytest.fixture
+def list_expenses(fx, update):
+    """以 args 执行 /expenses，返回本次回复的全部文本"""
+    def run(*args) -> str:
+        update.message.sent.clear()
+        asyncio.run(fx.list_expenses(update, SimpleNamespace(args=list(args))))
+        return '\n'.join(update.message.sent)
+    return run
+
+
+def page_amounts(text) -> list:
+    return [int(float(amount)) for amount in re.findall(r'金额: ([\d.,]+) ', text)]
+
+
+def next_args(text):
+    link = re.search(r'➡️ 下一页: /expenses (.+)', text)
+    return link.group(1).split() if link else None
+
+
+def test_pages_cover_every_expense_once(fx, list_expenses, currency, expenses, monkeypatch):
+    monkeypatch.setattr(fx, 'EXPENSES_PAGE', 10)
+    pages, args = [], [currency]
+    while args:
+        text = list_expenses(*args)
+        pages.append(page_amounts(text))
+        args = next_args(text)
+    assert [len(page) for page in pages] == [10, 10, 5]
+    assert sum(pages, []) == [amount for _, amount in expenses]
+
+
+def test_new_expense_does_not_shift_later_pages(fx, list_expenses, write, currency, expenses, monkeypatch):
+    monkeypatch.setattr(fx, 'EXPENSES_PAGE', 10)
+    first = list_expenses(currency)
+    write(fx.record_expense, 99.0, currency, '翻页期间新增')
+    second = list_expenses(*next_args(first))
+    assert page_amounts(second) == [amount for _, amount in expenses[10:20]]
+
+
+def test_next_link_keeps_date_filter(fx, list_expenses, currency, expenses, monkeypatch):
+    monkeypatch.setattr(fx, 'EXPENSES_PAGE', 4)
+    text = list_expenses('01/03/2001-01/03/2001', currency)
+    assert page_amounts(text) == [amount for _, amount in expenses[:4]]
+    assert next_args(text) == ['01/03/2001-01/03/2001', currency, f'p{expenses[3][0]}']
+
+
+def test_unknown_cursor_is_rejected(list_expenses, currency):
+    assert '分页标记无效' in list_expenses(currency, 'p999999999')
@@ -0,0 +1,67 @@
+"""报表缓存：按账本版本失效、LRU 与大小上限；/creport 的生成时间不进入缓存"""
+import asyncio
+from datetime import datetime
+
+
+def test_newer_version_drops_older_entries(fx):
+    cache = fx.ReportCache(max_entries=8, max_size=1024)
+    cache.put(1, 'a', 'one')
+    assert cache.get(1, 'a') == 'one'
+    cache.put(2, 'b', 'two')
+    assert cache.get(1, 'a') is fx.MISSING
+    assert cache.get(2, 'a') is fx.MISSING
+    assert cache.get(2, 'b') == 'two'
+    # 比当前版本旧的结果不写入
+    cache.put(1, 'a', 'stale')
+    assert len(cache) == 1 and cache.get(1, 'a') is fx.MISSING
+
+
+def test_evicts_least_recently_used(fx):
+    cache = fx.ReportCache(max_entries=2, max_size=1024)
+    cache.put(1, 'a', 'x')
+    cache.put(1, 'b', 'y')
+    cache.get(1, 'a')
+    cache.put(1, 'c', 'z')
+    assert [cache.get(1, key) for key in 'abc'] == ['x', fx.MISSING, 'z']
+
+
+def test_size_limit_evicts(fx):
+    cache = fx.ReportCache(max_entries=8, max_size=10)
+    cache.put(1, 'a', 'x' * 6)
+    cache.put(1, 'b', 'y' * 6)
+    assert cache.get(1, 'a') is fx.MISSING and cache.get(1, 'b') == 'y' * 6
+
+
+def test_ledger_write_invalidates_cached_report(fx, write):
+    builds = []
+
+    async def build():
+        builds.append(1)
+        return f"report {len(builds)}"
+
+    async def fetch():
+        return await fx.cached_report(('test', 'ledger'), build)
+
+    assert asyncio.run(fetch()) == 'report 1'
+    assert asyncio.run(fetch()) == 'report 1'
+    write(fx.record_expense, 10.0, 'MYR', '测试')
+    assert asyncio.run(fetch()) == 'report 2'
+
+
+def test_cached_statement_gets_fresh_header(fx, write, update):
+    write(fx.book_transaction, fx.generate_order_id(), 'header', 'buy', 'MYR', 'USDT', 100, 1.0, '*', 100)
+    start, end = datetime(2000, 1, 1), datetime(2100, 1, 1)
+    key = ('creport', 'header', start, end)
+
+    def send(header):
+        asyncio.run(fx.reply_cached_stream(update, key, fx.customer_statement_lines,
+                                           'header', start, end, header=header))
+
+    send('生成时间: 第一次')
+    send('生成时间: 第二次')
+    first, second = update.message.sent
+    assert first.startswith('生成时间: 第一次\n📊 当前余额:')
+    assert second.startswith('生成时间: 第二次\n📊 当前余额:')
+    assert first.split('\n', 1)[1] == second.split('\n', 1)[1]
+    version = asyncio.run(fx.run_report(fx.ledger_version))
+    assert all('第一次' not in message for message in fx.report_cache.get(version, key))
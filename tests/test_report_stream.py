@@ -0,0 +1,52 @@
+"""流式报表：按消息上限打包、分批生成时不在批次之间持有读事务"""
+import asyncio
+import sqlite3
+from datetime import datetime
+
+
+def test_pack_lines_keeps_entries_whole(fx):
+    entries = ['a' * 4, 'b' * 4, 'c\nc', 'd' * 4]
+    assert list(fx.pack_lines(entries, limit=10)) == ['aaaa\nbbbb', 'c\nc\ndddd']
+
+
+def test_pack_lines_splits_long_entry_by_line_then_by_char(fx):
+    assert list(fx.pack_lines(['xx\nyyyy\nzz'], limit=5)) == ['xx', 'yyyy', 'zz']
+    assert list(fx.pack_lines(['q', 'w' * 12], limit=5)) == ['q', 'wwwww', 'wwwww', 'ww']
+
+
+def test_pack_lines_counts_utf16_units(fx):
+    # emoji 占两个 UTF-16 码元：'📊' * 3 为 6 个码元
+    messages = list(fx.pack_lines(['📊' * 3, '📊' * 3], limit=10))
+    assert messages == ['📊' * 3, '📊' * 3]
+    assert all(fx.utf16_len(message) <= 10 for message in messages)
+
+
+def test_stream_releases_snapshot_between_batches(fx, write, monkeypatch):
+    monkeypatch.setattr(fx, 'STREAM_PREFETCH', 1)
+    monkeypatch.setattr(fx, 'STREAM_BATCH', 10)
+    order_ids = [fx.generate_order_id() for _ in range(60)]
+    write(lambda session: [
+        fx.book_transaction(session, order_id, 'stream', 'buy', 'MYR', 'USDT', 100, 1.0, '*', 100)
+        for order_id in order_ids
+    ])
+    start, end = datetime(2000, 1, 1), datetime(2100, 1, 1)
+
+    async def run():
+        stream = fx.ReportStream(fx.customer_statement_lines, ('stream', start, end))
+        batches, checkpoints = [], []
+        try:
+            while batch := await stream.next_batch():
+                batches.append(batch)
+                # 等待发送期间：其他连接写入后，检查点应能完整回写 WAL
+                write(fx.record_expense, 1.0, 'MYR', '检查点')
+                with sqlite3.connect(fx.DB_PATH) as conn:
+                    checkpoints.append(conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()[0])
+        finally:
+            await stream.close()
+        return batches, checkpoints
+
+    batches, checkpoints = asyncio.run(run())
+    assert len(batches) > 1
+    assert checkpoints == [0] * len(batches)
+    text = '\n'.join(message for batch in batches for message in batch)
+    assert [order_id for order_id in order_ids if order_id in text] == order_ids
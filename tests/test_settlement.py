@@ -0,0 +1,79 @@
+"""/received 按结算顺序分摊：FIFO/LIFO、超付余数、覆盖付款后不再载入其余订单"""
+import pytest
+from sqlalchemy import event
+
+
+@pytest.fixture
+def book(fx, write):
+    """为客户下若干笔 USDT 应付（'in' 一侧）各 amount 的买单，按时间先后返回订单号"""
+    def run(customer, *amounts):
+        return [
+            write(fx.book_transaction, fx.generate_order_id(), customer, 'buy', 'MYR', 'USDT',
+                  amount, 1.0, '*', amount)
+            for amount in amounts
+        ]
+    return run
+
+
+@pytest.fixture
+def transaction_selects(fx):
+    """记录对 transactions 表的 SELECT 及其参数个数"""
+    selects = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().startswith('SELECT') and 'FROM transactions' in statement:
+            selects.append(len(parameters or ()))
+
+    event.listen(fx.engine, 'before_cursor_execute', capture)
+    yield selects
+    event.remove(fx.engine, 'before_cursor_execute', capture)
+
+
+def settled_in(fx, order_id):
+    session = fx.Session()
+    try:
+        return session.query(fx.Transaction).filter_by(order_id=order_id).one().settled_in
+    finally:
+        fx.Session.remove()
+
+
+def test_fifo_settles_oldest_first(fx, write, book):
+    first, second, third = book('fifo', 100, 100, 100)
+    allocations = write(fx.apply_received, 'fifo', 'USDT', 150)
+    assert allocations == [(first, 100), (second, 50)]
+    assert [settled_in(fx, order_id) for order_id in (first, second, third)] == [100, 50, 0]
+
+
+def test_lifo_settles_newest_first(fx, write, book, monkeypatch):
+    monkeypatch.setattr(fx, 'SETTLEMENT_ORDER', 'lifo')
+    first, second, third = book('lifo', 100, 100, 100)
+    assert write(fx.apply_received, 'lifo', 'USDT', 150) == [(third, 100), (second, 50)]
+
+
+def test_overpayment_lands_on_last_order(fx, write, book):
+    first, second = book('over', 100, 100)
+    assert write(fx.apply_received, 'over', 'USDT', 250) == [(first, 100), (second, 150)]
+    assert fx.open_orders.candidates('over', 'USDT', 'in', 1) == []
+    # 订单全部结清后再付款：没有可分摊的订单
+    assert write(fx.apply_received, 'over', 'USDT', 10) == []
+
+
+def test_covered_payment_loads_only_covering_orders(fx, write, book, transaction_selects):
+    first, *_ = book('early', *[100] * 20)
+    assert write(fx.apply_received, 'early', 'USDT', 1) == [(first, 1)]
+    assert transaction_selects == [1]
+
+
+def test_stale_index_entry_loads_next_orders(fx, write, book, transaction_selects):
+    first, second, third = book('stale', 100, 100, 100)
+    # 模拟索引尚未看到的结算：第一笔在库中已结清
+    write(lambda session: session.query(fx.Transaction).filter_by(order_id=first)
+          .update({'settled_in': 100, 'status': 'partial'}))
+    assert write(fx.apply_received, 'stale', 'USDT', 150) == [(second, 100), (third, 50)]
+    assert transaction_selects == [2, 1]
+
+
+def test_falls_back_to_query_before_index_is_warm(fx, write, book, monkeypatch):
+    first, second = book('cold', 100, 100)
+    monkeypatch.setattr(fx.open_orders, 'warmed', False)
+    assert write(fx.apply_received, 'cold', 'USDT', 120) == [(first, 100), (second, 20)]
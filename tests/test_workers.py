@@ -0,0 +1,54 @@
+"""多进程部署：Ctrl+C（SIGINT 发往整个进程组）时工作进程处理完已排队的更新再正常退出"""
+import os
+import signal
+import socket
+import subprocess
+import sys
+
+from bench.fake_telegram import FakeTelegram
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+UPDATES = 30
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_sigint_drains_queued_updates(tmp_path):
+    fake_port, webhook_port = free_port(), free_port()
+    fake = FakeTelegram('127.0.0.1', fake_port).start()
+    env = dict(
+        os.environ,
+        FX_DB_PATH=str(tmp_path / 'fx_bot.db'),
+        FX_TELEGRAM_BASE_URL=f'http://127.0.0.1:{fake_port}',
+        FX_WEBHOOK_LISTEN='127.0.0.1',
+        FX_WEBHOOK_PORT=str(webhook_port),
+        FX_WEBHOOK_URL=f'http://127.0.0.1:{webhook_port}/telegram',
+        FX_CHAT_RATE='1000',
+        FX_CHAT_BURST='1000',
+    )
+    stderr = open(tmp_path / 'bot.err', 'w+')
+    bot = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'fx_bot.py'), 'run', '--mode', 'webhook', '--workers', '2'],
+        cwd=tmp_path, env=env, stderr=stderr, start_new_session=True,
+    )
+    try:
+        fake.wait_for_webhook(60)
+        for i in range(UPDATES):
+            fake.push(f'c{i % 7} 买 1000USD /4.42 MYR', chat_id=1)
+        # 模拟终端 Ctrl+C：信号发给入口进程与全部工作进程
+        os.killpg(bot.pid, signal.SIGINT)
+        assert bot.wait(60) == 0
+        replies = fake.wait_for_replies(1, UPDATES, timeout=5)
+    finally:
+        if bot.poll() is None:
+            os.killpg(bot.pid, signal.SIGKILL)
+        fake.stop()
+
+    stderr.seek(0)
+    log = stderr.read()
+    assert 'Traceback' not in log and 'KeyboardInterrupt' not in log, log
+    assert len(replies) == UPDATES